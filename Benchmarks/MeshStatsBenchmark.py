@@ -0,0 +1,226 @@
+#  Benchmarks of the hot paths of MeshStatsLogic, run headless with SlicerStandIn
+#  Synthetic meshes (spheres with random fields and ROIs) from 10k to several million vertices are
+#  timed on defineArray, computeAll, displayStatistics and both CSV exportations (separate files and
+#  single file). Each measure runs in a forked process to report its own peak memory.
+#  Results are written as JSON; with --baseline, measures slower than the baseline are reported as regressions.
+#
+#  Example:
+#      python MeshStatsBenchmark.py --vertices 10000 1000000 4000000 --shapes 1 8 -o results.json
+#      python MeshStatsBenchmark.py --baseline results.json
+
+import argparse
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy
+import vtk
+from vtk.util import numpy_support
+
+import SlicerStandIn
+SlicerStandIn.install(tempfile.gettempdir())
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import MeshStats
+
+STAGES = ['defineArray', 'computeAll', 'displayStatistics', 'exportSeparateFiles', 'exportSingleFile']
+
+
+def makeShape(numberOfVertices, numberOfFields, numberOfROIs, seed):
+    #  Sphere of about numberOfVertices vertices with fields (field0, field1, ...) of random distances
+    #  and ROIs (region0ROI, region1ROI, ...) covering caps of the sphere
+    resolution = max(3, int(math.ceil(math.sqrt(numberOfVertices))))
+    sphereSource = vtk.vtkSphereSource()
+    sphereSource.SetThetaResolution(resolution)
+    sphereSource.SetPhiResolution(resolution + 2)
+    sphereSource.Update()
+    polyData = vtk.vtkPolyData()
+    polyData.DeepCopy(sphereSource.GetOutput())
+    numberOfPoints = polyData.GetNumberOfPoints()
+    random = numpy.random.RandomState(seed)
+    points = numpy_support.vtk_to_numpy(polyData.GetPoints().GetData())
+    for i in range(numberOfFields):
+        array = numpy_support.numpy_to_vtk(random.standard_normal(numberOfPoints), deep=1)
+        array.SetName('field%d' % i)
+        polyData.GetPointData().AddArray(array)
+    for i in range(numberOfROIs):
+        direction = random.standard_normal(3)
+        mask = numpy.dot(points, direction / numpy.linalg.norm(direction)) > 0.2
+        array = numpy_support.numpy_to_vtk(mask.astype(numpy.float64), deep=1)
+        array.SetName('region%dROI' % i)
+        polyData.GetPointData().AddArray(array)
+    return polyData
+
+
+def checkedFieldTable(numberOfFields):
+    tableField = SlicerStandIn.QTableWidget()
+    tableField.setRowCount(numberOfFields)
+    for i in range(numberOfFields):
+        checkBox = SlicerStandIn.QCheckBox()
+        checkBox.setChecked(True)
+        tableField.setCellWidget(i, 0, checkBox)
+        tableField.setCellWidget(i, 1, SlicerStandIn.QLabel('field%d' % i))
+    return tableField
+
+
+def runStage(stage, modelList, numberOfFields, numberOfROIs):
+    #  Run stage once, return the number of elements processed (values or rows of CSV)
+    logic = MeshStats.MeshStatsLogic()
+    polyData = modelList[0].GetPolyData()
+    fieldArray = polyData.GetPointData().GetArray('field0')
+    ROIArray = polyData.GetPointData().GetArray('region0ROI') if numberOfROIs else 'None'
+    if stage == 'defineArray':
+        logic.defineArray(fieldArray, ROIArray)
+        return fieldArray.GetNumberOfTuples()
+    if stage == 'computeAll':
+        logic.computeAll(fieldArray, logic.StatisticStore(logic.percentiles), ROIArray)
+        return fieldArray.GetNumberOfTuples()
+
+    ROICheckBox = SlicerStandIn.QCheckBox()
+    ROICheckBox.setChecked(True)
+    ROIList = ['Entire Shape'] + ['region%dROI' % i for i in range(numberOfROIs)]
+    ROIDict = dict()
+    logic.displayStatistics(ROICheckBox, ROIList, ROIDict, SlicerStandIn.QComboBox(),
+                            checkedFieldTable(numberOfFields), modelList,
+                            SlicerStandIn.QTabWidget(), SlicerStandIn.QLayout())
+    if stage == 'displayStatistics':
+        return len(modelList) * polyData.GetNumberOfPoints() * numberOfFields * len(ROIList)
+
+    #  Both exportations (dot and comma) in new directories, so that no file has to be replaced
+    directory = tempfile.mkdtemp(prefix='MeshStatsBenchmark')
+    exportCheckBox = SlicerStandIn.QCheckBox()
+    exportCheckBox.setChecked(stage == 'exportSeparateFiles')
+    try:
+        timeBefore = time.time()
+        for BoolComa in (False, True):
+            directoryExport = SlicerStandIn.QObject()
+            directoryExport.directory = os.path.join(directory, 'comma' if BoolComa else 'dot')
+            os.mkdir(directoryExport.directory)
+            logic.exportationFunction(BoolComa, directoryExport, exportCheckBox, ROIDict)
+        exportTime = time.time() - timeBefore
+    finally:
+        shutil.rmtree(directory)
+    return 2 * len(modelList) * numberOfFields * len(ROIList), exportTime
+
+
+def measureStage(queue, stage, modelList, numberOfFields, numberOfROIs, repeat):
+    #  Run in a forked process: its peak memory only accounts for the stage
+    memoryBefore = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    times = list()
+    for i in range(repeat):
+        timeBefore = time.time()
+        elements = runStage(stage, modelList, numberOfFields, numberOfROIs)
+        elapsedTime = time.time() - timeBefore
+        if isinstance(elements, tuple):  # Exportations are timed without the statistics
+            elements, elapsedTime = elements
+        times.append(elapsedTime)
+    memoryAfter = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((elements, times, memoryBefore, memoryAfter))
+
+
+def benchmark(stage, modelList, numberOfFields, numberOfROIs, repeat):
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=measureStage,
+                                      args=(queue, stage, modelList, numberOfFields, numberOfROIs, repeat))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError("Stage %s failed (exit code %d)" % (stage, process.exitcode))
+    elements, times, memoryBefore, memoryAfter = queue.get()
+    #  ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    memoryUnit = 1 if sys.platform == 'darwin' else 1024
+    bestTime = min(times)
+    return {'stage': stage,
+            'vertices': modelList[0].GetPolyData().GetNumberOfPoints(),
+            'fields': numberOfFields,
+            'rois': numberOfROIs,
+            'shapes': len(modelList),
+            'repeat': repeat,
+            'seconds': {'min': bestTime, 'median': sorted(times)[len(times) // 2], 'max': max(times)},
+            'elements': elements,
+            'throughput': elements / bestTime if bestTime > 0 else None,
+            'throughputUnit': 'rows/s' if stage.startswith('export') else 'values/s',
+            'peakMemoryIncreaseBytes': (memoryAfter - memoryBefore) * memoryUnit,
+            'peakMemoryBytes': memoryAfter * memoryUnit}
+
+
+def caseKey(result):
+    return (result['stage'], result['vertices'], result['fields'], result['rois'], result['shapes'])
+
+
+def compareWithBaseline(results, baselineFilename, tolerance):
+    #  Return the measures whose best time is more than tolerance slower than in the baseline
+    with open(baselineFilename, 'r') as file:
+        baseline = dict((caseKey(result), result) for result in json.load(file)['results'])
+    regressions = list()
+    for result in results:
+        reference = baseline.get(caseKey(result))
+        if reference and result['seconds']['min'] > reference['seconds']['min'] * (1 + tolerance):
+            regressions.append({'case': caseKey(result),
+                                'seconds': result['seconds']['min'],
+                                'baselineSeconds': reference['seconds']['min']})
+    return regressions
+
+
+def parseArguments(argv):
+    parser = argparse.ArgumentParser(description="Benchmark MeshStatsLogic on synthetic meshes.")
+    parser.add_argument('--vertices', type=int, nargs='+', default=[10000, 100000, 1000000],
+                        help="approximate numbers of vertices of the meshes")
+    parser.add_argument('--fields', type=int, nargs='+', default=[1, 4], help="numbers of fields")
+    parser.add_argument('--rois', type=int, nargs='+', default=[1, 4], help="numbers of ROIs")
+    parser.add_argument('--shapes', type=int, nargs='+', default=[1, 8], help="numbers of shapes")
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES, help="stages to measure")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per measure, the best time is kept")
+    parser.add_argument('-o', '--output', help="JSON file of the results (default: standard output)")
+    parser.add_argument('--baseline', help="JSON file of previous results to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="relative slowdown reported as a regression (default: 0.2)")
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    options = parseArguments(argv)
+    results = list()
+    for numberOfVertices, numberOfShapes in itertools.product(options.vertices, options.shapes):
+        maximumFields = max(options.fields)
+        maximumROIs = max(options.rois)
+        modelList = [SlicerStandIn.ModelNode('shape%d' % i, makeShape(numberOfVertices, maximumFields, maximumROIs, i))
+                     for i in range(numberOfShapes)]
+        for stage in options.stages:
+            if stage in ('defineArray', 'computeAll'):
+                if numberOfShapes != min(options.shapes):
+                    continue  # Single array stages do not depend on the number of shapes
+                cases = [(1, min(maximumROIs, 1))]
+            else:
+                cases = itertools.product(options.fields, options.rois)
+            for numberOfFields, numberOfROIs in cases:
+                result = benchmark(stage, modelList, numberOfFields, numberOfROIs, options.repeat)
+                results.append(result)
+                print >> sys.stderr, "%-20s %9d vertices %2d fields %2d ROIs %3d shapes: %.4f s" % \
+                    (stage, result['vertices'], numberOfFields, numberOfROIs, numberOfShapes, result['seconds']['min'])
+
+    report = {'environment': {'python': platform.python_version(),
+                              'numpy': numpy.__version__,
+                              'vtk': vtk.vtkVersion.GetVTKVersion(),
+                              'platform': platform.platform(),
+                              'processors': multiprocessing.cpu_count()},
+              'results': results}
+    if options.baseline:
+        report['regressions'] = compareWithBaseline(results, options.baseline, options.tolerance)
+    if options.output:
+        with open(options.output, 'w') as file:
+            json.dump(report, file, indent=2, sort_keys=True)
+    else:
+        print json.dumps(report, indent=2, sort_keys=True)
+    return 1 if report.get('regressions') else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,227 @@
+#  Minimal stand-in for the qt, ctk and slicer modules of 3D Slicer
+#  Only what MeshStatsLogic needs to build its interface and tables is implemented: widgets keep their
+#  state (checked boxes, rows, tabs) but display nothing. Used to run MeshStats headless (see MeshStatsBenchmark.py).
+#
+#  install() must be called before importing MeshStats.
+
+import sys
+import types
+
+import vtk
+
+
+class StandIn(object):
+    #  Any method which is not defined does nothing
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: None
+
+
+class QObject(StandIn):
+    def connect(self, signal, slot):
+        self.__dict__.setdefault('slots', dict()).setdefault(signal, list()).append(slot)
+
+    def disconnect(self, signal, slot):
+        slots = self.__dict__.get('slots', dict()).get(signal, list())
+        if slot in slots:
+            slots.remove(slot)
+
+    def emit(self, signal, *args):
+        for slot in list(self.__dict__.get('slots', dict()).get(signal, list())):
+            slot(*args)
+
+
+class QCheckBox(QObject):
+    def __init__(self, text=''):
+        self.text = text
+        self.checked = False
+
+    def isChecked(self):
+        return self.checked
+
+    def setChecked(self, checked):
+        self.checked = checked
+
+
+class QLabel(QObject):
+    def __init__(self, text=''):
+        self.text = text
+
+
+class QLayout(QObject):
+    def __init__(self, *args):
+        self.items = list()
+
+    def addWidget(self, widget, *args):
+        self.items.append(widget)
+
+    def addLayout(self, layout, *args):
+        self.items.append(layout)
+
+    def indexOf(self, widget):
+        return self.items.index(widget) if widget in self.items else -1
+
+    def removeWidget(self, widget):
+        if widget in self.items:
+            self.items.remove(widget)
+
+    def removeItem(self, item):
+        self.removeWidget(item)
+
+
+class QWidget(QObject):
+    def setLayout(self, layout):
+        self.widgetLayout = layout
+
+    def layout(self):
+        return self.widgetLayout
+
+
+class QTableWidget(QWidget):
+    def __init__(self):
+        self.rowCount = 0
+        self.cells = dict()
+
+    def setRowCount(self, rowCount):
+        self.rowCount = rowCount
+
+    def setCellWidget(self, row, column, widget):
+        self.cells[(row, column)] = widget
+
+    def cellWidget(self, row, column):
+        return self.cells.get((row, column))
+
+    def clearContents(self):
+        self.cells.clear()
+
+
+class QTabWidget(QWidget):
+    def __init__(self):
+        self.tabs = list()
+        self.currentIndex = -1
+
+    @property
+    def count(self):
+        return len(self.tabs)
+
+    def addTab(self, widget, label):
+        self.tabs.append((widget, label))
+        if self.currentIndex == -1:
+            self.currentIndex = 0
+            self.emit('currentChanged(int)', 0)
+        return len(self.tabs) - 1
+
+    def widget(self, index):
+        return self.tabs[index][0]
+
+    def setCurrentIndex(self, index):
+        self.currentIndex = index
+        self.emit('currentChanged(int)', index)
+
+    def clear(self):
+        self.tabs = list()
+        self.currentIndex = -1
+
+
+class QTableView(QWidget):
+    def setModel(self, model):
+        self.tableModel = model
+
+    def model(self):
+        return self.tableModel
+
+
+class QAbstractTableModel(QObject):
+    pass
+
+
+class QComboBox(QObject):
+    def __init__(self):
+        self.itemTexts = list()
+        self.currentText = ''
+
+    def addItem(self, text):
+        self.itemTexts.append(text)
+        if len(self.itemTexts) == 1:
+            self.currentText = text
+
+    def clear(self):
+        self.itemTexts = list()
+        self.currentText = ''
+
+
+class Qt(object):
+    DisplayRole = 0
+    Horizontal = 1
+    Vertical = 2
+    AscendingOrder = 0
+    DescendingOrder = 1
+
+
+class App(object):
+    temporaryPath = None
+    cachePath = None
+
+
+def install(temporaryPath='.'):
+    #  Make qt, ctk and slicer importable from __main__ and slicer.ScriptedLoadableModule importable
+    qt = types.ModuleType('qt')
+    for standIn in (QObject, QCheckBox, QLabel, QWidget, QTableWidget, QTabWidget, QTableView,
+                    QAbstractTableModel, Qt):
+        setattr(qt, standIn.__name__, standIn)
+    for name in ('QFormLayout', 'QHBoxLayout', 'QVBoxLayout'):
+        setattr(qt, name, QLayout)
+    for name in ('QPushButton', 'QLineEdit', 'QProgressBar', 'QTimer'):
+        setattr(qt, name, QObject)
+
+    ctk = types.ModuleType('ctk')
+    ctk.ctkComboBox = QComboBox
+    ctk.ctkDirectoryButton = QObject
+    ctk.ctkMessageBox = QObject
+
+    scriptedLoadableModule = types.ModuleType('slicer.ScriptedLoadableModule')
+    for name in ('ScriptedLoadableModule', 'ScriptedLoadableModuleWidget',
+                 'ScriptedLoadableModuleLogic', 'ScriptedLoadableModuleTest'):
+        setattr(scriptedLoadableModule, name, type(name, (object,), dict()))
+    scriptedLoadableModule.__all__ = [name for name in dir(scriptedLoadableModule) if name.startswith('Scripted')]
+    slicer = types.ModuleType('slicer')
+    slicer.ScriptedLoadableModule = scriptedLoadableModule
+    slicer.app = App()
+    slicer.app.temporaryPath = slicer.app.cachePath = temporaryPath
+    slicer.mrmlScene = StandIn()
+
+    sys.modules['qt'] = qt
+    sys.modules['ctk'] = ctk
+    sys.modules['slicer'] = slicer
+    sys.modules['slicer.ScriptedLoadableModule'] = scriptedLoadableModule
+    main = sys.modules['__main__']
+    main.vtk = vtk
+    main.qt = qt
+    main.ctk = ctk
+    main.slicer = slicer
+
+
+class ModelNode(object):
+    #  Stand-in for a vtkMRMLModelNode (and its display node) holding polyData
+    def __init__(self, name, polyData):
+        self.name = name
+        self.polyData = polyData
+
+    def GetName(self):
+        return self.name
+
+    def GetID(self):
+        return 'vtkMRMLModelNode' + self.name
+
+    def GetModelDisplayNode(self):
+        return self
+
+    def GetInputPolyData(self):
+        return self.polyData
+
+    def GetPolyData(self):
+        return self.polyData
@@ -0,0 +1,339 @@
+#  Command line interface of Mesh Statistics
+#  Compute the statistics of MeshStatsLogic on .vtk/.vtp files read from disk, without Slicer,
+#  shapes being distributed over a pool of processes, and export them with the CSV layout of the module.
+#
+#  Example:
+#      python MeshStatsCLI.py /data/cohort -o /data/stats --fields "*Distance*" --rois "left*" -j 8
+
+import argparse
+import collections
+import csv
+import fnmatch
+import multiprocessing
+import os
+import re
+import sys
+
+import numpy
+import vtk
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from MeshStats import MeshStatsLogic, StatisticsCache, ArrayStore, StatisticsDatabase
+
+# Configuration of the worker processes (set by initializeWorker)
+workerOptions = None
+workerLogic = None
+
+
+def listMeshFiles(inputs, recursive):
+    #  inputs is a list of .vtk/.vtp files or of directories containing them
+    #  Return a list of (filename, name of shape): shapes are named by the path of their file relative to its input
+    #  directory, without extension (e.g. "subject01/left"), so that files of subdirectories keep different names
+    meshFiles = list()
+    for path in inputs:
+        if os.path.isdir(path):
+            for root, directories, files in os.walk(path):
+                directories.sort()
+                for filename in sorted(files):
+                    if os.path.splitext(filename)[1].lower() in ('.vtk', '.vtp'):
+                        relativePath = os.path.relpath(os.path.join(root, filename), path)
+                        shapeName = os.path.splitext(relativePath)[0].replace(os.sep, '/')
+                        meshFiles.append((os.path.join(root, filename), shapeName))
+                if not recursive:
+                    break
+        else:
+            meshFiles.append((path, os.path.splitext(os.path.basename(path))[0]))
+    return meshFiles
+
+
+def readPolyData(filename):
+    if os.path.splitext(filename)[1].lower() == '.vtp':
+        reader = vtk.vtkXMLPolyDataReader()
+    else:
+        reader = vtk.vtkPolyDataReader()
+    reader.SetFileName(filename)
+    reader.Update()
+    return reader.GetOutput()
+
+
+def matchesAny(name, patterns):
+    for pattern in patterns:
+        if fnmatch.fnmatchcase(name, pattern):
+            return True
+    return False
+
+
+def selectArrays(arrayIndex, fieldPatterns, ROIPatterns, entireShape):
+    #  arrayIndex is given by MeshStatsLogic.indexPointData
+    #  Fields are the scalar arrays whose name does not end with ROI or Labels, ROIs are the ones ending with ROI,
+    #  or with Labels for label arrays (same convention as MeshStatsLogic.updateInterface)
+    fieldNames = list()
+    ROINames = ['Entire Shape'] if entireShape else list()
+    for arrayName, (numberOfComponents, dataType) in arrayIndex.iteritems():
+        if numberOfComponents != 1:
+            continue
+        if re.search(r"(ROI|Labels)$", arrayName):
+            if matchesAny(arrayName, ROIPatterns):
+                ROINames.append(arrayName)
+        elif matchesAny(arrayName, fieldPatterns):
+            fieldNames.append(arrayName)
+    return fieldNames, ROINames
+
+
+def configureLogic(logic, options):
+    logic.setPercentiles(options.percentiles)
+    logic.streaming = options.streaming
+    logic.bootstrapResamples = options.bootstrap
+    logic.bootstrapConfidence = options.confidence
+    logic.bootstrapSeed = options.seed
+    if options.histogram:
+        logic.histogramBins = int(options.histogram[0])
+        logic.histogramRange = tuple(options.histogram[1:])
+    logic.smoothingRings = options.smooth
+    logic.localRings = options.localRings
+
+
+def initializeWorker(options):
+    global workerOptions, workerLogic
+    workerOptions = options
+    workerLogic = MeshStatsLogic()
+    configureLogic(workerLogic, options)
+    workerLogic.computeCohortStatistics = False  # Sketches of the shapes are merged by the main process
+    #  Shapes are already spread over the processes: their bootstrap threads share the processors
+    workerLogic.bootstrapThreads = max(1, multiprocessing.cpu_count() // max(1, options.processes))
+    if options.cache:
+        workerLogic.cache = StatisticsCache(options.cache, fullHash=options.cacheFullHash)
+    if options.store:
+        workerLogic.arrayStore = ArrayStore(options.store)
+
+
+def computeShape(meshFile):
+    #  Compute the statistics of one mesh file, given as (filename, name of shape) (see listMeshFiles)
+    #  Return (name of shape, list of (ROI, field, row of statistics, histogram or None, StreamingStatistics or None)),
+    #  or (filename, error message)
+    #  With the array store, a mesh whose file did not change since it was stored is not read again
+    filename, shapeName = meshFile
+    version = (os.path.abspath(filename), os.path.getmtime(filename), os.path.getsize(filename))
+    arrayStore = workerLogic.arrayStore
+    polyData = None
+    arrayIndex = arrayStore.getIndex(shapeName, version) if arrayStore else None
+    if arrayIndex is None:
+        polyData = readPolyData(filename)
+        if polyData is None or polyData.GetNumberOfPoints() == 0:
+            return filename, "Cannot read a mesh from " + filename
+        arrayIndex = workerLogic.indexPointData(polyData.GetPointData())
+        if arrayStore:
+            arrayStore.putIndex(shapeName, version, arrayIndex)
+    fieldNames, ROINames = selectArrays(arrayIndex, workerOptions.fields, workerOptions.rois, workerOptions.entireShape)
+    ROIDict = dict()
+    for ROIName in ROINames:
+        ROIDict[ROIName] = dict((fieldName, dict()) for fieldName in fieldNames)
+    try:
+        plan = workerLogic.planRun([(shapeName, polyData, version)], ROIDict)
+    except KeyError:  # Arrays selected for the first time: not stored yet
+        polyData = readPolyData(filename)
+        plan = workerLogic.planRun([(shapeName, polyData, version)], ROIDict)
+    workerLogic.executePlan(plan, ROIDict)
+    workerLogic.releaseShapes([])  # A worker computes many shapes, each only once
+    rows = list()
+    for ROIName, fieldDict in ROIDict.iteritems():
+        for fieldName, shapeDict in fieldDict.iteritems():
+            for name, shapeStats in shapeDict.iteritems():
+                histogram = shapeStats.histogram.tolist() if shapeStats.histogram is not None else None
+                streamingStatistics = getattr(shapeStats, 'streamingStatistics', None)
+                rows.append((ROIName, fieldName, workerLogic.statisticsRow(name, shapeStats), histogram,
+                             streamingStatistics))
+    return shapeName, rows
+
+
+class CSVExporter(object):
+    #  Write the rows of statistics with the layout of MeshStatsLogic.exportationFunction:
+    #  - separate files: <directory>/<ROI>/<field>.csv, rows are written as soon as they are received
+    #  - single file: <directory>/<ROI>.csv with one section per field, written when all shapes are done
+    #  Histograms (bins of histogramEdges) are written after the statistics of each field, when all shapes are done
+    def __init__(self, logic, directory, header, separateFiles, comma, histogramEdges=None):
+        self.logic = logic
+        self.directory = directory
+        self.header = header
+        self.separateFiles = separateFiles
+        self.delimiter = ';' if comma else ','
+        self.decimalSeparator = ',' if comma else '.'
+        self.files = dict()  # Key = (ROI, field), Value = (file, csv writer)
+        self.sections = collections.defaultdict(lambda: collections.defaultdict(list))
+        self.histogramEdges = histogramEdges
+        self.histograms = collections.defaultdict(list)  # Key = (ROI, field), Value = list of (shape, histogram)
+
+    def addRow(self, ROIName, fieldName, row, histogram=None):
+        if histogram is not None:
+            self.histograms[(ROIName, fieldName)].append((row[0], histogram))
+        if not self.separateFiles:
+            self.sections[ROIName][fieldName].append(row)
+            return
+        key = (ROIName, fieldName)
+        if key not in self.files:
+            directoryFolder = os.path.join(self.directory, ROIName)
+            if not os.path.exists(directoryFolder):
+                os.makedirs(directoryFolder)
+            file = open(os.path.join(directoryFolder, fieldName + '.csv'), 'wb')
+            cw = csv.writer(file, delimiter=self.delimiter)
+            cw.writerow([fieldName])
+            cw.writerow(self.header)
+            self.files[key] = (file, cw)
+        self.files[key][1].writerow(self.logic.formatRow(row, self.decimalSeparator))
+
+    def writeHistograms(self, cw, ROIName, fieldName):
+        histograms = self.histograms.get((ROIName, fieldName))
+        if histograms:
+            self.logic.writeHistogramRows(cw, self.histogramEdges, histograms, self.decimalSeparator)
+
+    def close(self):
+        for (ROIName, fieldName), (file, cw) in self.files.iteritems():
+            self.writeHistograms(cw, ROIName, fieldName)
+            file.close()
+        for ROIName, fieldDict in sorted(self.sections.iteritems()):
+            with open(os.path.join(self.directory, ROIName + '.csv'), 'wb') as file:
+                cw = csv.writer(file, delimiter=self.delimiter)
+                cw.writerow([ROIName])
+                for fieldName, rows in sorted(fieldDict.iteritems()):
+                    cw.writerow([fieldName])
+                    cw.writerow(self.header)
+                    for row in rows:
+                        cw.writerow(self.logic.formatRow(row, self.decimalSeparator))
+                    self.writeHistograms(cw, ROIName, fieldName)
+                    cw.writerow([' '])
+
+
+def parseArguments(argv):
+    parser = argparse.ArgumentParser(description="Compute Mesh Statistics on .vtk/.vtp files.")
+    parser.add_argument('inputs', nargs='+', help=".vtk/.vtp files or directories containing them")
+    parser.add_argument('-o', '--output', required=True, help="directory where CSV files are written")
+    parser.add_argument('-f', '--fields', nargs='+', default=['*'],
+                        help="names or patterns (fnmatch) of the fields (default: all)")
+    parser.add_argument('-r', '--rois', nargs='+', default=['*'],
+                        help="names or patterns (fnmatch) of the ROI arrays, whose names end with ROI, "
+                             "or of the label arrays, whose names end with Labels (default: all)")
+    parser.add_argument('--no-entire-shape', dest='entireShape', action='store_false',
+                        help="do not compute the statistics on the entire shape")
+    parser.add_argument('-p', '--percentiles', default='5,15,25,50,75,85,95',
+                        help="percentiles separated by commas (default: 5,15,25,50,75,85,95)")
+    parser.add_argument('-j', '--processes', type=int, default=multiprocessing.cpu_count(),
+                        help="number of processes (default: number of cores)")
+    parser.add_argument('--single-file', dest='separateFiles', action='store_false',
+                        help="export all the fields of a ROI in the same file")
+    parser.add_argument('--comma', action='store_true', help="export as 0,000 (';' as separator)")
+    parser.add_argument('--streaming', action='store_true', help="bounded memory, approximate percentiles")
+    parser.add_argument('--bootstrap', type=int, default=0,
+                        help="number of bootstrap resamples of the confidence intervals of the mean and of the percentiles "
+                             "(default: 0, no interval)")
+    parser.add_argument('--confidence', type=float, default=95, help="confidence of the intervals in percent (default: 95)")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the bootstrap resamples (default: 0)")
+    parser.add_argument('--histogram', nargs=3, type=float, metavar=('BINS', 'LOW', 'HIGH'),
+                        help="histograms of BINS bins between LOW and HIGH, the same for all the shapes "
+                             "(written after the statistics of each field)")
+    parser.add_argument('--smooth', type=int, default=0, metavar='N',
+                        help="add the fields smoothed over N rings of neighbors (e.g. \"Distance Smoothed 2-ring\")")
+    parser.add_argument('--local-rings', dest='localRings', type=int, default=0, metavar='K',
+                        help="add the local mean and standard deviation of the fields over K rings of neighbors")
+    parser.add_argument('--sqlite', help="SQLite database to which the statistics are added (created if needed), "
+                                         "replacing the ones of the same shapes, ROIs and fields")
+    parser.add_argument('--cache', help="directory of the statistics cache (unchanged shapes are not recomputed)")
+    parser.add_argument('--cache-full-hash', dest='cacheFullHash', action='store_true',
+                        help="identify the arrays of the cache by their whole content instead of the modification "
+                             "time of their file and a sample of their values (slower)")
+    parser.add_argument('--store', help="directory of the array store: arrays are read from memory mapped copies "
+                                        "(unchanged meshes are not read again)")
+    parser.add_argument('--recursive', action='store_true', help="search the input directories recursively")
+    options = parser.parse_args(argv)
+    options.percentiles = [value for value in re.split(r"[,;\s]+", options.percentiles.strip()) if value]
+    if not 0 < options.confidence < 100:
+        parser.error("--confidence must be in ]0, 100[")
+    if options.histogram and (options.histogram[0] < 1 or options.histogram[0] != int(options.histogram[0])
+                              or not options.histogram[1] < options.histogram[2]):
+        parser.error("--histogram needs a positive number of bins and LOW < HIGH")
+    if options.smooth < 0 or options.localRings < 0:
+        parser.error("--smooth and --local-rings cannot be negative")
+    return options
+
+
+def main(argv):
+    options = parseArguments(argv)
+    logic = MeshStatsLogic()
+    try:
+        logic.setPercentiles(options.percentiles)
+    except ValueError as error:
+        print >> sys.stderr, error
+        return 2
+    options.percentiles = logic.percentiles
+    meshFiles = listMeshFiles(options.inputs, options.recursive)
+    if not meshFiles:
+        print >> sys.stderr, "No .vtk/.vtp file found"
+        return 1
+    #  Rows, database records and stored arrays of a shape are identified by its name
+    shapeNames = collections.Counter(shapeName for filename, shapeName in meshFiles)
+    duplicateNames = sorted(shapeName for shapeName, count in shapeNames.iteritems() if count > 1)
+    if duplicateNames:
+        print >> sys.stderr, "Several meshes are named " + ", ".join(duplicateNames) + \
+            " (shapes are named by their path relative to their input directory)"
+        return 2
+    if not os.path.exists(options.output):
+        os.makedirs(options.output)
+
+    confidence = options.confidence if options.bootstrap and not options.streaming else None
+    histogramEdges = None
+    if options.histogram:
+        histogramEdges = numpy.linspace(options.histogram[1], options.histogram[2], int(options.histogram[0]) + 1)
+    exporter = CSVExporter(logic, options.output, logic.statisticsHeader(logic.percentiles, confidence),
+                           options.separateFiles, options.comma, histogramEdges)
+    database = None
+    records = list()  # Records not written to the database yet, written by transactions of at least 100000 records
+    entries = list()  # (shape, ROI, field) of these records, whose previous statistics are replaced
+    if options.sqlite:
+        configureLogic(logic, options)
+        database = StatisticsDatabase(options.sqlite)
+        runID = database.addRun(logic.runConfiguration())
+    if options.streaming:
+        logic.cohortStatistics = collections.OrderedDict()  # Sketches of the shapes, merged as they are received
+
+    numberOfErrors = 0
+    pool = multiprocessing.Pool(max(1, options.processes), initializeWorker, (options,))
+    try:
+        for numberOfShapes, (shapeName, rows) in enumerate(pool.imap_unordered(computeShape, meshFiles), 1):
+            if isinstance(rows, basestring):
+                print >> sys.stderr, rows
+                numberOfErrors += 1
+                continue
+            for ROIName, fieldName, row, histogram, streamingStatistics in rows:
+                exporter.addRow(ROIName, fieldName, row, histogram)
+                if streamingStatistics is not None:
+                    logic.mergeCohortStatistics(ROIName, fieldName, streamingStatistics)
+            if database is not None:
+                for ROIName, fieldName, row, histogram, streamingStatistics in rows:
+                    records += logic.rowRecords(ROIName, fieldName, exporter.header, row, histogram, histogramEdges)
+                    entries.append((row[0], ROIName, fieldName))
+                if len(records) >= 100000:
+                    database.write(runID, records, entries)
+                    records = list()
+                    entries = list()
+            print "[%d/%d] %s" % (numberOfShapes, len(meshFiles), shapeName)
+        pool.close()
+        if logic.cohortStatistics:
+            for (ROIName, fieldName), cohortStatistics in logic.cohortStatistics.iteritems():
+                row = logic.statisticsRow(logic.cohortName, logic.createCohortStatisticStore(cohortStatistics))
+                exporter.addRow(ROIName, fieldName, row)
+                if database is not None:
+                    records += logic.rowRecords(ROIName, fieldName, exporter.header, row)
+                    entries.append((row[0], ROIName, fieldName))
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        exporter.close()
+        if database is not None:
+            database.write(runID, records, entries)
+            database.close()
+    return 1 if numberOfErrors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
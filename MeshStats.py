@@ -1,11 +1,25 @@
 import numpy
 import math
 import re
+import collections
 import csv
 import os
-from __main__ import vtk, qt, ctk, slicer
-from random import randint
-from slicer.ScriptedLoadableModule import *
+import hashlib
+import json
+import sqlite3
+import functools
+import threading
+import time
+try:
+    from __main__ import vtk, qt, ctk, slicer
+    from slicer.ScriptedLoadableModule import *
+except ImportError:
+    #  Outside of Slicer (see CLI/MeshStatsCLI.py) only MeshStatsLogic can be used
+    import vtk
+    qt = ctk = slicer = None
+    ScriptedLoadableModule = ScriptedLoadableModuleWidget = object
+    ScriptedLoadableModuleLogic = ScriptedLoadableModuleTest = object
+from vtk.util import numpy_support
 
 class MeshStats(ScriptedLoadableModule):
     def __init__(self, parent):
@@ -81,15 +95,96 @@ class MeshStatsWidget(ScriptedLoadableModuleWidget):
 
         self.layout.addLayout(fieldLayout)
         # ------------------------------------------------------------------------------------
+        #                                  PERCENTILES
+        # ------------------------------------------------------------------------------------
+        self.percentileLineEdit = qt.QLineEdit(', '.join(str(percent) for percent in self.logic.percentiles))
+        self.percentileLineEdit.setToolTip("Percentiles computed on each shape, between 0 and 100, separated by commas")
+        percentileLayout = qt.QFormLayout()
+        percentileLayout.addRow(" Percentiles: ", self.percentileLineEdit)
+        self.populationComboBox = slicer.qMRMLNodeComboBox()
+        self.populationComboBox.nodeTypes = ['vtkMRMLModelNode']
+        self.populationComboBox.noneEnabled = True
+        self.populationComboBox.addEnabled = False
+        self.populationComboBox.removeEnabled = False
+        self.populationComboBox.setMRMLScene(slicer.mrmlScene)
+        self.populationComboBox.setToolTip("Model on which the per vertex statistics of the shapes are added "
+                                           "(shapes must have the same number of points)")
+        percentileLayout.addRow(" Population maps on: ", self.populationComboBox)
+        self.bootstrapSpinBox = qt.QSpinBox()
+        self.bootstrapSpinBox.setRange(0, 100000)
+        self.bootstrapSpinBox.setSingleStep(500)
+        self.bootstrapSpinBox.setSpecialValueText("No confidence intervals")
+        self.bootstrapSpinBox.setToolTip("Number of bootstrap resamples used to compute the 95% confidence intervals "
+                                         "of the mean and of the percentiles")
+        percentileLayout.addRow(" Bootstrap resamples: ", self.bootstrapSpinBox)
+        self.histogramSpinBox = qt.QSpinBox()
+        self.histogramSpinBox.setRange(0, 10000)
+        self.histogramSpinBox.setSpecialValueText("No histogram")
+        self.histogramSpinBox.setToolTip("Number of bins of the histograms of the fields, whose edges are shared by all "
+                                         "the shapes and ROIs (exported after the statistics of each field)")
+        percentileLayout.addRow(" Histogram bins: ", self.histogramSpinBox)
+        self.smoothingSpinBox = qt.QSpinBox()
+        self.smoothingSpinBox.setRange(0, 20)
+        self.smoothingSpinBox.setSpecialValueText("No smoothing")
+        self.smoothingSpinBox.setToolTip("Number of rings of neighbors over which the fields are smoothed, the "
+                                         "smoothed fields being added to the statistics (e.g. \"Distance Smoothed 2-ring\")")
+        percentileLayout.addRow(" Smoothing rings: ", self.smoothingSpinBox)
+        self.localRingsSpinBox = qt.QSpinBox()
+        self.localRingsSpinBox.setRange(0, 20)
+        self.localRingsSpinBox.setSpecialValueText("No local statistics")
+        self.localRingsSpinBox.setToolTip("Number of rings of neighbors of the local mean and standard deviation of the "
+                                          "fields around each vertex, added to the statistics as fields")
+        percentileLayout.addRow(" Local statistics rings: ", self.localRingsSpinBox)
+
+        self.layout.addLayout(percentileLayout)
+        # ------------------------------------------------------------------------------------
         #                                    RUN
         # ------------------------------------------------------------------------------------
         self.runButton = qt.QPushButton(" Run ")
         self.runButton.enabled = False
+        self.streamingCheckBox = qt.QCheckBox("Bounded memory")
+        self.streamingCheckBox.setToolTip("Read the fields by chunks and approximate the percentiles (for very dense meshes)")
         roiLayout = qt.QHBoxLayout()
         roiLayout.addWidget(self.runButton)
+        roiLayout.addWidget(self.streamingCheckBox)
+        self.areaWeightedCheckBox = qt.QCheckBox("Area weighted")
+        self.areaWeightedCheckBox.setToolTip("Weight each vertex by its share of the surface area")
+        roiLayout.addWidget(self.areaWeightedCheckBox)
+        self.cacheCheckBox = qt.QCheckBox("Use cache")
+        self.cacheCheckBox.setToolTip("Keep the statistics on disk to skip the computation of unchanged shapes")
+        roiLayout.addWidget(self.cacheCheckBox)
+        self.arrayStoreCheckBox = qt.QCheckBox("Arrays on disk")
+        self.arrayStoreCheckBox.setToolTip("Compute from memory mapped copies of the arrays (for cohorts larger than the memory)")
+        roiLayout.addWidget(self.arrayStoreCheckBox)
+        self.liveCheckBox = qt.QCheckBox("Live")
+        self.liveCheckBox.setToolTip("After a Run, recompute only the statistics of the shapes and arrays which change")
+        roiLayout.addWidget(self.liveCheckBox)
 
         self.layout.addLayout(roiLayout)
         self.runButton.connect('clicked()', self.onRunButton)
+        self.liveCheckBox.connect('toggled(bool)', self.onLiveCheckBoxToggled)
+        #  Live mode: modifications of the shapes are gathered by this timer before updating the statistics
+        self.liveTimer = qt.QTimer()
+        self.liveTimer.setSingleShot(True)
+        self.liveTimer.setInterval(500)
+        self.liveTimer.connect('timeout()', self.onLiveTimer)
+        self.liveObservers = list()  # (observed object, tag)
+        self.liveUpdate = False
+        # ---------------------------- Progress - Cancel Button ------------------------------
+        self.progressBar = qt.QProgressBar()
+        self.cancelButton = qt.QPushButton("Cancel")
+        progressLayout = qt.QHBoxLayout()
+        progressLayout.addWidget(self.progressBar)
+        progressLayout.addWidget(self.cancelButton)
+        self.progressBar.hide()
+        self.cancelButton.hide()
+
+        self.layout.addLayout(progressLayout)
+        self.cancelButton.connect('clicked()', self.onCancelButton)
+        #  Results of the background computation are collected on the GUI thread by this timer
+        self.pollTimer = qt.QTimer()
+        self.pollTimer.setInterval(100)
+        self.pollTimer.connect('timeout()', self.onPollTimer)
         # ------------------------------------------------------------------------------------
         #                          Statistics Table - Export
         # ------------------------------------------------------------------------------------
@@ -104,6 +199,9 @@ class MeshStatsWidget(ScriptedLoadableModuleWidget):
         self.exportDotButton.enabled = True
         self.exportComaButton = qt.QPushButton("Export as 0,000")
         self.exportComaButton.enabled = True
+        self.exportSQLiteButton = qt.QPushButton("Export to SQLite")
+        self.exportSQLiteButton.setToolTip("Add the statistics to MeshStats.sqlite in the directory, replacing the ones "
+                                           "of the same shapes, ROIs and fields")
 
         self.exportLayout = qt.QVBoxLayout()
         self.directoryAndExportLayout = qt.QHBoxLayout()
@@ -112,24 +210,112 @@ class MeshStatsWidget(ScriptedLoadableModuleWidget):
         self.exportButtonsLayout = qt.QHBoxLayout()
         self.exportButtonsLayout.addWidget(self.exportDotButton)
         self.exportButtonsLayout.addWidget(self.exportComaButton)
+        self.exportButtonsLayout.addWidget(self.exportSQLiteButton)
 
         self.exportLayout.addLayout(self.directoryAndExportLayout)
         self.exportLayout.addLayout(self.exportButtonsLayout)
 
         self.logic.updateInterface(self.tableField, self.ROIComboBox, self.ROIList, self.modelList, self.layout)
+        self.layout.addStretch(1)
 
         # ------------------------------------------------------------------------------------
         #                                   OBSERVERS
         # ------------------------------------------------------------------------------------
-        def onCloseScene(obj, event):
-            # initialize Parameters
-            globals()["MeshStats"] = slicer.util.reloadScriptedModule("MeshStats")
-        slicer.mrmlScene.AddObserver(slicer.mrmlScene.EndCloseEvent, onCloseScene)
+        #  Registered once, removed by cleanup: closing a scene resets the widget in place (see onCloseScene)
+        self.closeSceneObserverTag = slicer.mrmlScene.AddObserver(slicer.mrmlScene.EndCloseEvent, self.onCloseScene)
+
+    def cleanup(self):
+        self.pollTimer.stop()
+        self.liveTimer.stop()
+        self.observeModels(False)
+        self.logic.reset()  # Cancels the running tasks and closes the pools of threads
+        if self.closeSceneObserverTag is not None:
+            slicer.mrmlScene.RemoveObserver(self.closeSceneObserverTag)
+            self.closeSceneObserverTag = None
+
+    def onCloseScene(self, caller, event):
+        #  Clear the shapes, ROIs, statistics, tables and caches of the closed scene, keeping the widgets and
+        #  the settings: the time taken does not depend on the number of scenes closed before
+        if self.pollTimer.isActive():
+            self.pollTimer.stop()
+            self.progressBar.hide()
+            self.cancelButton.hide()
+        self.liveTimer.stop()
+        self.liveUpdate = False
+        self.observeModels(False)
+        self.removeResults()
+        self.ROIDict.clear()
+        self.modelList = list()
+        self.logic.reset()
+        self.logic.updateInterface(self.tableField, self.ROIComboBox, self.ROIList, self.modelList, self.layout)
+        self.runButton.enabled = False
+
+    def removeResults(self):
+        #  Remove the tables and the export buttons of the last Run
+        self.logic.removeTable(self.layout, self.tabROI)
+        self.exportDotButton.disconnect('clicked()', self.onExportDotButton)
+        self.layout.removeWidget(self.exportDotButton)
+        self.exportComaButton.disconnect('clicked()', self.onExportComaButton)
+        self.layout.removeWidget(self.exportComaButton)
+        self.exportSQLiteButton.disconnect('clicked()', self.onExportSQLiteButton)
+        self.layout.removeItem(self.exportLayout)
 
     def onInputComboBoxCheckedNodesChanged(self):
         self.modelList = self.inputComboBox.checkedNodes()
-        self.runButton.enabled = not self.inputComboBox.noneChecked()
+        #  Enabled again by onStatisticsFinished during a computation: its tasks read the plan a Run would replace
+        self.runButton.enabled = not self.inputComboBox.noneChecked() and not self.pollTimer.isActive()
         self.logic.updateInterface(self.tableField, self.ROIComboBox, self.ROIList, self.modelList, self.layout)
+        if self.liveCheckBox.isChecked():
+            self.observeModels()
+            self.liveTimer.start()
+
+    def observeModels(self, observe=True):
+        #  Live mode: observe the checked models, their polydata and point data (removing the previous observers)
+        for observedObject, tag in self.liveObservers:
+            observedObject.RemoveObserver(tag)
+        self.liveObservers = list()
+        if not observe:
+            return
+        for model in self.modelList:
+            polyData = model.GetModelDisplayNode().GetInputPolyData()
+            events = [(model, vtk.vtkCommand.ModifiedEvent)]
+            if hasattr(model, 'PolyDataModifiedEvent'):
+                events.append((model, model.PolyDataModifiedEvent))
+            if polyData is not None:
+                events += [(polyData, vtk.vtkCommand.ModifiedEvent),
+                           (polyData.GetPointData(), vtk.vtkCommand.ModifiedEvent)]
+            for observedObject, event in events:
+                self.liveObservers.append((observedObject, observedObject.AddObserver(event, self.onLiveModified)))
+
+    def onLiveCheckBoxToggled(self, checked):
+        self.observeModels(checked)
+        if checked:
+            self.liveTimer.start()
+        else:
+            self.liveTimer.stop()
+
+    def onLiveModified(self, caller, event):
+        self.liveTimer.start()  # Restarted by each modification: shapes are updated once they stop changing
+
+    def onLiveTimer(self):
+        if not self.liveCheckBox.isChecked() or not self.ROIDict:
+            return
+        if self.pollTimer.isActive():  # Wait for the end of the computation
+            self.liveTimer.start()
+            return
+        self.observeModels()  # Polydata may have been replaced
+        tasks, changedROIs = self.logic.planLiveStatistics(self.logic.modelShapes(self.modelList), self.ROIDict)
+        for ROIName in changedROIs:
+            self.logic.refreshROITable(ROIName, self.ROIDict[ROIName])
+        if not tasks:
+            return
+        self.liveUpdate = True
+        self.runButton.enabled = False
+        self.logic.startStatistics(None, self.ROIDict, tasks=tasks)
+        self.progressBar.setValue(0)
+        self.progressBar.setMaximum(max(1, self.logic.numberOfTasks))
+        self.progressBar.show()
+        self.pollTimer.start()
 
     def onROICheckBoxStateChanged(self, intCheckState):
         # intCheckState == 2 when checked
@@ -141,20 +327,81 @@ class MeshStatsWidget(ScriptedLoadableModuleWidget):
                 self.ROIComboBox.setEnabled(True)
 
     def onRunButton(self):
+        if self.pollTimer.isActive():
+            return
+        try:
+            self.logic.parsePercentiles(self.percentileLineEdit.text)
+        except ValueError as error:
+            messageBox = ctk.ctkMessageBox()
+            messageBox.setWindowTitle(" /!\ WARNING /!\ ")
+            messageBox.setIcon(messageBox.Warning)
+            messageBox.setText("Invalid percentiles: " + str(error))
+            messageBox.exec_()
+            return
+        self.logic.streaming = self.streamingCheckBox.isChecked()
+        self.logic.areaWeighted = self.areaWeightedCheckBox.isChecked()
+        self.logic.bootstrapResamples = self.bootstrapSpinBox.value
+        self.logic.histogramBins = self.histogramSpinBox.value
+        self.logic.smoothingRings = self.smoothingSpinBox.value
+        self.logic.localRings = self.localRingsSpinBox.value
+        populationNode = self.populationComboBox.currentNode()
+        self.logic.computePopulationMaps = populationNode is not None
+        if not self.cacheCheckBox.isChecked():
+            self.logic.cache = None
+        elif self.logic.cache is None:
+            #  Versions of the shapes are modification times, only valid in this session: entries kept across sessions
+            #  are keyed by the whole content of the arrays
+            self.logic.cache = StatisticsCache(os.path.join(slicer.app.cachePath, 'MeshStats'), fullHash=True)
+        if not self.arrayStoreCheckBox.isChecked():
+            self.logic.arrayStore = None
+        elif self.logic.arrayStore is None:
+            self.logic.arrayStore = ArrayStore(os.path.join(slicer.app.cachePath, 'MeshStatsArrays'))
+            self.logic.arrayStore.clear()  # Versions of the shapes are modification times, only valid in this session
         self.ROIDict.clear()
         if self.modelList:
-            self.logic.removeTable(self.layout, self.tabROI)
-            self.exportDotButton.disconnect('clicked()', self.onExportDotButton)
-            self.layout.removeWidget(self.exportDotButton)
-            self.exportComaButton.disconnect('clicked()', self.onExportComaButton)
-            self.layout.removeWidget(self.exportComaButton)
-            self.layout.removeItem(self.exportLayout)
-        self.logic.displayStatistics(self.ROICheckBox, self.ROIList, self.ROIDict, self.ROIComboBox,
-                                     self.tableField, self.modelList, self.tabROI, self.layout)
+            self.removeResults()
+        self.populationNode = populationNode
+        plan = self.logic.prepareStatistics(self.ROICheckBox, self.ROIList, self.ROIDict, self.ROIComboBox,
+                                            self.tableField, self.modelList)
+        self.logic.initializeTable(self.tabROI, self.layout)
+        self.logic.startStatistics(plan, self.ROIDict)
+        self.runButton.enabled = False
+        self.progressBar.setValue(0)
+        self.progressBar.setMaximum(max(1, self.logic.numberOfTasks))
+        self.progressBar.show()
+        self.cancelButton.enabled = True
+        self.cancelButton.show()
+        self.pollTimer.start()
+
+    def onPollTimer(self):
+        numberOfFinishedTasks, numberOfTasks, finishedROIs = self.logic.pollStatistics(self.ROIDict)
+        self.progressBar.setValue(numberOfFinishedTasks)
+        for ROIName in finishedROIs:
+            self.logic.refreshROITable(ROIName, self.ROIDict[ROIName])
+        if numberOfFinishedTasks == numberOfTasks:
+            self.pollTimer.stop()
+            self.onStatisticsFinished()
+
+    def onCancelButton(self):
+        self.cancelButton.enabled = False
+        self.logic.cancelStatistics()
+
+    def onStatisticsFinished(self):
+        self.progressBar.hide()
+        self.cancelButton.hide()
+        self.runButton.enabled = not self.inputComboBox.noneChecked()
+        if self.liveUpdate:  # The tables and export buttons of the Run are kept
+            self.liveUpdate = False
+            return
+        if self.logic.canceled.isSet():
+            return
+        if self.populationNode is not None:
+            self.logic.writePopulationMaps(self.populationNode.GetPolyData())
         self.layout.addLayout(self.exportLayout)
 
         self.exportDotButton.connect('clicked()', self.onExportDotButton)
         self.exportComaButton.connect('clicked()', self.onExportComaButton)
+        self.exportSQLiteButton.connect('clicked()', self.onExportSQLiteButton)
 
     def onExportDotButton(self):
         self.logic.exportationFunction(False, self.directoryExport, self.exportCheckBox, self.ROIDict)
@@ -162,44 +409,786 @@ class MeshStatsWidget(ScriptedLoadableModuleWidget):
     def onExportComaButton(self):
         self.logic.exportationFunction(True, self.directoryExport, self.exportCheckBox, self.ROIDict)
 
+    def onExportSQLiteButton(self):
+        self.logic.exportAsSQLite(os.path.join(self.directoryExport.directory, 'MeshStats.sqlite'), self.ROIDict)
+
+class QuantileSketch(object):
+    #  Mergeable quantile sketch (hierarchy of compactors, as in Manku-Rajagopalan-Lindsay and KLL)
+    #  Level h keeps values standing for 2**h input values each. When a level holds more than
+    #  capacity values, it is sorted and one value out of two is promoted to the next level.
+    #  Error bound: the rank of a percentile returned by the sketch differs from its exact rank
+    #  by at most count * numberOfCompactedLevels / capacity, i.e. at most
+    #  count * (log2(count / capacity) + 1) / capacity values (about 0.5% of the values for
+    #  capacity = 4096 and a billion values). Up to capacity values the percentiles are exact.
+    #  Memory is capacity * (number of levels) values, whatever the number of values.
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self.count = 0
+        self.levels = [numpy.empty(0)]
+        self.offsets = [0]
+
+    def update(self, valueArray):
+        valueArray = numpy.asarray(valueArray, dtype=numpy.float64).ravel()
+        self.count += valueArray.size
+        self.levels[0] = numpy.concatenate((self.levels[0], valueArray))
+        self.compress()
+
+    def merge(self, other):
+        #  Merge an other sketch (e.g. of an other shape) in this one
+        self.count += other.count
+        for level, buffer in enumerate(other.levels):
+            if level == len(self.levels):
+                self.levels.append(numpy.empty(0))
+                self.offsets.append(0)
+            self.levels[level] = numpy.concatenate((self.levels[level], buffer))
+        self.compress()
+
+    def compress(self):
+        level = 0
+        while level < len(self.levels):
+            buffer = self.levels[level]
+            if buffer.size > self.capacity:
+                buffer = numpy.sort(buffer)
+                evenSize = buffer.size - buffer.size % 2
+                #  Alternate the kept values from one compaction to the other so the errors compensate
+                promoted = buffer[self.offsets[level]:evenSize:2]
+                self.offsets[level] = 1 - self.offsets[level]
+                self.levels[level] = buffer[evenSize:]
+                if level + 1 == len(self.levels):
+                    self.levels.append(numpy.empty(0))
+                    self.offsets.append(0)
+                self.levels[level + 1] = numpy.concatenate((self.levels[level + 1], promoted))
+            level += 1
+
+    def computePercentiles(self, percentiles):
+        #  percentiles: list of percents between 0 and 100
+        #  Same definition as MeshStatsLogic.computePercentile, using the weights of the stored values
+        valueArray = numpy.concatenate(self.levels)
+        weights = numpy.concatenate([numpy.full(buffer.size, 2 ** level, dtype=numpy.int64)
+                                     for level, buffer in enumerate(self.levels)])
+        order = numpy.argsort(valueArray, kind='mergesort')
+        cumulativeWeights = numpy.cumsum(weights[order])
+        ranks = numpy.ceil(self.count * (numpy.asarray(percentiles, dtype=numpy.float64) / 100.0) - 1).astype(numpy.int64)
+        ranks[ranks < 0] += self.count
+        indexes = numpy.searchsorted(cumulativeWeights, ranks + 1)
+        return valueArray[order][indexes]
+
+
+class StreamingStatistics(object):
+    #  Bounded memory statistics of values received chunk by chunk
+    #  Mean and variance are updated with the pairwise formulas of Chan et al. (numerically stable),
+    #  percentiles come from a QuantileSketch. Two StreamingStatistics can be merged.
+    def __init__(self, capacity=4096):
+        self.count = 0
+        self.mean = 0.0
+        self.M2 = 0.0  # Sum of the squared differences to the mean
+        self.min = numpy.inf
+        self.max = -numpy.inf
+        self.sketch = QuantileSketch(capacity)
+
+    def update(self, valueArray):
+        if valueArray.size == 0:
+            return
+        chunkMean = numpy.mean(valueArray, dtype=numpy.float64)
+        chunkM2 = numpy.sum(numpy.square(valueArray - chunkMean), dtype=numpy.float64)
+        self.combine(valueArray.size, chunkMean, chunkM2, numpy.min(valueArray), numpy.max(valueArray))
+        self.sketch.update(valueArray)
+
+    def merge(self, other):
+        if other.count == 0:
+            return
+        self.combine(other.count, other.mean, other.M2, other.min, other.max)
+        self.sketch.merge(other.sketch)
+
+    def combine(self, count, mean, M2, min, max):
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / float(total)
+        self.M2 += M2 + delta * delta * self.count * count / float(total)
+        self.count = total
+        self.min = float(numpy.minimum(self.min, min))
+        self.max = float(numpy.maximum(self.max, max))
+
+
+class StatisticsCache(object):
+    #  Persistent cache of the statistics, stored in directory (one JSON file per entry)
+    #  Entries are keyed by a fingerprint of the field array, of the ROI array and of the configuration
+    #  When the directory exceeds maximumSize bytes, the least recently used entries are removed
+    #  Arrays of a shape with a version are fingerprinted by the version and a sample of their values (see
+    #  arrayFingerprint), their whole content is hashed only when fullHash is set: sampling is only safe when versions
+    #  identify the content across sessions (e.g. path, modification time and size of the file of the shape)
+    numberOfSamples = 4096
+
+    def __init__(self, directory, maximumSize=64 * 1024 * 1024, fullHash=False):
+        self.directory = directory
+        self.maximumSize = maximumSize
+        self.fullHash = fullHash
+        self.lock = threading.Lock()  # Entries are added by several tasks at the same time
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.size = sum(os.path.getsize(os.path.join(directory, filename)) for filename in self.listEntries())
+
+    def listEntries(self):
+        return [filename for filename in os.listdir(self.directory) if filename.endswith('.json')]
+
+    def arrayFingerprint(self, array, identity=None):
+        #  Fingerprint of a numpy array (None for the entire shape)
+        #  identity (name of the shape and of the array, and version of the shape) is None when the shape has no
+        #  version: the whole content is then hashed, otherwise only numberOfSamples values spread over the array are,
+        #  so that a hit costs less than computing the statistics again
+        if array is None:
+            return 'None'
+        fingerprint = hashlib.sha1(str(array.dtype) + str(array.shape))
+        if identity is None or self.fullHash:
+            fingerprint.update(numpy.ascontiguousarray(array).view(numpy.uint8))
+        else:
+            fingerprint.update(identity)
+            step = max(1, len(array) // self.numberOfSamples)
+            fingerprint.update(numpy.ascontiguousarray(array[::step]).view(numpy.uint8))
+        return fingerprint.hexdigest()
+
+    def key(self, *fingerprints):
+        return hashlib.sha1('|'.join(fingerprints)).hexdigest()
+
+    def get(self, key):
+        #  Return the values stored for key, or None
+        filename = os.path.join(self.directory, key + '.json')
+        try:
+            with open(filename, 'r') as file:
+                values = json.load(file)
+            os.utime(filename, None)  # Most recently used
+            return values
+        except (IOError, OSError, ValueError):
+            return None
+
+    def put(self, key, values):
+        filename = os.path.join(self.directory, key + '.json')
+        with open(filename, 'w') as file:
+            json.dump(values, file)
+        with self.lock:
+            self.size += os.path.getsize(filename)
+            if self.size > self.maximumSize:
+                self.evict()
+
+    def evict(self):
+        #  Remove the least recently used entries until the cache uses 3/4 of maximumSize (called with lock held)
+        #  Entries removed in the meantime (e.g. by another process sharing the directory) are skipped
+        entries = list()
+        for filename in self.listEntries():
+            path = os.path.join(self.directory, filename)
+            try:
+                status = os.stat(path)
+            except OSError:
+                continue
+            entries.append((status.st_mtime, status.st_size, path))
+        entries.sort()
+        self.size = sum(entry[1] for entry in entries)
+        for modificationTime, size, path in entries:
+            if self.size <= self.maximumSize * 3 / 4:
+                break
+            try:
+                os.remove(path)
+                self.size -= size
+            except OSError:
+                pass
+
+    def clear(self):
+        with self.lock:
+            for filename in self.listEntries():
+                os.remove(os.path.join(self.directory, filename))
+            self.size = 0
+
+
+class ArrayStore(object):
+    #  On disk copies of the arrays of the shapes (one .npy file per shape and array), read as read-only memory maps:
+    #  the system loads their pages when they are read and can drop them at any time, so a cohort does not have
+    #  to fit in memory
+    #  Arrays are stored with a version of their shape (e.g. modification time of its file): an array of another
+    #  version is not returned, and is replaced when the array is stored again
+    #  The version of each shape, its stored arrays and the index of its arrays are kept in a JSON manifest per shape,
+    #  so that storing an array does not list the directory
+    #  At most maximumResident arrays stay mapped, the least recently used ones are unmapped first
+    def __init__(self, directory, maximumResident=64):
+        self.directory = directory
+        self.maximumResident = maximumResident
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.lock = threading.Lock()
+        self.resident = collections.OrderedDict()  # Key = filename, Value = memory map
+
+    def prefix(self, shapeName, arrayName):
+        return os.path.join(self.directory, hashlib.sha1(repr((shapeName, arrayName))).hexdigest())
+
+    def versionHash(self, version):
+        return hashlib.sha1(repr(version)).hexdigest()[:16]
+
+    def filename(self, shapeName, arrayName, version, extension='.npy'):
+        return self.prefix(shapeName, arrayName) + '-' + self.versionHash(version) + extension
+
+    def get(self, shapeName, arrayName, version):
+        #  Return the memory map of the array stored for this version of the shape, or None
+        filename = self.filename(shapeName, arrayName, version)
+        with self.lock:
+            if filename in self.resident:
+                array = self.resident.pop(filename)
+            elif os.path.exists(filename):
+                try:
+                    array = numpy.load(filename, mmap_mode='r')
+                except (IOError, ValueError):
+                    return None
+            else:
+                return None
+            self.resident[filename] = array  # Most recently used
+            while len(self.resident) > self.maximumResident:
+                self.resident.popitem(last=False)
+        return array
+
+    def put(self, shapeName, arrayName, version, array):
+        #  Store array for this version of the shape, remove the arrays of its other versions and return its memory map
+        filename = self.filename(shapeName, arrayName, version)
+        temporaryFilename = filename + '.' + str(os.getpid()) + '.' + str(threading.current_thread().ident) + '.tmp'
+        with open(temporaryFilename, 'wb') as file:
+            numpy.save(file, numpy.ascontiguousarray(array))
+        os.rename(temporaryFilename, filename)  # Other processes never read a partial file
+        with self.lock:
+            manifest = self.currentManifest(shapeName, version)
+            if os.path.basename(filename) not in manifest['arrays']:
+                manifest['arrays'].append(os.path.basename(filename))
+            self.writeManifest(shapeName, manifest)
+        return self.get(shapeName, arrayName, version)
+
+    def getIndex(self, shapeName, version):
+        #  Return the index of the arrays of the shape (see MeshStatsLogic.indexPointData) stored for this version, or None
+        manifest = self.readManifest(shapeName)
+        if manifest is None or manifest['version'] != self.versionHash(version) or manifest['index'] is None:
+            return None
+        #  Names as given by VTK (utf-8 strings), values as given by indexPointData
+        return collections.OrderedDict((arrayName.encode('utf-8'), tuple(value))
+                                       for arrayName, value in manifest['index'])
+
+    def putIndex(self, shapeName, version, arrayIndex):
+        with self.lock:
+            manifest = self.currentManifest(shapeName, version)
+            manifest['index'] = arrayIndex.items()
+            self.writeManifest(shapeName, manifest)
+
+    def manifestFilename(self, shapeName):
+        return self.prefix(shapeName, '') + '.json'
+
+    def readManifest(self, shapeName):
+        #  Return {'version': hash of the version, 'arrays': files of the stored arrays, 'index': items of the index
+        #  of the arrays or None}, or None when nothing is stored for the shape
+        try:
+            with open(self.manifestFilename(shapeName), 'r') as file:
+                return json.load(file)
+        except (IOError, ValueError):
+            return None
+
+    def writeManifest(self, shapeName, manifest):
+        filename = self.manifestFilename(shapeName)
+        temporaryFilename = filename + '.' + str(os.getpid()) + '.tmp'
+        with open(temporaryFilename, 'w') as file:
+            json.dump(manifest, file)
+        os.rename(temporaryFilename, filename)
+
+    def currentManifest(self, shapeName, version):
+        #  Manifest of this version of the shape: the arrays of another version are removed (called with the lock)
+        manifest = self.readManifest(shapeName)
+        versionHash = self.versionHash(version)
+        if manifest is not None and manifest['version'] == versionHash:
+            return manifest
+        if manifest is not None:
+            for filename in manifest['arrays']:
+                path = os.path.join(self.directory, filename)
+                self.resident.pop(path, None)
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        return {'version': versionHash, 'arrays': list(), 'index': None}
+
+    def clear(self):
+        with self.lock:
+            self.resident.clear()
+        for filename in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, filename))
+
+
+class StatisticsDatabase(object):
+    #  SQLite database of statistics in long format: one row per shape, ROI, field and statistic (as named in
+    #  the CSV header, e.g. "Mean" or "95th centile"), with the run which computed it
+    #  Statistics of a shape, ROI and field exported again replace all the previous ones (including bins of
+    #  histograms with other edges), so cohorts can be exported incrementally; each export is a run, whose date and
+    #  configuration are kept in the runs table
+    #  Example of query: SELECT shape, value FROM statistics WHERE roi = 'Entire Shape' AND statistic = 'Mean'
+    def __init__(self, filename):
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS runs ("
+                                    "run_id INTEGER PRIMARY KEY, created TEXT NOT NULL, configuration TEXT)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS statistics ("
+                                    "shape TEXT NOT NULL, roi TEXT NOT NULL, field TEXT NOT NULL, "
+                                    "statistic TEXT NOT NULL, value REAL, "
+                                    "run_id INTEGER NOT NULL REFERENCES runs (run_id), "
+                                    "PRIMARY KEY (shape, roi, field, statistic))")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS statisticsByField "
+                                    "ON statistics (field, roi, statistic)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS statisticsByRun ON statistics (run_id)")
+
+    def addRun(self, configuration):
+        #  configuration is a dictionary stored as JSON, return the identifier of the new run
+        with self.connection:
+            cursor = self.connection.execute("INSERT INTO runs (created, configuration) VALUES (?, ?)",
+                                             (time.strftime('%Y-%m-%dT%H:%M:%S'), json.dumps(configuration)))
+        return cursor.lastrowid
+
+    def write(self, runID, records, entries=None):
+        #  records is an iterable of (shape, ROI, field, statistic, value), inserted in a single transaction
+        #  Statistics stored before for the (shape, ROI, field) of entries (by default the ones of records, entries
+        #  also give the ones without any record left, e.g. of an empty ROI) are removed first
+        #  Return the number of records written
+        if entries is None:
+            records = list(records)
+            entries = set(record[:3] for record in records)
+        with self.connection:
+            self.connection.executemany("DELETE FROM statistics WHERE shape = ? AND roi = ? AND field = ?", entries)
+            cursor = self.connection.executemany(
+                "INSERT OR REPLACE INTO statistics (shape, roi, field, statistic, value, run_id) "
+                "VALUES (?, ?, ?, ?, ?, ?)", (record + (runID,) for record in records))
+        return cursor.rowcount
+
+    def close(self):
+        self.connection.close()
+
+
+class StageMeasure(object):
+    #  Measure of one call of a stage, see StageProfiler.measure
+    def __init__(self, profiler, key):
+        self.profiler = profiler
+        self.key = key
+        self.elements = 0
+        self.bytes = 0
+
+    def __enter__(self):
+        self.startTime = time.time()
+        return self
+
+    def __exit__(self, exceptionType, exceptionValue, traceback):
+        self.profiler.record(self.key, time.time() - self.startTime, self.elements, self.bytes)
+        return False
+
+    def count(self, elements, bytes=0):
+        #  elements can be a numpy array: its number of values and its size in bytes are counted
+        if isinstance(elements, numpy.ndarray):
+            elements, bytes = elements.size, elements.nbytes
+        self.elements += elements
+        self.bytes += bytes
+
+
+class NullMeasure(object):
+    #  Measure used when profiling is disabled: does nothing
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exceptionType, exceptionValue, traceback):
+        return False
+
+    def count(self, elements, bytes=0):
+        pass
+
+nullMeasure = NullMeasure()
+
+
+class StageProfiler(object):
+    #  Instrumentation of the stages of MeshStatsLogic (see MeshStatsLogic.enableProfiling)
+    #  For each stage and each (shape, field, ROI) it is called on: number of calls, wall time,
+    #  number of elements processed and bytes allocated (arrays created or files written)
+    #  Labels which do not apply are None (e.g. shape for the statistics of batched shapes)
+    #  Stages can be nested (e.g. computeAll calls defineArray): their times are not exclusive
+    def __init__(self):
+        self.lock = threading.Lock()  # Stages can be measured from the threads of startStatistics
+        self.records = collections.OrderedDict()  # Key = (stage, shape, field, ROI), Value = [calls, seconds, elements, bytes]
+
+    def measure(self, stage, shape=None, field=None, ROI=None):
+        #  Context manager measuring a call of stage, whose count method adds elements processed by the call
+        return StageMeasure(self, (stage, shape, field, ROI))
+
+    def record(self, key, seconds, elements, bytes):
+        with self.lock:
+            values = self.records.setdefault(key, [0, 0.0, 0, 0])
+            values[0] += 1
+            values[1] += seconds
+            values[2] += elements
+            values[3] += bytes
+
+    def clear(self):
+        with self.lock:
+            self.records = collections.OrderedDict()
+
+    def query(self, stage=None, shape=None, field=None, ROI=None):
+        #  Records matching the labels given (all the records by default), as a list of dictionaries
+        with self.lock:
+            items = self.records.items()
+        result = list()
+        for key, (calls, seconds, elements, bytes) in items:
+            if all(label is None or label == value for label, value in zip((stage, shape, field, ROI), key)):
+                result.append(collections.OrderedDict([('stage', key[0]), ('shape', key[1]), ('field', key[2]),
+                                                       ('ROI', key[3]), ('calls', calls), ('seconds', seconds),
+                                                       ('elements', elements), ('bytes', bytes)]))
+        return result
+
+    def summary(self):
+        #  Totals per stage: Key = stage, Value = dictionary of calls, seconds, elements and bytes
+        summary = collections.OrderedDict()
+        for record in self.query():
+            totals = summary.setdefault(record['stage'], collections.OrderedDict(
+                [('calls', 0), ('seconds', 0.0), ('elements', 0), ('bytes', 0)]))
+            for name in totals:
+                totals[name] += record[name]
+        return summary
+
+    def report(self):
+        #  Text table of the totals per stage, e.g. print logic.profiler.report()
+        lines = ['%-20s %8s %12s %14s %14s' % ('Stage', 'Calls', 'Seconds', 'Elements', 'Bytes')]
+        for stage, totals in self.summary().iteritems():
+            lines.append('%-20s %8d %12.4f %14d %14d' % (stage, totals['calls'], totals['seconds'],
+                                                         totals['elements'], totals['bytes']))
+        return '\n'.join(lines)
+
+    def dump(self, filename):
+        with open(filename, 'w') as file:
+            json.dump({'summary': self.summary(), 'records': self.query()}, file, indent=2)
+
+
+class StatisticsTableModel(qt.QAbstractTableModel if qt else object):
+    #  Table model of rows of statistics (see MeshStatsLogic.statisticsRow)
+    #  Cells are only read when they are drawn and sorting reorders the list of rows
+    def __init__(self, header, rows):
+        qt.QAbstractTableModel.__init__(self)
+        self.header = header
+        self.rows = rows
+
+    def rowCount(self, parent):
+        return len(self.rows)
+
+    def columnCount(self, parent):
+        return len(self.header)
+
+    def data(self, index, role):
+        if role == qt.Qt.DisplayRole and index.isValid():
+            value = self.rows[index.row()][index.column()]
+            return value if value == value else None  # NaN: not computed
+        return None
+
+    def headerData(self, section, orientation, role):
+        if role == qt.Qt.DisplayRole and orientation == qt.Qt.Horizontal:
+            return self.header[section]
+        return None
+
+    def sort(self, column, order):
+        if column < 0:
+            return
+        self.layoutAboutToBeChanged()
+        self.rows.sort(key=lambda row: row[column], reverse=(order == qt.Qt.DescendingOrder))
+        self.layoutChanged()
+
+    def updateRows(self, rows):
+        #  Replace the rows of the same shapes (first column), keeping their order: only the rows which changed
+        #  are redrawn, unless shapes were added (at the end) or removed
+        indexes = dict((row[0], index) for index, row in enumerate(self.rows))
+        shapeNames = set(row[0] for row in rows)
+        if shapeNames != set(indexes):
+            self.layoutAboutToBeChanged()
+            newRows = dict((row[0], row) for row in rows)
+            self.rows[:] = [newRows[row[0]] for row in self.rows if row[0] in newRows] + \
+                           [row for row in rows if row[0] not in indexes]
+            self.layoutChanged()
+            return
+        for row in rows:
+            index = indexes[row[0]]
+            if self.rows[index] != row:
+                self.rows[index] = row
+                self.dataChanged(self.index(index, 0), self.index(index, len(self.header) - 1))
+
+
 class MeshStatsLogic (ScriptedLoadableModuleLogic):
     class StatisticStore(object):
-        def __init__(self):
-            self.min = 0
-            self.max = 0
-            self.mean = 0
-            self.std = 0
-            self.percentile5 = 0
-            self.percentile15 = 0
-            self.percentile25 = 0
-            self.percentile50 = 0
-            self.percentile75 = 0
-            self.percentile85 = 0
-            self.percentile95 = 0
+        #  Statistics which are not computed (e.g. on a ROI without any vertex) stay NaN: they are shown and exported as
+        #  empty cells, and are not added to the SQLite databases
+        def __init__(self, percentiles=(5, 15, 25, 50, 75, 85, 95)):
+            self.min = numpy.nan
+            self.max = numpy.nan
+            self.mean = numpy.nan
+            self.std = numpy.nan
+            #  Key = percent (between 0 and 100), Value = percentile
+            self.percentiles = collections.OrderedDict((percent, numpy.nan) for percent in percentiles)
+            #  Bootstrap confidence intervals (see MeshStatsLogic.computeBootstrapIntervals), empty when not computed
+            #  Key = 'Mean' or percent, Value = (lower bound, upper bound)
+            self.confidence = None
+            self.intervals = collections.OrderedDict()
+            #  Histogram: edges of the bins shared by the shapes (None when not computed) and count of each bin
+            self.histogramEdges = None
+            self.histogram = None
+
+        def __getattr__(self, name):
+            #  Keep percentile5, percentile15, ... available as attributes
+            if name.startswith('percentile') and name != 'percentiles':
+                try:
+                    return self.percentiles[float(name[len('percentile'):])]
+                except (ValueError, KeyError):
+                    pass
+            raise AttributeError(name)
+
+    class ShapePlan(object):
+        #  Arrays of one shape needed by a Run, extracted once from its point data
+        def __init__(self, name, polyData, version):
+            self.name = name
+            self.version = version  # Version of the shape (see planRun), None when it has none
+            self.polyData = polyData  # None when all the arrays are read from the ArrayStore
+            self.numberOfPoints = polyData.GetNumberOfPoints() if polyData is not None else 0
+            self.fieldArrays = collections.OrderedDict()  # Key = Name of Field, Value = numpy view of the field array
+            self.ROIArrays = collections.OrderedDict()  # Key = Name of ROI, Value = numpy view of the ROI array
+                                                        #                     (None for 'Entire Shape')
+                                                        # Arrays are memory maps when the ArrayStore is used
+            #  Arrays which have to be computed (e.g. neighborhood fields) or copied to the ArrayStore are planned as
+            #  functions returning them, called by the first task which needs them (see fieldArray and ROIArray), not by
+            #  the GUI thread; polyData is then never None
+            self.lock = threading.Lock()
+            self.fingerprints = dict()  # Key = Name of Field or ROI, Value = fingerprint used by the cache
+            self.ranges = dict()  # Key = Name of Field, Value = (minimum, maximum) or None (see fieldRange)
+            self.rangeLock = threading.Lock()
+
+        def fieldArray(self, fieldName):
+            return self.resolveArray(self.fieldArrays, fieldName)
+
+        def ROIArray(self, ROIName):
+            return self.resolveArray(self.ROIArrays, ROIName)
+
+        def fieldRange(self, fieldName, computeRange):
+            #  Range of a field returned by computeRange(array), computed once by the first task which needs it
+            with self.rangeLock:
+                if fieldName not in self.ranges:
+                    self.ranges[fieldName] = computeRange(self.fieldArray(fieldName))
+            return self.ranges[fieldName]
+
+        def resolveArray(self, arrays, arrayName):
+            array = arrays[arrayName]
+            if callable(array):
+                with self.lock:  # Tasks of other ROIs of the shape wait for the same array instead of computing it again
+                    array = arrays[arrayName]
+                    if callable(array):
+                        array = arrays[arrayName] = array()
+            return array
 
     def __init__(self):
         self.numberOfDecimals = 3
+        self.percentiles = [5, 15, 25, 50, 75, 85, 95]
+        #  Streaming mode: arrays are read by chunks of streamingChunkSize values and percentiles are
+        #  approximated with a QuantileSketch of sketchCapacity values (see QuantileSketch for the error bound)
+        self.streaming = False
+        self.streamingChunkSize = 65536
+        self.sketchCapacity = 4096
+        #  In streaming mode, pooled statistics of all the shapes of a Run are added to each ROI and field as a row
+        #  named cohortName, merged from the sketches of the shapes as soon as their task is done
+        #  (see mergeCohortStatistics)
+        self.computeCohortStatistics = True
+        self.cohortName = 'Cohort'
+        self.cohortStatistics = None  # Key = (Name of ROI, Name of Field), Value = StreamingStatistics of the Run
+        #  StatisticsCache used to skip the computation of unchanged shapes (None to disable)
+        self.cache = None
+        #  ArrayStore from which the arrays are read (None to read them from the point data)
+        #  Matrices of batched shapes built from the store are computed by blocks of storeMemoryBudget bytes
+        self.arrayStore = None
+        self.storeMemoryBudget = 256 * 1024 * 1024
+        #  Key = ID of model, Value = (point data, its modification time, index of its arrays)
+        self.arrayIndex = dict()
+        #  Statistics of corresponded shapes (same number of points) are computed as a matrix
+        self.batchCorrespondedShapes = True
+        #  Per vertex statistics of the population, computed when shapes are corresponded
+        #  Key = Name of Field, Value = OrderedDict (see computePopulationStatistics)
+        self.computePopulationMaps = False
+        self.populationMaps = collections.OrderedDict()
+        #  Area weighted mode: each vertex is weighted by its share of the area of the surface
+        #  (not used in streaming mode)
+        self.areaWeighted = False
+        #  Key = polydata, Value = (modification time of its points and polygons, area of each vertex)
+        self.vertexAreas = dict()
+        #  Neighborhood fields, computed as fields of their own from each field (see computeNeighborhoodFields):
+        #  the field smoothed over smoothingRings rings, and its local mean and SD over localRings rings (0 to disable)
+        self.smoothingRings = 0
+        self.localRings = 0
+        #  Neighborhood fields of the last plan: Key = Name of neighborhood field, Value = (Name of Field, kind)
+        self.derivedFields = collections.OrderedDict()
+        #  Key = polydata, Value = (modification time of its polygons, vertex adjacency) (see computeAdjacency)
+        self.adjacencies = dict()
+        #  Fingerprints of the arrays (see getFingerprint), computed once per version of the shapes given to planRun
+        #  Key = (Name of shape, Name of array, version of the shape), Value = fingerprint
+        self.sessionFingerprints = dict()
+        self.batched = False
+        #  Background computation (see startStatistics)
+        self.canceled = threading.Event()
+        self.threadPool = None
+        self.pendingResults = list()
+        self.numberOfTasks = 0
+        self.runningPlan = None
+        self.tableModels = list()
+        self.pendingTables = list()
+        #  StageProfiler measuring the stages of the Runs (None when profiling is disabled)
+        self.profiler = None
+        #  Label arrays of the last plan: Key = Name of label array, Value = list of the ROIs of its labels found by
+        #  the tasks so far, sorted by label (see addLabelROI)
+        self.labelArrays = collections.OrderedDict()
+        self.labelFields = collections.OrderedDict()  # Key = Name of label array, Value = list of fields
+        self.ROILabels = dict()  # Key = Name of the ROI of a label, Value = label
+        #  Bootstrap confidence intervals of the mean and of the percentiles (0 resamples to disable),
+        #  not computed in streaming and area weighted modes
+        self.bootstrapResamples = 0
+        self.bootstrapConfidence = 95
+        self.bootstrapSeed = 0
+        self.bootstrapMemoryBudget = 8 * 1024 * 1024  # Bytes of the resamples drawn at once by all the threads
+        self.bootstrapSliceSize = 1 << 16  # Indexes drawn at once by a thread (see computeBootstrapIntervals)
+        self.bootstrapThreads = None  # Threads drawing the slices (None for the number of processors)
+        self.bootstrapPool = None  # None when the slices are drawn by the thread computing the statistics
+        self.bootstrapSlices = None  # Semaphore of the slices drawn at once, within bootstrapMemoryBudget
+        self.bootstrapSettings = None  # (threads, memory budget, slice size) of bootstrapPool and bootstrapSlices
+        self.bootstrapLock = threading.Lock()
+        #  Histograms of histogramBins bins (0 to disable), with the same edges for all the shapes and ROIs of a field:
+        #  histogramRange = (low, high), or None for the range of the field over all the shapes of the Run
+        self.histogramBins = 0
+        self.histogramRange = None
+        self.histogramEdges = dict()  # Key = Name of Field, Value = edges of the bins in the last plan
+        self.histogramPlan = None  # Plan whose ranges give the edges, until it is computed (see getHistogramEdges)
+        #  Live mode (see planLiveStatistics): versions of the statistics computed
+        #  Key = (Name of shape, Name of Field, Name of ROI or of label array), Value = version (see entryVersion)
+        self.entryVersions = dict()
+        self.ROITabs = dict()  # Key = Name of ROI, Value = its list of pending tables (see addROITable)
+        self.statisticsModels = dict()  # Key = (Name of ROI, Name of Field), Value = StatisticsTableModel shown
+
+    def reset(self):
+        #  Forget everything about the shapes of the last scene (run when the scene is closed): running tasks are
+        #  canceled, indexes of arrays, areas, maps and tables are cleared; the cache and the array store are
+        #  created again by the next Run
+        if self.threadPool is not None:
+            self.cancelStatistics()
+            self.threadPool.join()  # Tasks stop at their next field
+            self.threadPool = None
+        if self.bootstrapPool is not None:
+            self.bootstrapPool.close()
+            self.bootstrapPool.join()
+            self.bootstrapPool = None
+        self.bootstrapSettings = None
+        self.canceled.clear()
+        self.pendingResults = list()
+        self.numberOfTasks = 0
+        self.runningPlan = None
+        self.arrayIndex = dict()
+        self.vertexAreas = dict()
+        self.adjacencies = dict()
+        self.sessionFingerprints = dict()
+        self.derivedFields = collections.OrderedDict()
+        self.populationMaps = collections.OrderedDict()
+        self.cohortStatistics = None
+        self.labelArrays = collections.OrderedDict()
+        self.labelFields = collections.OrderedDict()
+        self.ROILabels = dict()
+        self.histogramEdges = dict()
+        self.histogramPlan = None
+        self.entryVersions = dict()
+        self.tableModels = list()
+        self.pendingTables = list()
+        self.ROITabs = dict()
+        self.statisticsModels = dict()
+        self.batched = False
+        self.cache = None
+        self.arrayStore = None
+
+    def enableProfiling(self, enabled=True):
+        #  From the Python console, e.g.:
+        #      logic = slicer.modules.meshstats.widgetRepresentation().self().logic
+        #      logic.enableProfiling()
+        #      (Run)
+        #      print logic.profiler.report()
+        #      logic.profiler.dump('/tmp/MeshStatsProfile.json')
+        self.profiler = StageProfiler() if enabled else None
+        return self.profiler
+
+    def measure(self, stage, shape=None, field=None, ROI=None):
+        #  Context manager measuring a stage with the profiler, does nothing when profiling is disabled
+        if self.profiler is None:
+            return nullMeasure
+        return self.profiler.measure(stage, shape, field, ROI)
+
+    def setPercentiles(self, percentiles):
+        #  percentiles is a list of percents (values in ]0, 100]) computed on each shape
+        percentiles = sorted(set(float(percent) for percent in percentiles))
+        for percent in percentiles:
+            if percent <= 0 or percent > 100:
+                raise ValueError("Percentile " + str(percent) + " is not in ]0, 100]")
+        self.percentiles = [int(percent) if percent.is_integer() else percent for percent in percentiles]
+
+    def parsePercentiles(self, text):
+        #  text is a list of percents separated by commas or spaces, e.g. "1, 5, 50, 95, 99"
+        self.setPercentiles([value for value in re.split(r"[,;\s]+", text.strip()) if value])
+
+    def centileLabel(self, percent):
+        #  Label of a percentile as it appears in the tables and in the CSV files, e.g. "95th centile"
+        percent = '%g' % percent
+        suffix = 'th'
+        if not percent.endswith(('11', '12', '13')):
+            suffix = {'1': 'st', '2': 'nd', '3': 'rd'}.get(percent[-1], 'th')
+        return percent + suffix + ' centile'
+
+    def getPercentiles(self, shapeDict):
+        #  Percentiles stored for the shapes of shapeDict (dictionary of StatisticStore)
+        for shapeStats in shapeDict.itervalues():
+            return shapeStats.percentiles.keys()
+        return self.percentiles
+
+    def getConfidence(self, shapeDict):
+        #  Confidence (in percent) of the intervals stored for the shapes of shapeDict, None without intervals
+        for shapeStats in shapeDict.itervalues():
+            if shapeStats.intervals:
+                return shapeStats.confidence
+        return None
+
+    def statisticsHeader(self, percentiles, confidence=None):
+        #  With a confidence, columns of the lower and upper bounds of the mean and of each percentile are added
+        header = ['Shape', 'Min', 'Max', 'Mean', 'SD'] + [self.centileLabel(percent) for percent in percentiles]
+        if confidence is not None:
+            for label in ['Mean'] + [self.centileLabel(percent) for percent in percentiles]:
+                header += [label + ' %g%% CI low' % confidence, label + ' %g%% CI high' % confidence]
+        return header
+
+    def statisticsRow(self, shapeName, shapeStats):
+        row = [shapeName, shapeStats.min, shapeStats.max, shapeStats.mean, shapeStats.std] + shapeStats.percentiles.values()
+        for interval in shapeStats.intervals.itervalues():
+            row += list(interval)
+        return row
 
     def updateInterface(self, tableField, ROIComboBox, ROIList, modelList, layout):
+        with self.measure('updateInterface') as measure:
+            self.fillInterface(tableField, ROIComboBox, ROIList, modelList, layout)
+            measure.count(tableField.rowCount + len(ROIList))
+
+    def fillInterface(self, tableField, ROIComboBox, ROIList, modelList, layout):
         tableField.clearContents()
         tableField.setRowCount(0)
         ROIComboBox.clear()
         ROIComboBox.addItem('Entire Shape')
         del ROIList[:]
         ROIList.append('Entire Shape')
-        fieldList = list()
-        del fieldList[:]
         tableFieldNumRows = 0
-        expression = r"ROI$"
+        #  ROI arrays end with ROI, label arrays (one ROI per label) end with Labels
+        expression = r"(ROI|Labels)$"
         if modelList:
-            pointData = modelList[0].GetModelDisplayNode().GetInputPolyData().GetPointData()
-            numOfArray = pointData.GetNumberOfArrays()
-            for i in range(0, numOfArray):
-                fieldList.append(pointData.GetArray(i).GetName())
-            for arrayName in fieldList:
-                bool = self.compareArray(modelList, arrayName)
-                if bool:
-                    if pointData.GetArray(arrayName).GetNumberOfComponents() == 1:
+            arrayIndexes = self.updateArrayIndex(modelList)
+            commonArrays = set(arrayIndexes[0])
+            for arrayIndex in arrayIndexes[1:]:
+                commonArrays.intersection_update(arrayIndex)
+            for arrayName, (numberOfComponents, dataType) in arrayIndexes[0].iteritems():
+                if arrayName in commonArrays:
+                    if numberOfComponents == 1:
                         if not re.search(expression, arrayName):
                             tableFieldNumRows += 1
                             tableField.setRowCount(tableFieldNumRows)
@@ -208,56 +1197,114 @@ class MeshStatsLogic (ScriptedLoadableModuleLogic):
                         else:
                             ROIComboBox.addItem(arrayName)
                             ROIList.append(arrayName)
-        layout.addStretch(1)
 
-    def compareArray(self, modelList, arrayName):
-        listBool = list()
+    def indexPointData(self, pointData):
+        #  Key = Name of array, Value = (number of components, VTK data type)
+        arrayIndex = collections.OrderedDict()
+        for i in range(0, pointData.GetNumberOfArrays()):
+            array = pointData.GetArray(i)
+            if array is not None:
+                arrayIndex[array.GetName()] = (array.GetNumberOfComponents(), array.GetDataType())
+        return arrayIndex
+
+    def updateArrayIndex(self, modelList):
+        #  Index again only the models that were not indexed yet or whose point data changed,
+        #  forget the models which are not in modelList anymore
+        #  Return the list of the array indexes of modelList
+        previousIndex = self.arrayIndex
+        self.arrayIndex = dict()
+        arrayIndexes = list()
         for model in modelList:
             pointData = model.GetModelDisplayNode().GetInputPolyData().GetPointData()
-            listBool.append(pointData.HasArray(arrayName))
-        for bool in listBool:
-            if bool == 0:
-                return False
-        return True
+            entry = previousIndex.get(model.GetID())
+            if entry is None or entry[0] is not pointData or entry[1] != pointData.GetMTime():
+                entry = (pointData, pointData.GetMTime(), self.indexPointData(pointData))
+            self.arrayIndex[model.GetID()] = entry
+            arrayIndexes.append(entry[2])
+        return arrayIndexes
 
     def defineStatisticsTable(self, fieldDictionaryValue):
-        statTable = qt.QTableWidget()
+        #  The table view shows the statistics through a StatisticsTableModel: no widget is created per cell
+        statTable = qt.QTableView()
         statTable.setMinimumHeight(200)
-        statTable.setColumnCount(12)
-        statTable.setHorizontalHeaderLabels(['Shape','Min','Max','Mean','SD','5th centile','15th centile','25th centile','50th centile','75th centile','85th centile','95th centile'])
-        # Add Values:
-        numberOfRows = fieldDictionaryValue.__len__()
-        statTable.setRowCount(numberOfRows)
-        i = numberOfRows - 1
-        for key, value in fieldDictionaryValue.iteritems():
-            statTable.setCellWidget(i, 0, qt.QLabel(key))
-            statTable.setCellWidget(i, 1, qt.QLabel(value.min))
-            statTable.setCellWidget(i, 2, qt.QLabel(value.max))
-            statTable.setCellWidget(i, 3, qt.QLabel(value.mean))
-            statTable.setCellWidget(i, 4, qt.QLabel(value.std))
-            statTable.setCellWidget(i, 5, qt.QLabel(value.percentile5))
-            statTable.setCellWidget(i, 6, qt.QLabel(value.percentile15))
-            statTable.setCellWidget(i, 7, qt.QLabel(value.percentile25))
-            statTable.setCellWidget(i, 8, qt.QLabel(value.percentile50))
-            statTable.setCellWidget(i, 9, qt.QLabel(value.percentile75))
-            statTable.setCellWidget(i, 10, qt.QLabel(value.percentile85))
-            statTable.setCellWidget(i, 11, qt.QLabel(value.percentile95))
-            i -= 1
+        rows = [self.statisticsRow(key, value) for key, value in fieldDictionaryValue.iteritems()]
+        model = StatisticsTableModel(self.statisticsHeader(self.getPercentiles(fieldDictionaryValue),
+                                                           self.getConfidence(fieldDictionaryValue)), rows)
+        statTable.setModel(model)
+        statTable.setSortingEnabled(True)
+        statTable.sortByColumn(0, qt.Qt.AscendingOrder)
         statTable.resizeColumnToContents(0)
+        self.tableModels.append(model)  # Models are not owned by the views
         return statTable
 
     def updateTable(self, ROIDict, tabROI, layout):
+        self.initializeTable(tabROI, layout)
         for ROIName, FieldDict in ROIDict.iteritems():
+            self.addROITable(ROIName, FieldDict)
+
+    def initializeTable(self, tabROI, layout):
+        #  Tabs are created empty, each table is defined the first time its tab is shown
+        self.tableModels = list()
+        self.pendingTables = list()  # One list per ROI tab, of [field tab, ROI, field, dictionary of shapes]
+                                     # (None once shown)
+        self.ROITabs = dict()
+        self.statisticsModels = dict()
+        tabROI.connect('currentChanged(int)', self.onTabROICurrentChanged)
+        self.tabROI = tabROI
+        layout.addWidget(tabROI)
+
+    def addROITable(self, ROIName, FieldDict):
+        with self.measure('updateTable', ROI=ROIName) as measure:
             tab = qt.QTabWidget()
             tab.adjustSize()
             tab.setTabPosition(0)
+            pendingTables = list()
             for fieldName, fieldDictValue in FieldDict.iteritems():
-                statisticsTable = self.defineStatisticsTable(fieldDictValue)
-                tab.addTab(statisticsTable, fieldName)
-            tabROI.addTab(tab, ROIName)
-        layout.addWidget(tabROI)
+                fieldTab = qt.QWidget()
+                fieldTab.setLayout(qt.QVBoxLayout())
+                fieldTab.layout().setContentsMargins(0, 0, 0, 0)
+                tab.addTab(fieldTab, fieldName)
+                pendingTables.append([fieldTab, ROIName, fieldName, fieldDictValue])
+            tab.connect('currentChanged(int)', lambda index, pendingTables=pendingTables: self.showTable(pendingTables, index))
+            self.pendingTables.append(pendingTables)
+            self.ROITabs[ROIName] = pendingTables
+            measure.count(len(FieldDict))
+        self.tabROI.addTab(tab, ROIName)
+        self.onTabROICurrentChanged(self.tabROI.currentIndex)
+
+    def onTabROICurrentChanged(self, index):
+        if 0 <= index < len(self.pendingTables):
+            self.showTable(self.pendingTables[index], self.tabROI.widget(index).currentIndex)
+
+    def showTable(self, pendingTables, index):
+        if 0 <= index < len(pendingTables) and pendingTables[index] is not None:
+            fieldTab, ROIName, fieldName, fieldDictValue = pendingTables[index]
+            pendingTables[index] = None
+            with self.measure('updateTable', field=fieldName, ROI=ROIName) as measure:
+                fieldTab.layout().addWidget(self.defineStatisticsTable(fieldDictValue))
+                self.statisticsModels[(ROIName, fieldName)] = self.tableModels[-1]
+                measure.count(len(fieldDictValue))
+
+    def refreshROITable(self, ROIName, FieldDict):
+        #  Show the statistics of FieldDict in the tab of ROIName: the rows of its tables already shown are patched
+        #  (see StatisticsTableModel.updateRows), the other tables are defined from FieldDict when shown
+        if ROIName not in self.ROITabs:
+            self.addROITable(ROIName, FieldDict)
+            return
+        for fieldName, fieldDictValue in FieldDict.iteritems():
+            model = self.statisticsModels.get((ROIName, fieldName))
+            if model is not None:
+                with self.measure('updateTable', field=fieldName, ROI=ROIName) as measure:
+                    model.updateRows([self.statisticsRow(key, value) for key, value in fieldDictValue.iteritems()])
+                    measure.count(len(fieldDictValue))
 
     def displayStatistics(self, ROICheckBox, ROIList, ROIDict, ROIComboBox, tableField, modelList, tabROI, layout):
+        plan = self.prepareStatistics(ROICheckBox, ROIList, ROIDict, ROIComboBox, tableField, modelList)
+        self.executePlan(plan, ROIDict)
+        self.updateTable(ROIDict, tabROI, layout)
+
+    def prepareStatistics(self, ROICheckBox, ROIList, ROIDict, ROIComboBox, tableField, modelList):
+        #  Fill ROIDict with the ROIs and fields chosen in the interface and return the plan of the Run
         if ROICheckBox.isChecked():
                 for ROIName in ROIList:
                     if not ROIDict.has_key(ROIName):
@@ -272,54 +1319,746 @@ class MeshStatsLogic (ScriptedLoadableModuleLogic):
                 widget = tableField.cellWidget(i, 0)
                 if widget.isChecked():
                     ROIFieldDict[tableField.cellWidget(i, 1).text] = dict()
-            for fieldName, fieldValue in ROIFieldDict.iteritems():
-                for shape in modelList:
-                    activePointData = shape.GetModelDisplayNode().GetInputPolyData().GetPointData()
-                    fieldArray = activePointData.GetArray(fieldName)
-                    fieldValue[shape.GetName()] = self.StatisticStore()
-                    if ROIName == 'Entire Shape':
-                        self.computeAll(fieldArray, fieldValue[shape.GetName()], 'None')
-                    else:
-                        ROIArray = activePointData.GetArray(ROIName)
-                        self.computeAll(fieldArray, fieldValue[shape.GetName()], ROIArray)
-        self.updateTable(ROIDict, tabROI, layout)
+        shapes = self.modelShapes(modelList)
+        plan = self.planRun(shapes, ROIDict)
+        self.entryVersions = dict()
+        self.recordVersions(shapes, self.runSelection(ROIDict))
+        return plan
+
+    def modelShapes(self, modelList):
+        #  (name of shape, polydata, version of the shape) of each model of modelList
+        shapes = list()
+        for shape in modelList:
+            polyData = shape.GetModelDisplayNode().GetInputPolyData()
+            #  The points and the polygons are part of the version: vertex areas and neighborhood fields depend on them
+            version = (polyData.GetPointData().GetMTime(), polyData.GetPoints().GetMTime(),
+                       polyData.GetPolys().GetMTime(), polyData.GetStrips().GetMTime())
+            shapes.append((shape.GetName(), polyData, version))
+        return shapes
+
+    def planRun(self, shapes, ROIDict):
+        #  shapes is a list of (name of shape, polydata) or (name of shape, polydata, version of the shape)
+        #  Gather once per shape every field and ROI array needed to fill ROIDict
+        #  Arrays are numpy views on the VTK buffers: nothing is copied or computed here
+        #  With the ArrayStore, arrays of shapes given with a version are memory maps of the store (see extractArray)
+        #  Neighborhood fields of the fields of ROIDict are added to ROIDict (see addDerivedFields)
+        self.addDerivedFields(ROIDict)
+        self.releaseShapes(shapes)
+        fieldNames = list()
+        for ROIFieldDict in ROIDict.itervalues():
+            for fieldName in ROIFieldDict:
+                if fieldName not in fieldNames:
+                    fieldNames.append(fieldName)
+        plan = list()
+        for shape in shapes:
+            shapeName, polyData = shape[:2]
+            version = shape[2] if len(shape) > 2 else None
+            plan.append(self.planShape(shapeName, polyData, version, fieldNames, ROIDict.keys()))
+        self.expandLabelArrays(ROIDict)
+        return plan
+
+    def releaseShapes(self, shapes):
+        #  Forget what was computed for the shapes which are not in shapes (see planRun), or for their former versions:
+        #  areas and adjacencies are keyed by polydata, which they would keep alive after their models are removed
+        currentVersions = set((shape[0], shape[2] if len(shape) > 2 else None) for shape in shapes)
+        for key in [key for key in self.sessionFingerprints if (key[0], key[2]) not in currentVersions]:
+            del self.sessionFingerprints[key]
+        polyDatas = set(shape[1] for shape in shapes)
+        for polyData in [polyData for polyData in self.vertexAreas if polyData not in polyDatas]:
+            del self.vertexAreas[polyData]
+        for polyData in [polyData for polyData in self.adjacencies if polyData not in polyDatas]:
+            del self.adjacencies[polyData]
+
+    def planShape(self, shapeName, polyData, version, fieldNames, ROINames):
+        #  ShapePlan of the fields fieldNames and of the ROIs ROINames of one shape
+        shapePlan = self.ShapePlan(shapeName, polyData, version)
+        neighborhoodFields = dict()  # Neighborhood fields computed for this shape (see computeDerivedArray)
+        for fieldName in fieldNames:
+            if fieldName in self.derivedFields:
+                shapePlan.fieldArrays[fieldName] = self.extractDerivedArray(shapeName, polyData, fieldName, version,
+                                                                            neighborhoodFields)
+            else:
+                shapePlan.fieldArrays[fieldName] = self.extractArray(shapeName, polyData, fieldName, version)
+        for ROIName in ROINames:
+            if ROIName == 'Entire Shape':
+                shapePlan.ROIArrays[ROIName] = None
+            else:
+                shapePlan.ROIArrays[ROIName] = self.extractArray(shapeName, polyData, ROIName, version)
+        if polyData is None and shapePlan.fieldArrays:
+            shapePlan.numberOfPoints = len(shapePlan.fieldArrays.values()[0])
+        return shapePlan
+
+    def entryVersion(self, polyData, fieldName, ROIName):
+        #  Version of the statistics of a field on a ROI (or label array) of a shape: modification times of the arrays
+        #  they are computed from, and of the surface in area weighted mode (None when an array is missing)
+        #  Neighborhood fields also depend on the polygons
+        pointData = polyData.GetPointData()
+        arrays = [pointData.GetArray(self.derivedFields.get(fieldName, (fieldName,))[0])]
+        if ROIName != 'Entire Shape':
+            arrays.append(pointData.GetArray(ROIName))
+        if any(array is None for array in arrays):
+            return None
+        version = tuple(array.GetMTime() for array in arrays)
+        if self.areaWeighted:
+            version += (polyData.GetPoints().GetMTime(), polyData.GetPolys().GetMTime())
+        if fieldName in self.derivedFields:
+            version += (polyData.GetPolys().GetMTime(), polyData.GetStrips().GetMTime())
+        return version
+
+    def recordVersions(self, shapes, selection):
+        #  Keep the versions of the statistics of shapes computed by a Run
+        #  selection: Key = Name of ROI or of label array, Value = list of fields
+        for shape in shapes:
+            shapeName, polyData = shape[:2]
+            for ROIName, fieldNames in selection.iteritems():
+                for fieldName in fieldNames:
+                    self.entryVersions[(shapeName, fieldName, ROIName)] = self.entryVersion(polyData, fieldName, ROIName)
+
+    def runSelection(self, ROIDict):
+        #  Fields of each ROI of ROIDict, the ROIs of the labels being gathered in their label array
+        #  Return an OrderedDict: Key = Name of ROI or of label array, Value = list of fields
+        selection = collections.OrderedDict(self.labelFields)
+        for ROIName, ROIFieldDict in ROIDict.iteritems():
+            if ROIName not in self.ROILabels:
+                selection[ROIName] = ROIFieldDict.keys()
+        return selection
+
+    def planLiveStatistics(self, shapes, ROIDict):
+        #  Live mode: after a Run, bring ROIDict up to date with shapes (see modelShapes) by computing only
+        #  the statistics whose arrays changed (see entryVersion), or of the shapes added since the Run;
+        #  statistics of the shapes which are not in shapes anymore are removed from ROIDict
+        #  The ROIs and fields are the ones of the Run, histograms keep its bins and population maps are not updated
+        #  Return (list of (Name of ROI or of label array, task) as planTasks, set of the ROIs whose shapes were removed)
+        #  Cohort statistics cannot be updated (sketches of the shapes are dropped once merged): they are removed
+        selection = self.runSelection(ROIDict)
+        self.releaseShapes(shapes)
+        shapeNames = set(shape[0] for shape in shapes)
+        shapeNames.add(self.cohortName)
+        self.cohortStatistics = None
+        changedROIs = set()
+        for key in [key for key in self.entryVersions if key[0] not in shapeNames]:
+            del self.entryVersions[key]
+        for ROIName, ROIFieldDict in ROIDict.iteritems():
+            for shapeDict in ROIFieldDict.itervalues():
+                for shapeName in [shapeName for shapeName in shapeDict if shapeName not in shapeNames]:
+                    del shapeDict[shapeName]
+                    changedROIs.add(ROIName)
+        useCache = self.cache is not None and not self.streaming
+        tasks = list()
+        for shape in shapes:
+            shapeName, polyData = shape[:2]
+            version = shape[2] if len(shape) > 2 else None
+            staleEntries = collections.OrderedDict()  # Key = Name of ROI or of label array, Value = list of fields
+            for ROIName, fieldNames in selection.iteritems():
+                for fieldName in fieldNames:
+                    key = (shapeName, fieldName, ROIName)
+                    entryVersion = self.entryVersion(polyData, fieldName, ROIName)
+                    if entryVersion is not None and self.entryVersions.get(key) != entryVersion:
+                        self.entryVersions[key] = entryVersion
+                        staleEntries.setdefault(ROIName, list()).append(fieldName)
+            if not staleEntries:
+                continue
+            fieldNames = list(set(fieldName for fieldNames in staleEntries.itervalues() for fieldName in fieldNames))
+            shapePlan = self.planShape(shapeName, polyData, version, fieldNames, staleEntries.keys())
+            for ROIName, fieldNames in staleEntries.iteritems():
+                if ROIName not in self.labelArrays:
+                    tasks.append((ROIName, functools.partial(self.executeShapeROI, shapePlan, ROIName, fieldNames,
+                                                             useCache)))
+                    continue
+                #  Labels of the shape may have changed: its statistics are removed from the ROIs of all the labels,
+                #  ROIs of new labels are added when the task finds them (see addLabelROI)
+                for labelROIName in self.labelArrays[ROIName]:
+                    for fieldName in fieldNames:
+                        if ROIDict[labelROIName][fieldName].pop(shapeName, None) is not None:
+                            changedROIs.add(labelROIName)
+                tasks.append((ROIName, functools.partial(self.executeLabelROIs, shapePlan, ROIName, fieldNames)))
+        if tasks or changedROIs:
+            for ROIName, ROIFieldDict in ROIDict.iteritems():
+                for shapeDict in ROIFieldDict.itervalues():
+                    if shapeDict.pop(self.cohortName, None) is not None:
+                        changedROIs.add(ROIName)
+        return tasks, changedROIs
+
+    def derivedFieldName(self, fieldName, kind, rings):
+        #  e.g. "Distance Smoothed 2-ring", "Distance Local SD 3-ring"
+        return '%s %s %d-ring' % (fieldName, kind, rings)
+
+    def isDerivedFieldName(self, fieldName):
+        return re.search(r" (Smoothed|Local Mean|Local SD) \d+-ring$", fieldName) is not None
+
+    def addDerivedFields(self, ROIDict):
+        #  Add the neighborhood fields (smoothed field, local mean and local SD) of each field of ROIDict to ROIDict
+        self.derivedFields = collections.OrderedDict()
+        kinds = list()
+        if self.smoothingRings > 0:
+            kinds.append(('Smoothed', self.smoothingRings))
+        if self.localRings > 0:
+            kinds += [('Local Mean', self.localRings), ('Local SD', self.localRings)]
+        for ROIFieldDict in ROIDict.itervalues():
+            for fieldName in [fieldName for fieldName in ROIFieldDict if not self.isDerivedFieldName(fieldName)]:
+                for kind, rings in kinds:
+                    derivedName = self.derivedFieldName(fieldName, kind, rings)
+                    ROIFieldDict.setdefault(derivedName, dict())
+                    self.derivedFields[derivedName] = (fieldName, kind)
+
+    def extractDerivedArray(self, shapeName, polyData, derivedName, version, neighborhoodFields):
+        #  Neighborhood field of a shape in a ShapePlan: the memory map of its copy in the ArrayStore when there is one,
+        #  otherwise a function computing it (see computeDerivedArray), called by the task which needs it
+        if self.arrayStore is not None and version is not None:
+            array = self.arrayStore.get(shapeName, derivedName, version)
+            if array is not None:
+                return array
+        if polyData is None:
+            raise KeyError("Array " + derivedName + " of " + shapeName + " is not in the array store")
+        return functools.partial(self.computeDerivedArray, shapeName, polyData, derivedName, version, neighborhoodFields)
+
+    def computeDerivedArray(self, shapeName, polyData, derivedName, version, neighborhoodFields):
+        #  numpy array of a neighborhood field of a shape, computed from its field and its polygons
+        #  All the neighborhood fields of a field are computed together and kept in neighborhoodFields
+        #  (Key = Name of Field, Value = result of computeNeighborhoodFields), then copied to the ArrayStore
+        fieldName, kind = self.derivedFields[derivedName]
+        if fieldName not in neighborhoodFields:
+            neighborhoodFields[fieldName] = self.computeNeighborhoodFields(
+                polyData, numpy_support.vtk_to_numpy(polyData.GetPointData().GetArray(fieldName)))
+        array = neighborhoodFields[fieldName][kind]
+        if self.arrayStore is not None and version is not None:
+            array = self.arrayStore.put(shapeName, derivedName, version, array)
+        return array
+
+    def isLabelArray(self, arrayName):
+        return re.search(r"Labels$", arrayName) is not None
+
+    def labelROIName(self, arrayName, label):
+        #  Name of the ROI of a label of a label array, e.g. "SegmentationLabels 3"
+        return arrayName + ' ' + ('%d' % label if float(label).is_integer() else repr(float(label)))
+
+    def expandLabelArrays(self, ROIDict):
+        #  Remove the label arrays from ROIDict: the ROIs of their labels are added to ROIDict by mergeResults as the
+        #  tasks find them (see addLabelROI), so the labels are not read when planning
+        #  The ROIs of a label array are computed together (see executeLabelROIs)
+        self.labelArrays = collections.OrderedDict()
+        self.labelFields = collections.OrderedDict()
+        self.ROILabels = dict()
+        for arrayName in [ROIName for ROIName in ROIDict if self.isLabelArray(ROIName)]:
+            self.labelFields[arrayName] = ROIDict.pop(arrayName).keys()
+            self.labelArrays[arrayName] = list()
+
+    def addLabelROI(self, ROIDict, arrayName, label):
+        #  Name of the ROI of a label of a label array, added to ROIDict and to the ROIs of the label array
+        #  the first time a task finds the label
+        ROIName = self.labelROIName(arrayName, label)
+        if ROIName not in ROIDict:
+            ROIDict[ROIName] = dict((fieldName, dict()) for fieldName in self.labelFields[arrayName])
+        if ROIName not in self.ROILabels:
+            self.ROILabels[ROIName] = label
+            self.labelArrays[arrayName].append(ROIName)
+            self.labelArrays[arrayName].sort(key=self.ROILabels.get)
+        return ROIName
+
+    def extractArray(self, shapeName, polyData, arrayName, version):
+        #  numpy array of the point data arrayName of a shape: a view on the VTK buffer, or with the ArrayStore
+        #  (and a version of the shape), the memory map of its copy in the store
+        #  The point data is only read when the store has no copy of this version (polyData can be None otherwise):
+        #  the array is then planned as a function copying it to the store, called by the task which needs it
+        if self.arrayStore is None or version is None:
+            return numpy_support.vtk_to_numpy(polyData.GetPointData().GetArray(arrayName))
+        array = self.arrayStore.get(shapeName, arrayName, version)
+        if array is None:
+            if polyData is None:
+                raise KeyError("Array " + arrayName + " of " + shapeName + " is not in the array store")
+            array = functools.partial(self.arrayStore.put, shapeName, arrayName, version,
+                                      numpy_support.vtk_to_numpy(polyData.GetPointData().GetArray(arrayName)))
+        return array
+
+    def executePlan(self, plan, ROIDict):
+        #  Compute the statistics of every shape of plan and store them in ROIDict
+        for ROIName, task in self.planTasks(plan, ROIDict):
+            self.mergeResults(ROIDict, ROIName, task())
+        self.completePopulationMaps(plan)
+        self.completeCohortStatistics(ROIDict)
+        self.histogramPlan = None
+
+    def planTasks(self, plan, ROIDict):
+        #  Split the computation of plan into independent tasks (functions without argument), which can run
+        #  on different threads: one task per ROI and shape, or per ROI when shapes are batched, and one task
+        #  per label array and shape for the ROIs of the labels
+        #  Return a list of (Name of ROI or of label array, task), each task returns a dictionary of fields
+        #  (or, for a label array, a dictionary of ROIs) (see mergeResults)
+        #  Statistics of the streaming mode are not cached: their sketches are needed to merge them
+        useCache = self.cache is not None and not self.streaming
+        self.populationMaps = collections.OrderedDict()
+        self.cohortStatistics = collections.OrderedDict() if self.streaming and self.computeCohortStatistics else None
+        self.histogramEdges = dict()
+        self.histogramPlan = plan
+        #  Shapes with the same number of points (e.g. ModelToModelDistance outputs of corresponded shapes)
+        #  are computed together, as the rows of a matrix
+        self.batched = self.batchCorrespondedShapes and not self.streaming and not self.areaWeighted and \
+                       len(plan) > 1 and len(set(shapePlan.numberOfPoints for shapePlan in plan)) == 1
+        tasks = list()
+        for arrayName, fieldNames in self.labelFields.iteritems():
+            for shapePlan in plan:
+                tasks.append((arrayName, functools.partial(self.executeLabelROIs, shapePlan, arrayName, fieldNames)))
+        for ROIName, ROIFieldDict in ROIDict.iteritems():
+            if ROIName in self.ROILabels:
+                continue
+            fieldNames = ROIFieldDict.keys()
+            if self.batched:
+                tasks.append((ROIName, functools.partial(self.executeBatchedROI, plan, ROIName, fieldNames, useCache)))
+            else:
+                for shapePlan in plan:
+                    tasks.append((ROIName, functools.partial(self.executeShapeROI, shapePlan, ROIName, fieldNames,
+                                                             useCache)))
+        return tasks
+
+    def mergeResults(self, ROIDict, ROIName, ROIFieldDict):
+        #  ROIFieldDict: Key = Name of Field, Value = dictionary of shapes (key = name of shape, value = StatisticStore)
+        #  For a label array: Key = label, Value = dictionary of fields
+        if ROIName in self.labelArrays:
+            for label, labelFieldDict in ROIFieldDict.iteritems():
+                self.mergeResults(ROIDict, self.addLabelROI(ROIDict, ROIName, label), labelFieldDict)
+            return
+        for fieldName, shapeDict in ROIFieldDict.iteritems():
+            if self.cohortStatistics is not None:
+                for shapeStats in shapeDict.itervalues():
+                    if getattr(shapeStats, 'streamingStatistics', None) is not None:
+                        self.mergeCohortStatistics(ROIName, fieldName, shapeStats.streamingStatistics)
+                        shapeStats.streamingStatistics = None  # Dropped once merged
+            ROIDict[ROIName][fieldName].update(shapeDict)
+
+    def taskROINames(self, ROIName):
+        #  ROIs filled by the tasks of ROIName (see planTasks)
+        return self.labelArrays.get(ROIName, [ROIName])
+
+    def completePopulationMaps(self, plan, results=()):
+        #  Population maps of the fields which were not computed with the entire shapes
+        #  Run as the last task of startStatistics: results of the other tasks are waited for first
+        for result in results:
+            result.wait()
+        if self.computePopulationMaps and self.batched:
+            for fieldName in plan[0].fieldArrays:
+                if fieldName not in self.populationMaps and not self.canceled.isSet():
+                    self.populationMaps[fieldName] = self.computeBlockPopulationStatistics(
+                        [shapePlan.fieldArray(fieldName) for shapePlan in plan])
+
+    def getHistogramEdges(self, fieldName, shapePlan=None):
+        #  Edges of the histogramBins bins of a field (None when histograms are disabled), shared by all the shapes and
+        #  ROIs of the Run so that their histograms can be compared: between histogramRange, or the minimum and maximum
+        #  of the field over the shapes of the Run
+        #  Computed by the first task which needs them, not by the GUI thread: the ranges of the shapes are computed
+        #  from the shape of the task (shapePlan) on, so that the tasks of other shapes compute other ranges meanwhile
+        #  Neighborhood fields are not computed here: being averages of their field, smoothed fields and local means
+        #  are within the range of their field, and local SDs within [0, half of this range]
+        edges = self.histogramEdges.get(fieldName)
+        if edges is not None or self.histogramBins <= 0 or self.histogramPlan is None:
+            return edges
+        if self.histogramRange is not None:
+            low, high = self.histogramRange
+        else:
+            baseFieldName, kind = self.derivedFields.get(fieldName, (fieldName, None))
+            plan = self.histogramPlan
+            start = plan.index(shapePlan) if shapePlan in plan else 0
+            ranges = [otherPlan.fieldRange(baseFieldName, self.computeRange) for otherPlan in plan[start:] + plan[:start]]
+            ranges = [fieldRange for fieldRange in ranges if fieldRange is not None]
+            if not ranges:
+                return None
+            low = min(fieldRange[0] for fieldRange in ranges)
+            high = max(fieldRange[1] for fieldRange in ranges)
+            if not (numpy.isfinite(low) and numpy.isfinite(high)):
+                return None
+            if kind == 'Local SD':
+                low, high = 0.0, (high - low) / 2.0
+        low, high = float(low), float(high)
+        if low == high:  # Same as numpy.histogram
+            low, high = low - 0.5, high + 0.5
+        edges = self.histogramEdges[fieldName] = numpy.linspace(low, high, self.histogramBins + 1)
+        return edges
+
+    def computeRange(self, valueArray):
+        #  (minimum, maximum) of the values of valueArray which are not NaN, or None when there is none
+        #  Both are computed in one pass over the array, by chunks of streamingChunkSize values
+        low, high = numpy.inf, -numpy.inf
+        for start in xrange(0, len(valueArray), self.streamingChunkSize):
+            chunk = valueArray[start:start + self.streamingChunkSize]
+            low = numpy.fmin(low, numpy.fmin.reduce(chunk))
+            high = numpy.fmax(high, numpy.fmax.reduce(chunk))
+        if low > high:
+            return None
+        return low, high
+
+    def createStatisticStore(self, fieldName, shapePlan=None):
+        #  StatisticStore of a field of shapePlan, with the edges of its histogram when histograms are computed
+        fieldState = self.StatisticStore(self.percentiles)
+        fieldState.histogramEdges = self.getHistogramEdges(fieldName, shapePlan)
+        return fieldState
+
+    def executeShapeROI(self, shapePlan, ROIName, fieldNames, useCache):
+        #  Compute the statistics of the fields fieldNames on a ROI of one shape
+        ROIFieldDict = dict((fieldName, dict()) for fieldName in fieldNames)
+        ROIArray = shapePlan.ROIArray(ROIName)
+        mask = None
+        if ROIArray is not None and len(ROIArray) != shapePlan.numberOfPoints:
+            print "Size of ROIArray and fieldArray are not the same!!!"
+            return ROIFieldDict
+        for fieldName, fieldValue in ROIFieldDict.iteritems():
+            if self.canceled.isSet():
+                break
+            fieldState = self.createStatisticStore(fieldName, shapePlan)
+            fieldValue[shapePlan.name] = fieldState
+            if useCache:
+                key = self.cacheKey(shapePlan, fieldName, ROIName)
+                if self.loadStatisticStore(self.cache.get(key), fieldState):
+                    continue
+            if self.streaming:
+                with self.measure('computeAll', shapePlan.name, fieldName, ROIName) as measure:
+                    self.computeStreamingStatistics(shapePlan.fieldArray(fieldName), ROIArray, fieldState)
+                    measure.count(len(shapePlan.fieldArray(fieldName)))
+                continue
+            with self.measure('defineArray', shapePlan.name, fieldName, ROIName) as measure:
+                valueArray = shapePlan.fieldArray(fieldName)
+                if self.areaWeighted:
+                    weightArray = self.getVertexAreas(shapePlan.polyData)
+                if ROIArray is not None:
+                    if mask is None:
+                        mask = ROIArray == 1.0
+                    valueArray = valueArray[mask]
+                    measure.count(valueArray)
+                    if self.areaWeighted:
+                        weightArray = weightArray[mask]
+            with self.measure('computeAll', shapePlan.name, fieldName, ROIName) as measure:
+                if self.areaWeighted:
+                    self.computeWeightedStatistics(valueArray, weightArray, fieldState)
+                else:
+                    self.computeStatistics(valueArray, fieldState)
+                measure.count(valueArray)  # Selections and sorts work on a copy of valueArray
+            if useCache:
+                self.cache.put(key, self.dumpStatisticStore(fieldState))
+        return ROIFieldDict
+
+    def executeBatchedROI(self, plan, ROIName, fieldNames, useCache):
+        #  Compute a ROI for all the shapes of plan at once when their masks are the same
+        #  (shape by shape otherwise)
+        mask = None
+        if ROIName != 'Entire Shape':
+            mask = plan[0].ROIArray(ROIName) == 1.0
+            for shapePlan in plan[1:]:
+                ROIArray = shapePlan.ROIArray(ROIName)
+                if len(ROIArray) != len(mask) or not numpy.array_equal(ROIArray == 1.0, mask):
+                    ROIFieldDict = dict((fieldName, dict()) for fieldName in fieldNames)
+                    for shapePlan in plan:
+                        for fieldName, shapeDict in self.executeShapeROI(shapePlan, ROIName, fieldNames,
+                                                                         useCache).iteritems():
+                            ROIFieldDict[fieldName].update(shapeDict)
+                    return ROIFieldDict
+        ROIFieldDict = dict((fieldName, dict()) for fieldName in fieldNames)
+        for fieldName, fieldValue in ROIFieldDict.iteritems():
+            if self.canceled.isSet():
+                break
+            rows = list()
+            fieldStates = list()
+            keys = list()
+            for shapePlan in plan:
+                fieldState = self.createStatisticStore(fieldName, shapePlan)
+                fieldValue[shapePlan.name] = fieldState
+                if useCache:
+                    key = self.cacheKey(shapePlan, fieldName, ROIName)
+                    if self.loadStatisticStore(self.cache.get(key), fieldState):
+                        continue
+                    keys.append(key)
+                rows.append(shapePlan.fieldArray(fieldName))
+                fieldStates.append(fieldState)
+            if not rows:
+                continue
+            #  Rows read from the ArrayStore are computed by blocks of storeMemoryBudget bytes
+            rowsPerBlock = len(rows)
+            if self.arrayStore is not None:
+                rowsPerBlock = max(1, self.storeMemoryBudget // max(1, rows[0].nbytes))
+            for start in xrange(0, len(rows), rowsPerBlock):
+                with self.measure('defineArray', field=fieldName, ROI=ROIName) as measure:
+                    matrix = numpy.vstack(rows[start:start + rowsPerBlock])
+                    measure.count(matrix)
+                    if mask is not None:
+                        matrix = matrix[:, mask]
+                        measure.count(matrix)
+                if mask is None and self.computePopulationMaps and len(rows) == len(plan):
+                    if rowsPerBlock >= len(rows):
+                        self.populationMaps[fieldName] = self.computePopulationStatistics(matrix)
+                    elif start == 0:
+                        self.populationMaps[fieldName] = self.computeBlockPopulationStatistics(rows)
+                with self.measure('computeAll', field=fieldName, ROI=ROIName) as measure:
+                    self.computeStatisticsMatrix(matrix, fieldStates[start:start + rowsPerBlock])
+                    measure.count(matrix)
+            for key, fieldState in zip(keys, fieldStates):
+                self.cache.put(key, self.dumpStatisticStore(fieldState))
+        return ROIFieldDict
+
+    def executeLabelROIs(self, shapePlan, arrayName, fieldNames):
+        #  Compute the statistics of the fields fieldNames on the ROIs of all the labels of a label array of one shape,
+        #  the vertices being grouped by label once, then each field in one grouped pass (see computeLabelStatistics)
+        #  Statistics of labels are not cached
+        #  Return an OrderedDict: Key = label found in the shape, Value = dictionary of fields (see mergeResults)
+        result = collections.OrderedDict()
+        labelArray = shapePlan.ROIArray(arrayName)
+        if len(labelArray) != shapePlan.numberOfPoints:
+            print "Size of ROIArray and fieldArray are not the same!!!"
+            return result
+        weightArray = self.getVertexAreas(shapePlan.polyData) if self.areaWeighted else None
+        with self.measure('defineArray', shapePlan.name, ROI=arrayName) as measure:
+            labelGroups = self.groupLabels(labelArray)
+            measure.count(labelGroups[0])
+        for fieldName in fieldNames:
+            if self.canceled.isSet():
+                break
+            valueArray = shapePlan.fieldArray(fieldName)
+            with self.measure('computeAll', shapePlan.name, fieldName, arrayName) as measure:
+                labelStates = self.computeLabelStatistics(valueArray, labelGroups, weightArray,
+                                                          self.getHistogramEdges(fieldName, shapePlan))
+                measure.count(valueArray)
+            for label, fieldState in labelStates.iteritems():
+                if label not in result:
+                    result[label] = dict((fieldName, dict()) for fieldName in fieldNames)
+                result[label][fieldName][shapePlan.name] = fieldState
+        return result
+
+    def startStatistics(self, plan, ROIDict, numberOfThreads=None, tasks=None):
+        #  Start the computation of plan on a pool of threads (numpy releases the GIL while computing)
+        #  Results are merged in ROIDict by pollStatistics, which must be called regularly from the GUI thread
+        #  tasks already planned (e.g. by planLiveStatistics) are computed instead of the ones of plan when given
+        import multiprocessing.pool
+        if self.threadPool is not None:
+            self.threadPool.join()  # Tasks of a canceled Run stop at their next field
+        self.canceled.clear()
+        self.runningPlan = plan
+        if tasks is None:
+            tasks = self.planTasks(plan, ROIDict)
+        self.threadPool = multiprocessing.pool.ThreadPool(numberOfThreads or multiprocessing.cpu_count())
+        self.pendingResults = [(ROIName, self.threadPool.apply_async(task)) for ROIName, task in tasks]
+        if plan and self.computePopulationMaps and self.batched:
+            #  Started once all the other tasks are (tasks are started in order), so waiting for them cannot deadlock;
+            #  its ROI is None: it has no result to merge
+            results = [result for ROIName, result in self.pendingResults]
+            self.pendingResults.append((None, self.threadPool.apply_async(self.completePopulationMaps, (plan, results))))
+        self.numberOfTasks = len(self.pendingResults)
+        self.threadPool.close()
+
+    def pollStatistics(self, ROIDict):
+        #  Merge the results of the tasks finished since the last call in ROIDict
+        #  Return (number of tasks finished, number of tasks, list of the ROIs whose tasks are all finished)
+        pendingResults = list()
+        finishedROIs = list()
+        for ROIName, result in self.pendingResults:
+            if not result.ready():
+                pendingResults.append((ROIName, result))
+                continue
+            try:
+                if ROIName is None:  # Population maps (see startStatistics)
+                    result.get()
+                else:
+                    self.mergeResults(ROIDict, ROIName, result.get())
+            except Exception as error:
+                print "Computation of " + (ROIName or "the population maps") + " failed: " + str(error)
+            if ROIName is not None and ROIName not in finishedROIs:
+                finishedROIs.append(ROIName)
+        self.pendingResults = pendingResults
+        pendingROIs = set(ROIName for ROIName, result in pendingResults)
+        finishedROIs = [labelROIName for ROIName in finishedROIs if ROIName not in pendingROIs
+                        for labelROIName in self.taskROINames(ROIName)]
+        if not pendingResults and self.runningPlan is not None:
+            self.runningPlan = None
+            self.histogramPlan = None
+            if self.cohortStatistics:
+                finishedROIs += [ROIName for ROIName, fieldName in self.cohortStatistics if ROIName not in finishedROIs]
+            self.completeCohortStatistics(ROIDict)
+        return self.numberOfTasks - len(pendingResults), self.numberOfTasks, finishedROIs
+
+    def cancelStatistics(self):
+        #  Tasks stop at the next field (or chunk in streaming mode), tasks not started yet do nothing
+        self.canceled.set()
+
+    def computeStatisticsMatrix(self, matrix, fieldStates):
+        #  Same statistics as computeStatistics for each row of matrix (one row per shape),
+        #  computed with vectorized operations along the rows
+        if matrix.shape[1] == 0:
+            return
+        percentiles = fieldStates[0].percentiles.keys()
+        ranks = self.percentileRanks(matrix.shape[1], percentiles)
+        kth = numpy.unique(numpy.concatenate(([0, matrix.shape[1] - 1], ranks)))
+        partitionedMatrix = numpy.partition(matrix, kth, axis=1)
+        means = numpy.mean(matrix, axis=1, dtype=numpy.float64)
+        stds = numpy.std(matrix, axis=1, dtype=numpy.float64)
+        for row, fieldState in enumerate(fieldStates):
+            fieldState.min = round(float(partitionedMatrix[row, 0]), self.numberOfDecimals)
+            fieldState.max = round(float(partitionedMatrix[row, -1]), self.numberOfDecimals)
+            fieldState.mean = round(means[row], self.numberOfDecimals)
+            fieldState.std = round(stds[row], self.numberOfDecimals)
+            for percent, rank in zip(percentiles, ranks):
+                fieldState.percentiles[percent] = round(float(partitionedMatrix[row, rank]), self.numberOfDecimals)
+            if self.bootstrapResamples:
+                self.computeBootstrapIntervals(matrix[row], fieldState)
+        edges = fieldStates[0].histogramEdges
+        if edges is not None:
+            #  Histograms of all the rows in one numpy.bincount
+            histograms = self.computeHistograms(matrix, edges, numpy.arange(len(fieldStates))[:, numpy.newaxis],
+                                                len(fieldStates))
+            for fieldState, histogram in zip(fieldStates, histograms):
+                fieldState.histogram = histogram
+
+    def computePopulationStatistics(self, matrix):
+        #  Per vertex statistics of the population (one row per shape, one column per vertex)
+        #  Return an OrderedDict: Key = name of the statistic, Value = array with one value per vertex
+        populationStatistics = collections.OrderedDict()
+        populationStatistics['Mean'] = numpy.mean(matrix, axis=0, dtype=numpy.float64)
+        populationStatistics['SD'] = numpy.std(matrix, axis=0, dtype=numpy.float64)
+        ranks = self.percentileRanks(matrix.shape[0], self.percentiles)
+        partitionedMatrix = numpy.partition(matrix, numpy.unique(ranks), axis=0)
+        for percent, rank in zip(self.percentiles, ranks):
+            populationStatistics[self.centileLabel(percent)] = partitionedMatrix[rank]
+        return populationStatistics
+
+    def computeBlockPopulationStatistics(self, rows):
+        #  computePopulationStatistics of the matrix of rows (one per shape), computed by blocks of vertices
+        #  of storeMemoryBudget bytes when the rows are read from the ArrayStore
+        if self.arrayStore is None:
+            return self.computePopulationStatistics(numpy.vstack(rows))
+        verticesPerBlock = max(1, self.storeMemoryBudget // (len(rows) * rows[0].itemsize))
+        blocks = collections.OrderedDict()
+        for start in xrange(0, len(rows[0]), verticesPerBlock):
+            matrix = numpy.vstack([row[start:start + verticesPerBlock] for row in rows])
+            for statisticName, valueArray in self.computePopulationStatistics(matrix).iteritems():
+                blocks.setdefault(statisticName, list()).append(valueArray)
+        return collections.OrderedDict((statisticName, numpy.concatenate(valueArrays))
+                                       for statisticName, valueArrays in blocks.iteritems())
+
+    def writePopulationMaps(self, polyData):
+        #  Add the population statistics computed by the last Run as point data arrays of polyData,
+        #  named "<field> Population <statistic>"
+        for fieldName, populationStatistics in self.populationMaps.iteritems():
+            for statisticName, valueArray in populationStatistics.iteritems():
+                if len(valueArray) != polyData.GetNumberOfPoints():
+                    print "Number of points of the model and of the shapes are not the same!!!"
+                    return
+                array = numpy_support.numpy_to_vtk(numpy.ascontiguousarray(valueArray), deep=1)
+                array.SetName(fieldName + ' Population ' + statisticName)
+                polyData.GetPointData().AddArray(array)
+        polyData.GetPointData().Modified()
+
+    def cacheKey(self, shapePlan, fieldName, ROIName):
+        fingerprints = [self.getFingerprint(shapePlan, fieldName, shapePlan.fieldArray),
+                        self.getFingerprint(shapePlan, ROIName, shapePlan.ROIArray),
+                        self.configurationFingerprint()]
+        if self.areaWeighted:
+            fingerprints.append(self.getFingerprint(shapePlan, 'Vertex Areas',
+                                                    lambda arrayName: self.getVertexAreas(shapePlan.polyData)))
+        edges = self.getHistogramEdges(fieldName, shapePlan)
+        if edges is not None:
+            fingerprints.append(repr(edges.tolist()))
+        return self.cache.key(*fingerprints)
+
+    def getFingerprint(self, shapePlan, arrayName, getArray):
+        #  Fingerprint of an array of shapePlan (returned by getArray(arrayName)), computed once per Run, and once per
+        #  version of a shape with a version (see sessionFingerprints)
+        #  Arrays computed from the shape (neighborhood fields and vertex areas) are identified by the version only,
+        #  or with fullHash by the fingerprints of what they are computed from, so that a hit does not compute them
+        if arrayName in shapePlan.fingerprints:
+            return shapePlan.fingerprints[arrayName]
+        sessionKey = (shapePlan.name, arrayName, shapePlan.version)
+        if sessionKey in self.sessionFingerprints:
+            fingerprint = self.sessionFingerprints[sessionKey]
+        else:
+            identity = repr(sessionKey) if shapePlan.version is not None else None
+            computed = arrayName in self.derivedFields or arrayName == 'Vertex Areas'
+            if computed and identity is not None and not self.cache.fullHash:
+                fingerprint = hashlib.sha1(identity).hexdigest()
+            elif computed and shapePlan.polyData is not None:
+                sources = [arrayName]
+                if arrayName in self.derivedFields:
+                    sources.append(self.getFingerprint(shapePlan, self.derivedFields[arrayName][0], shapePlan.fieldArray))
+                for geometryName in ('Points', 'Polygons', 'Strips'):
+                    sources.append(self.getFingerprint(shapePlan, geometryName,
+                                                       lambda name: self.geometryArray(shapePlan.polyData, name)))
+                fingerprint = hashlib.sha1('|'.join(sources)).hexdigest()
+            else:
+                fingerprint = self.cache.arrayFingerprint(getArray(arrayName), identity)
+            if shapePlan.version is not None:
+                self.sessionFingerprints[sessionKey] = fingerprint
+        shapePlan.fingerprints[arrayName] = fingerprint
+        return fingerprint
+
+    def geometryArray(self, polyData, geometryName):
+        #  Points, Polygons or Strips of polyData as a numpy view (None when it has no points)
+        if geometryName == 'Points':
+            data = polyData.GetPoints().GetData() if polyData.GetPoints() is not None else None
+        else:
+            data = (polyData.GetPolys() if geometryName == 'Polygons' else polyData.GetStrips()).GetData()
+        return numpy_support.vtk_to_numpy(data) if data is not None else None
+
+    def configurationFingerprint(self):
+        bootstrap = (self.bootstrapResamples, self.bootstrapConfidence, self.bootstrapSeed) if self.bootstrapResamples else None
+        return repr((self.percentiles, self.numberOfDecimals, self.areaWeighted, bootstrap))
+
+    def dumpStatisticStore(self, fieldState):
+        return {'min': fieldState.min, 'max': fieldState.max, 'mean': fieldState.mean, 'std': fieldState.std,
+                'percentiles': fieldState.percentiles.values(),
+                'confidence': fieldState.confidence, 'intervals': fieldState.intervals.values(),
+                'histogram': fieldState.histogram.tolist() if fieldState.histogram is not None else None}
+
+    def loadStatisticStore(self, values, fieldState):
+        #  Fill fieldState with values saved by dumpStatisticStore, return False if values is None
+        if values is None:
+            return False
+        fieldState.min = values['min']
+        fieldState.max = values['max']
+        fieldState.mean = values['mean']
+        fieldState.std = values['std']
+        for percent, value in zip(fieldState.percentiles.keys(), values['percentiles']):
+            fieldState.percentiles[percent] = value
+        if values.get('intervals'):
+            fieldState.confidence = values['confidence']
+            for key, interval in zip(['Mean'] + fieldState.percentiles.keys(), values['intervals']):
+                fieldState.intervals[key] = tuple(interval)
+        if values.get('histogram') is not None and fieldState.histogramEdges is not None:
+            fieldState.histogram = numpy.array(values['histogram'], dtype=numpy.intp)
+        return True
 
     def removeTable(self, layout, tabROI):
         # Remove table if it already exists:
         indexWidgetTabROI = layout.indexOf(tabROI)
         if indexWidgetTabROI != -1:
+            tabROI.disconnect('currentChanged(int)', self.onTabROICurrentChanged)
             for i in range(0, tabROI.count):
-                tabWidget = tabROI.widget(i)
-                for i in range(0, tabWidget.count):
-                    tableWidget = tabWidget.widget(i)
-                    tableWidget.clearContents()
-                    tableWidget.setRowCount(0)
-                tabWidget.clear()
+                tabROI.widget(i).clear()
             tabROI.clear()
+            self.tableModels = list()
+            self.pendingTables = list()
+            self.ROITabs = dict()
+            self.statisticsModels = dict()
 
     def defineArray(self, fieldArray, ROIArray):
         #  Define array of value from fieldArray(array with all the distances from ModelToModelDistance)
         #  using ROIArray as a mask
         #  Return a numpy.array to be able to use numpy's method to compute statistics
-        valueList = list()
+        #  The VTK buffers are wrapped as numpy views (no copy); the ROI is applied as a boolean mask
+        valueArray = numpy_support.vtk_to_numpy(fieldArray)
         if ROIArray == 'None':
-            for i in range(0, fieldArray.GetNumberOfTuples()):
-                valueList.append(fieldArray.GetValue(i))
-            valueArray = numpy.array(valueList)
-        else:
-            if ROIArray.GetNumberOfTuples() != fieldArray.GetNumberOfTuples():
-                print "Size of ROIArray and fieldArray are not the same!!!"
+            return valueArray
+        with self.measure('defineArray', field=fieldArray.GetName(), ROI=ROIArray.GetName()) as measure:
+            mask = self.defineMask(numpy_support.vtk_to_numpy(ROIArray), fieldArray.GetNumberOfTuples())
+            if mask is None:
                 return None
-            else:
-                for i in range(0, fieldArray.GetNumberOfTuples()):
-                    if ROIArray.GetValue(i) == 1.0:
-                        valueList.append(fieldArray.GetValue(i))
-                valueArray = numpy.array(valueList)
+            valueArray = valueArray[mask]
+            measure.count(valueArray)
         return valueArray
 
+    def defineMask(self, ROIArray, numberOfValues):
+        #  ROIArray is a numpy array, a value is inside the ROI if it is equal to 1.0
+        #  Return a boolean mask, or None if ROIArray does not have numberOfValues values
+        if len(ROIArray) != numberOfValues:
+            print "Size of ROIArray and fieldArray are not the same!!!"
+            return None
+        return ROIArray == 1.0
+
     def computeMean(self, valueArray):
         #  valueArray is an array in which values to compute statistics on are stored
-        return round(numpy.mean(valueArray), self.numberOfDecimals)
+        return round(numpy.mean(valueArray, dtype=numpy.float64), self.numberOfDecimals)
     
     def computeMinMax(self, valueArray):
         #  valueArray is an array in which values to compute statistics on are stored
@@ -327,7 +2066,7 @@ class MeshStatsLogic (ScriptedLoadableModuleLogic):
     
     def computeStandardDeviation(self, valueArray):
         #  valueArray is an array in which values to compute statistics on are stored
-        return round(numpy.std(valueArray), self.numberOfDecimals)
+        return round(numpy.std(valueArray, dtype=numpy.float64), self.numberOfDecimals)
     
     def computePercentile(self, valueArray, percent):
         #  Function to compute different percentile
@@ -335,64 +2074,485 @@ class MeshStatsLogic (ScriptedLoadableModuleLogic):
         #  percent is a value between 0 and 1
         valueArray = numpy.sort(valueArray)
         index = (valueArray.size * percent) - 1
-        ceilIndex = math.ceil(index)
+        ceilIndex = int(math.ceil(index))
         return round(valueArray[ceilIndex], self.numberOfDecimals)
 
+    def percentileRanks(self, size, percentiles):
+        #  Ranks (in the sorted array) of the percentiles of an array of size values
+        #  Same definition as computePercentile: rank = ceil(size * percent - 1), percent between 0 and 1
+        ranks = numpy.ceil(size * (numpy.asarray(percentiles, dtype=numpy.float64) / 100.0) - 1).astype(numpy.intp)
+        ranks[ranks < 0] += size
+        return ranks
+
+    def computeStatistics(self, valueArray, fieldState):
+        #  Compute min, max, mean, standard deviation and all the percentiles of fieldState
+        #  in a single selection pass: every rank needed is selected at once by numpy.partition
+        #  instead of sorting the whole array for each percentile
+        if valueArray is None or valueArray.size == 0:
+            if self.bootstrapResamples:
+                self.computeBootstrapIntervals(numpy.empty(0), fieldState)
+            return
+        percentiles = fieldState.percentiles.keys()
+        ranks = self.percentileRanks(valueArray.size, percentiles)
+        kth = numpy.unique(numpy.concatenate(([0, valueArray.size - 1], ranks)))
+        partitionedArray = numpy.partition(valueArray, kth)
+        fieldState.min = round(float(partitionedArray[0]), self.numberOfDecimals)
+        fieldState.max = round(float(partitionedArray[-1]), self.numberOfDecimals)
+        fieldState.mean = self.computeMean(valueArray)
+        fieldState.std = self.computeStandardDeviation(valueArray)
+        for percent, rank in zip(percentiles, ranks):
+            fieldState.percentiles[percent] = round(float(partitionedArray[rank]), self.numberOfDecimals)
+        if self.bootstrapResamples:
+            self.computeBootstrapIntervals(valueArray, fieldState)
+        if fieldState.histogramEdges is not None:
+            fieldState.histogram = self.computeHistograms(valueArray, fieldState.histogramEdges)[0]
+
+    def groupLabels(self, labelArray):
+        #  Order of the vertices sorted by label, computed once per label array and used for all the fields
+        #  Vertices of label 0 (background) are left out: label 0 is not a ROI
+        #  Return (order, first index of each label in the sorted order, number of vertices of each label, labels)
+        order = numpy.flatnonzero(labelArray)
+        sortedLabels = labelArray[order]
+        sortOrder = numpy.argsort(sortedLabels)
+        order = order[sortOrder]
+        sortedLabels = sortedLabels[sortOrder]
+        if sortedLabels.size == 0:
+            return order, numpy.zeros(0, dtype=numpy.intp), numpy.zeros(0, dtype=numpy.intp), list()
+        starts = numpy.concatenate(([0], numpy.flatnonzero(sortedLabels[1:] != sortedLabels[:-1]) + 1))
+        counts = numpy.diff(numpy.append(starts, sortedLabels.size))
+        return order, starts, counts, sortedLabels[starts].tolist()
+
+    def computeLabelStatistics(self, valueArray, labelGroups, weightArray=None, histogramEdges=None):
+        #  Statistics of valueArray on the vertices of each label, in a single grouped pass:
+        #  values gathered in the order of groupLabels make one slice per label, whose sums are reduced
+        #  with numpy.add.reduceat and whose min, max and percentiles are selected by numpy.partition
+        #  With weightArray (area weighted mode), each slice is computed by computeWeightedStatistics
+        #  With histogramEdges, the histograms of all the labels are counted in one numpy.bincount
+        #  Return an OrderedDict: Key = label, Value = StatisticStore
+        order, starts, counts, labels = labelGroups
+        labelStates = collections.OrderedDict()
+        if valueArray.size == 0 or not labels:
+            return labelStates
+        groupedValues = valueArray[order]
+        for label in labels:
+            labelStates[label] = self.StatisticStore(self.percentiles)
+        if histogramEdges is not None:
+            histograms = self.computeHistograms(groupedValues, histogramEdges,
+                                                numpy.repeat(numpy.arange(len(labels)), counts), len(labels))
+            for fieldState, histogram in zip(labelStates.itervalues(), histograms):
+                fieldState.histogram = histogram
+        if weightArray is not None:
+            groupedWeights = weightArray[order]
+            for fieldState, start, count in zip(labelStates.itervalues(), starts, counts):
+                self.computeWeightedStatistics(groupedValues[start:start + count], groupedWeights[start:start + count],
+                                               fieldState)
+                fieldState.histogramEdges = histogramEdges
+            return labelStates
+        means = numpy.add.reduceat(groupedValues, starts, dtype=numpy.float64) / counts
+        deviations = groupedValues - numpy.repeat(means, counts)
+        stds = numpy.sqrt(numpy.add.reduceat(deviations * deviations, starts) / counts)
+        for label, start, count, mean, std in zip(labels, starts, counts, means, stds):
+            fieldState = labelStates[label]
+            fieldState.histogramEdges = histogramEdges
+            ranks = self.percentileRanks(count, self.percentiles)
+            partitionedArray = numpy.partition(groupedValues[start:start + count],
+                                               numpy.unique(numpy.concatenate(([0, count - 1], ranks))))
+            fieldState.min = round(float(partitionedArray[0]), self.numberOfDecimals)
+            fieldState.max = round(float(partitionedArray[-1]), self.numberOfDecimals)
+            fieldState.mean = round(mean, self.numberOfDecimals)
+            fieldState.std = round(std, self.numberOfDecimals)
+            for percent, rank in zip(self.percentiles, ranks):
+                fieldState.percentiles[percent] = round(float(partitionedArray[rank]), self.numberOfDecimals)
+            if self.bootstrapResamples:
+                self.computeBootstrapIntervals(partitionedArray, fieldState)
+        return labelStates
+
+    def computeBootstrapIntervals(self, valueArray, fieldState):
+        #  Percentile bootstrap confidence intervals (bootstrapConfidence percent) of the mean and of the percentiles
+        #  of valueArray, from bootstrapResamples resamples seeded with bootstrapSeed (same array, same intervals)
+        #  Means of the resamples are sums of slices of at most bootstrapSliceSize indexes (a slice holds several
+        #  resamples of a small array), each slice drawn by its own seeded generator: the intervals do not depend on
+        #  how the slices are spread over the pool of threads, and at most bootstrapMemoryBudget bytes of slices are
+        #  drawn at once by all the threads
+        #  Percentiles of the resamples do not need the resamples: the value of rank k of a resample is the value of
+        #  the sorted array at the k-th smallest index drawn, and the k-th smallest of n uniform indices in [0, n)
+        #  is floor(n * u) with u drawn from Beta(k, n - k + 1)
+        size = valueArray.size
+        if size == 0:
+            #  Intervals of an empty ROI are NaN, so that its row has the columns of the other shapes
+            fieldState.confidence = self.bootstrapConfidence
+            fieldState.intervals = collections.OrderedDict((key, (numpy.nan, numpy.nan))
+                                                           for key in ['Mean'] + fieldState.percentiles.keys())
+            return
+        numberOfResamples = self.bootstrapResamples
+        sliceSize = min(size, self.bootstrapSliceSize)
+        resamplesPerGroup = max(1, self.bootstrapSliceSize // size)
+        groupStarts = range(0, numberOfResamples, resamplesPerGroup)
+        sums = numpy.zeros(numberOfResamples)
+
+        def sumResamples(blockGroupStarts):
+            #  Each group of resamples belongs to one block: blocks add their slices to distinct sums
+            for groupStart in blockGroupStarts:
+                numberOfGroupResamples = min(resamplesPerGroup, numberOfResamples - groupStart)
+                for sliceStart in xrange(0, size, sliceSize):
+                    if self.canceled.isSet():
+                        return
+                    with slices:  # Indexes and values of the slice
+                        random = numpy.random.RandomState([self.bootstrapSeed, groupStart, sliceStart])
+                        indexes = random.randint(0, size, (numberOfGroupResamples, min(sliceSize, size - sliceStart)))
+                        sums[groupStart:groupStart + numberOfGroupResamples] += \
+                            numpy.sum(valueArray.take(indexes), axis=1, dtype=numpy.float64)
+
+        import multiprocessing.pool
+        numberOfThreads = self.bootstrapThreads or multiprocessing.cpu_count()
+        with self.bootstrapLock:
+            settings = (numberOfThreads, self.bootstrapMemoryBudget, self.bootstrapSliceSize)
+            if settings != self.bootstrapSettings:
+                #  Intervals being computed keep the pool and the semaphore they started with
+                if self.bootstrapPool is not None:
+                    self.bootstrapPool.close()
+                self.bootstrapPool = multiprocessing.pool.ThreadPool(numberOfThreads) if numberOfThreads > 1 else None
+                self.bootstrapSlices = threading.BoundedSemaphore(
+                    max(1, self.bootstrapMemoryBudget // (16 * self.bootstrapSliceSize)))
+                self.bootstrapSettings = settings
+            pool, slices = self.bootstrapPool, self.bootstrapSlices
+        numberOfBlocks = min(len(groupStarts), 4 * numberOfThreads)
+        if pool is not None and numberOfBlocks > 1 and numberOfResamples * size > 2 * self.bootstrapSliceSize:
+            pool.map(sumResamples, [groupStarts[block::numberOfBlocks] for block in xrange(numberOfBlocks)])
+        else:
+            sumResamples(groupStarts)
+        if self.canceled.isSet():
+            return
+        resampledStatistics = [sums / size]
+        sortedArray = numpy.sort(valueArray)
+        random = numpy.random.RandomState([self.bootstrapSeed, numberOfResamples])
+        for rank in self.percentileRanks(size, fieldState.percentiles.keys()):
+            orderStatistics = random.beta(rank + 1, size - rank, numberOfResamples)
+            resampledStatistics.append(sortedArray[numpy.minimum((orderStatistics * size).astype(numpy.intp), size - 1)])
+        alpha = (100 - self.bootstrapConfidence) / 2.0
+        bounds = self.percentileRanks(numberOfResamples, [alpha, 100 - alpha])
+        fieldState.confidence = self.bootstrapConfidence
+        fieldState.intervals = collections.OrderedDict()
+        for key, statistics in zip(['Mean'] + fieldState.percentiles.keys(), resampledStatistics):
+            lower, upper = numpy.partition(statistics, numpy.unique(bounds))[bounds]
+            fieldState.intervals[key] = (round(float(lower), self.numberOfDecimals),
+                                         round(float(upper), self.numberOfDecimals))
+
+    def binIndexes(self, valueArray, edges):
+        #  Index of the bin of each value of valueArray for the equal width bins of edges, -1 outside of the bins
+        #  The last bin includes its upper edge, as in numpy.histogram
+        numberOfBins = len(edges) - 1
+        low, high = edges[0], edges[-1]
+        inside = (valueArray >= low) & (valueArray <= high)  # NaN are outside
+        indexes = numpy.full(valueArray.shape, -1, dtype=numpy.intp)
+        insideValues = valueArray[inside]
+        insideIndexes = ((insideValues - low) * (numberOfBins / (high - low))).astype(numpy.intp)
+        numpy.minimum(insideIndexes, numberOfBins - 1, out=insideIndexes)
+        #  Rounding errors of the division are corrected with the edges themselves
+        insideIndexes -= insideValues < edges[insideIndexes]
+        insideIndexes += (insideValues >= edges[insideIndexes + 1]) & (insideIndexes < numberOfBins - 1)
+        indexes[inside] = insideIndexes
+        return indexes
+
+    def computeHistograms(self, valueArray, edges, groups=None, numberOfGroups=1):
+        #  Histograms of the values of valueArray in the bins of edges, one per group, counted in one numpy.bincount
+        #  groups gives the group (in [0, numberOfGroups)) of each value and is broadcast against valueArray
+        #  (e.g. a column of row numbers for a matrix); None counts all the values in one histogram
+        #  Return an array of numberOfGroups rows of len(edges) - 1 counts
+        numberOfBins = len(edges) - 1
+        indexes = self.binIndexes(valueArray, edges)
+        inside = indexes >= 0
+        if groups is not None:
+            indexes += numpy.broadcast_to(groups, indexes.shape) * numberOfBins
+        histograms = numpy.bincount(indexes[inside], minlength=numberOfGroups * numberOfBins)
+        return histograms.reshape(numberOfGroups, numberOfBins)
+
+    def computeStreamingStatistics(self, fieldArray, ROIArray, fieldState):
+        #  fieldArray and ROIArray (None for the entire shape) are numpy arrays read by chunks:
+        #  the memory used does not depend on their size
+        #  The StreamingStatistics is kept in fieldState to be merged later (see mergeCohortStatistics)
+        streamingStatistics = StreamingStatistics(self.sketchCapacity)
+        edges = fieldState.histogramEdges
+        if edges is not None:
+            fieldState.histogram = numpy.zeros(len(edges) - 1, dtype=numpy.intp)
+        for start in xrange(0, len(fieldArray), self.streamingChunkSize):
+            valueArray = fieldArray[start:start + self.streamingChunkSize]
+            if ROIArray is not None:
+                valueArray = valueArray[ROIArray[start:start + self.streamingChunkSize] == 1.0]
+            streamingStatistics.update(valueArray)
+            if edges is not None:
+                fieldState.histogram += self.computeHistograms(valueArray, edges)[0]
+            if self.canceled.isSet():
+                break
+        fieldState.streamingStatistics = streamingStatistics
+        self.fillStatisticStore(streamingStatistics, fieldState)
+
+    def mergeCohortStatistics(self, ROIName, fieldName, streamingStatistics):
+        #  Merge the StreamingStatistics of a shape into the cohort statistics of a ROI and a field, without reading its
+        #  arrays again: once merged, sketches of the shapes are dropped, so the memory used does not depend on the
+        #  number of shapes
+        key = (ROIName, fieldName)
+        if key not in self.cohortStatistics:
+            self.cohortStatistics[key] = StreamingStatistics(self.sketchCapacity)
+        self.cohortStatistics[key].merge(streamingStatistics)
+
+    def completeCohortStatistics(self, ROIDict):
+        #  Add the cohort statistics of the Run to ROIDict once all its tasks are done (not when it is canceled)
+        if self.cohortStatistics is not None and not self.canceled.isSet():
+            for (ROIName, fieldName), cohortStatistics in self.cohortStatistics.iteritems():
+                ROIDict[ROIName][fieldName][self.cohortName] = self.createCohortStatisticStore(cohortStatistics)
+        self.cohortStatistics = None
+
+    def createCohortStatisticStore(self, cohortStatistics):
+        fieldState = self.StatisticStore(self.percentiles)
+        self.fillStatisticStore(cohortStatistics, fieldState)
+        return fieldState
+
+    def fillStatisticStore(self, streamingStatistics, fieldState):
+        if streamingStatistics.count == 0:
+            return
+        fieldState.min = round(streamingStatistics.min, self.numberOfDecimals)
+        fieldState.max = round(streamingStatistics.max, self.numberOfDecimals)
+        fieldState.mean = round(streamingStatistics.mean, self.numberOfDecimals)
+        fieldState.std = round(math.sqrt(streamingStatistics.M2 / streamingStatistics.count), self.numberOfDecimals)
+        percentiles = fieldState.percentiles.keys()
+        for percent, value in zip(percentiles, streamingStatistics.sketch.computePercentiles(percentiles)):
+            fieldState.percentiles[percent] = round(float(value), self.numberOfDecimals)
+
+    def getVertexAreas(self, polyData):
+        #  Area of each vertex of polyData, computed once per geometry
+        modificationTime = (polyData.GetPoints().GetMTime(), polyData.GetPolys().GetMTime(), polyData.GetStrips().GetMTime())
+        if polyData not in self.vertexAreas or self.vertexAreas[polyData][0] != modificationTime:
+            self.vertexAreas[polyData] = (modificationTime, self.computeVertexAreas(polyData))
+        return self.vertexAreas[polyData][1]
+
+    def computeVertexAreas(self, polyData):
+        #  Each vertex gets a third of the area of every triangle it belongs to
+        #  Computed with numpy on the connectivity of the triangles (see getTriangles)
+        triangles = self.getTriangles(polyData)
+        points = numpy_support.vtk_to_numpy(polyData.GetPoints().GetData()).astype(numpy.float64)
+        edges1 = points[triangles[:, 1]] - points[triangles[:, 0]]
+        edges2 = points[triangles[:, 2]] - points[triangles[:, 0]]
+        triangleAreas = 0.5 * numpy.sqrt(numpy.sum(numpy.square(numpy.cross(edges1, edges2)), axis=1))
+        return numpy.bincount(triangles.ravel(), weights=numpy.repeat(triangleAreas / 3.0, 3),
+                              minlength=polyData.GetNumberOfPoints())
+
+    def getTriangles(self, polyData):
+        #  Array of the 3 vertices of each triangle of polyData, polygons and strips are triangulated first
+        connectivity = numpy_support.vtk_to_numpy(polyData.GetPolys().GetData())
+        if polyData.GetNumberOfStrips() or connectivity.size != 4 * polyData.GetNumberOfPolys() or \
+           numpy.any(connectivity[::4] != 3):
+            triangleFilter = vtk.vtkTriangleFilter()
+            triangleFilter.SetInputData(polyData)
+            triangleFilter.PassVertsOff()
+            triangleFilter.PassLinesOff()
+            triangleFilter.Update()
+            connectivity = numpy_support.vtk_to_numpy(triangleFilter.GetOutput().GetPolys().GetData())
+        return connectivity.reshape(-1, 4)[:, 1:]
+
+    def getAdjacency(self, polyData):
+        #  Vertex adjacency of polyData, computed once per connectivity
+        modificationTime = (polyData.GetPolys().GetMTime(), polyData.GetStrips().GetMTime(), polyData.GetNumberOfPoints())
+        if polyData not in self.adjacencies or self.adjacencies[polyData][0] != modificationTime:
+            self.adjacencies[polyData] = (modificationTime, self.computeAdjacency(polyData))
+        return self.adjacencies[polyData][1]
+
+    def computeAdjacency(self, polyData):
+        #  Sparse vertex adjacency built with numpy from the edges of the triangles (no loop over the cells):
+        #  the neighbors of each vertex are the vertices it shares an edge with
+        #  Return (rows, columns, degrees): sorted by row, each (rows[k], columns[k]) is a pair of neighbors
+        #  (compressed sparse row matrix whose row pointers are the cumulated degrees)
+        numberOfPoints = polyData.GetNumberOfPoints()
+        triangles = self.getTriangles(polyData).astype(numpy.int64)
+        first = triangles.ravel()
+        second = triangles[:, [1, 2, 0]].ravel()
+        edges = first != second  # Degenerate triangles
+        first, second = first[edges], second[edges]
+        keys = numpy.unique(numpy.concatenate((first * numberOfPoints + second, second * numberOfPoints + first)))
+        indexType = numpy.int32 if numberOfPoints < 2 ** 31 else numpy.int64
+        rows = (keys // numberOfPoints).astype(indexType)
+        columns = (keys % numberOfPoints).astype(indexType)
+        return rows, columns, numpy.bincount(rows, minlength=numberOfPoints)
+
+    def computeNeighborhoodFields(self, polyData, valueArray):
+        #  Neighborhood fields of valueArray on the surface of polyData, computed with sparse matrix-vector products
+        #  on the vertex adjacency (numpy.bincount of the values of the neighbors):
+        #  - 'Smoothed': valueArray averaged smoothingRings times on each vertex and its neighbors (Laplacian
+        #    smoothing, whose support grows by one ring at each step)
+        #  - 'Local Mean' and 'Local SD': mean and standard deviation of valueArray on the localRings rings around each
+        #    vertex, the values being weighted by the same averaging repeated localRings times
+        #  Return an OrderedDict: Key = kind, Value = array with one value per vertex
+        rows, columns, degrees = self.getAdjacency(polyData)
+        weights = 1.0 / (1 + degrees)
+
+        def average(values):
+            return (values + numpy.bincount(rows, weights=values[columns], minlength=len(values))) * weights
+
+        values = valueArray.astype(numpy.float64)
+        neighborhoodFields = collections.OrderedDict()
+        if self.smoothingRings > 0:
+            smoothed = values
+            for ring in range(self.smoothingRings):
+                smoothed = average(smoothed)
+            neighborhoodFields['Smoothed'] = smoothed
+        if self.localRings > 0:
+            means = values
+            squares = values * values
+            for ring in range(self.localRings):
+                means = average(means)
+                squares = average(squares)
+            neighborhoodFields['Local Mean'] = means
+            neighborhoodFields['Local SD'] = numpy.sqrt(numpy.maximum(squares - means * means, 0))
+        return neighborhoodFields
+
+    def computeWeightedStatistics(self, valueArray, weightArray, fieldState):
+        #  Weighted min, max, mean, standard deviation and percentiles of valueArray
+        #  The percentile of percent p is the first sorted value whose cumulated weight reaches p * total weight
+        #  (with equal weights, the same value as computePercentile)
+        if valueArray.size == 0:
+            return
+        totalWeight = numpy.sum(weightArray)
+        if totalWeight <= 0:
+            return
+        order = numpy.argsort(valueArray, kind='mergesort')
+        sortedArray = valueArray[order]
+        cumulativeWeights = numpy.cumsum(weightArray[order])
+        mean = numpy.sum(weightArray * valueArray, dtype=numpy.float64) / totalWeight
+        variance = numpy.sum(weightArray * numpy.square(valueArray - mean), dtype=numpy.float64) / totalWeight
+        fieldState.min = round(float(sortedArray[0]), self.numberOfDecimals)
+        fieldState.max = round(float(sortedArray[-1]), self.numberOfDecimals)
+        fieldState.mean = round(mean, self.numberOfDecimals)
+        fieldState.std = round(math.sqrt(variance), self.numberOfDecimals)
+        percentiles = fieldState.percentiles.keys()
+        targets = numpy.asarray(percentiles, dtype=numpy.float64) / 100.0 * cumulativeWeights[-1]
+        indexes = numpy.minimum(numpy.searchsorted(cumulativeWeights, targets), sortedArray.size - 1)
+        for percent, index in zip(percentiles, indexes):
+            fieldState.percentiles[percent] = round(float(sortedArray[index]), self.numberOfDecimals)
+        if fieldState.histogramEdges is not None:
+            fieldState.histogram = self.computeHistograms(valueArray, fieldState.histogramEdges)[0]
+
     def computeAll(self, fieldArray, fieldState, ROIArray):
-        array = self.defineArray(fieldArray, ROIArray)
-        fieldState.min, fieldState.max = self.computeMinMax(array)
-        fieldState.mean = self.computeMean(array)
-        fieldState.std = self.computeStandardDeviation(array)
-        fieldState.percentile5 = self.computePercentile(array, 0.05)
-        fieldState.percentile15 = self.computePercentile(array, 0.15)
-        fieldState.percentile25 = self.computePercentile(array, 0.25)
-        fieldState.percentile50 = self.computePercentile(array, 0.50)
-        fieldState.percentile75 = self.computePercentile(array, 0.75)
-        fieldState.percentile85 = self.computePercentile(array, 0.85)
-        fieldState.percentile95 = self.computePercentile(array, 0.95)
-
-    def writeFieldFile(self, fileWriter, modelDict):
+        ROIName = 'Entire Shape' if ROIArray == 'None' else ROIArray.GetName()
+        with self.measure('computeAll', field=fieldArray.GetName(), ROI=ROIName) as measure:
+            array = self.defineArray(fieldArray, ROIArray)
+            self.computeStatistics(array, fieldState)
+            if array is not None:
+                measure.count(array)
+
+    def formatRow(self, row, decimalSeparator='.'):
+        #  Values of a row of statistics written with decimalSeparator (floats are written as csv.writer does),
+        #  NaN (not computed) written as empty cells
+        if decimalSeparator == '.':
+            return row[:1] + [value if value == value else '' for value in row[1:]]
+        return row[:1] + [repr(value).replace('.', decimalSeparator) if value == value else '' for value in row[1:]]
+
+    def writeFieldFile(self, fileWriter, modelDict, decimalSeparator='.'):
         #  Function defined to export all statistics of a field concidering a file writer (fileWriter)
         #  and a dictionary of models (modelDict) where statistics are stored
         for shapeName, shapeStats in modelDict.iteritems():
-            fileWriter.writerow([shapeName,
-                                 shapeStats.min,
-                                 shapeStats.max,
-                                 shapeStats.mean,
-                                 shapeStats.std,
-                                 shapeStats.percentile5,
-                                 shapeStats.percentile15,
-                                 shapeStats.percentile25,
-                                 shapeStats.percentile50,
-                                 shapeStats.percentile75,
-                                 shapeStats.percentile85,
-                                 shapeStats.percentile95])
-
-    def exportAllAsCSV(self, filename, ROIName, ROIDictValue):
-        #  Export all fields on the same csv file
-        file = open(filename, 'w')
-        cw = csv.writer(file, delimiter=',')
-        cw.writerow([ROIName])
-        for fieldName, shapeDict in sorted(ROIDictValue.iteritems()):
-            print shapeDict
-            cw.writerow([fieldName])
-            cw.writerow(['Shape','Min','Max','Mean','SD','5th centile','15th centile','25th centile','50th centile','75th centile','85th centile','95th centile'])
-            self.writeFieldFile(cw, shapeDict)
-            cw.writerow([' '])
-        file.close()
-
-    def exportFieldAsCSV(self, filename, fieldName, shapeDict):
-        #  Export fields on different csv files
-        file = open(filename, 'w')
-        cw = csv.writer(file, delimiter=',')
-        cw.writerow([fieldName])
-        cw.writerow(['Shape','Min','Max','Mean','SD','5th centile','15th centile','25th centile','50th centile','75th centile','85th centile','95th centile'])
-        self.writeFieldFile(cw, shapeDict)
-        file.close()
+            fileWriter.writerow(self.formatRow(self.statisticsRow(shapeName, shapeStats), decimalSeparator))
+
+    def writeHistograms(self, fileWriter, modelDict, decimalSeparator='.'):
+        #  Histograms of a field, after its statistics: the edges of the bins, shared by all the shapes,
+        #  then one row of counts per shape (nothing is written when histograms were not computed)
+        histograms = [(shapeName, shapeStats.histogram) for shapeName, shapeStats in modelDict.iteritems()
+                      if shapeStats.histogram is not None]
+        if histograms:
+            edges = modelDict[histograms[0][0]].histogramEdges
+            self.writeHistogramRows(fileWriter, edges, histograms, decimalSeparator)
+
+    def writeHistogramRows(self, fileWriter, edges, histograms, decimalSeparator='.'):
+        #  histograms is a list of (name of shape, counts of the bins of edges)
+        fileWriter.writerow(['Histogram'])
+        fileWriter.writerow(self.formatRow(['Bin edges'] + numpy.asarray(edges).tolist(), decimalSeparator))
+        for shapeName, histogram in histograms:
+            fileWriter.writerow([shapeName] + numpy.asarray(histogram).tolist())
+
+    def exportAllAsCSV(self, filename, ROIName, ROIDictValue, delimiter=',', decimalSeparator='.'):
+        #  Export all fields on the same csv file, in a single buffered pass
+        with self.measure('exportationFunction', ROI=ROIName) as measure:
+            with open(filename, 'wb', 1 << 16) as file:
+                cw = csv.writer(file, delimiter=delimiter)
+                cw.writerow([ROIName])
+                for fieldName, shapeDict in sorted(ROIDictValue.iteritems()):
+                    cw.writerow([fieldName])
+                    cw.writerow(self.statisticsHeader(self.getPercentiles(shapeDict), self.getConfidence(shapeDict)))
+                    self.writeFieldFile(cw, shapeDict, decimalSeparator)
+                    self.writeHistograms(cw, shapeDict, decimalSeparator)
+                    cw.writerow([' '])
+                    measure.count(len(shapeDict))
+            if self.profiler is not None:
+                measure.count(0, os.path.getsize(filename))
+
+    def exportFieldAsCSV(self, filename, fieldName, shapeDict, delimiter=',', decimalSeparator='.', ROIName=None):
+        #  Export fields on different csv files, in a single buffered pass
+        with self.measure('exportationFunction', field=fieldName, ROI=ROIName) as measure:
+            with open(filename, 'wb', 1 << 16) as file:
+                cw = csv.writer(file, delimiter=delimiter)
+                cw.writerow([fieldName])
+                cw.writerow(self.statisticsHeader(self.getPercentiles(shapeDict), self.getConfidence(shapeDict)))
+                self.writeFieldFile(cw, shapeDict, decimalSeparator)
+                self.writeHistograms(cw, shapeDict, decimalSeparator)
+            if self.profiler is not None:
+                measure.count(len(shapeDict), os.path.getsize(filename))
+
+    def runConfiguration(self):
+        #  Settings of the statistics, kept with each run of a StatisticsDatabase
+        return {'percentiles': self.percentiles, 'numberOfDecimals': self.numberOfDecimals,
+                'streaming': self.streaming, 'areaWeighted': self.areaWeighted,
+                'bootstrapResamples': self.bootstrapResamples, 'bootstrapConfidence': self.bootstrapConfidence,
+                'bootstrapSeed': self.bootstrapSeed, 'histogramBins': self.histogramBins,
+                'smoothingRings': self.smoothingRings, 'localRings': self.localRings}
+
+    def rowRecords(self, ROIName, fieldName, header, row, histogram=None, histogramEdges=None):
+        #  Records (shape, ROI, field, statistic, value) of a row of statistics (see StatisticsDatabase),
+        #  with one statistic per bin of the histogram, e.g. "Histogram [0.5, 1.0]"
+        #  Statistics which were not computed (NaN) have no record
+        shapeName = row[0]
+        records = [(shapeName, ROIName, fieldName, statistic, float(value))
+                   for statistic, value in zip(header[1:], row[1:]) if value == value]
+        if histogram is not None:
+            for low, high, count in zip(histogramEdges[:-1], histogramEdges[1:], histogram):
+                records.append((shapeName, ROIName, fieldName, 'Histogram [%r, %r]' % (float(low), float(high)),
+                                int(count)))
+        return records
+
+    def statisticsRecords(self, ROIDict):
+        #  Records of all the statistics of ROIDict (see rowRecords)
+        for ROIName, ROIDictValue in sorted(ROIDict.iteritems()):
+            for fieldName, shapeDict in sorted(ROIDictValue.iteritems()):
+                header = self.statisticsHeader(self.getPercentiles(shapeDict), self.getConfidence(shapeDict))
+                for shapeName, shapeStats in shapeDict.iteritems():
+                    for record in self.rowRecords(ROIName, fieldName, header, self.statisticsRow(shapeName, shapeStats),
+                                                  shapeStats.histogram, shapeStats.histogramEdges):
+                        yield record
+
+    def statisticsEntries(self, ROIDict):
+        #  (shape, ROI, field) of all the statistics of ROIDict
+        return [(shapeName, ROIName, fieldName) for ROIName, ROIDictValue in ROIDict.iteritems()
+                for fieldName, shapeDict in ROIDictValue.iteritems() for shapeName in shapeDict]
+
+    def exportAsSQLite(self, filename, ROIDict):
+        #  Add the statistics of ROIDict to the StatisticsDatabase filename (created if needed) as a new run,
+        #  replacing the statistics exported before for the same shapes, ROIs and fields, without any prompt
+        #  Return the identifier of the run
+        with self.measure('exportationFunction') as measure:
+            database = StatisticsDatabase(filename)
+            try:
+                runID = database.addRun(self.runConfiguration())
+                measure.count(database.write(runID, self.statisticsRecords(ROIDict), self.statisticsEntries(ROIDict)))
+            finally:
+                database.close()
+        return runID
 
     def exportationFunction(self, BoolComa, directoryExport, exportCheckBox, ROIDict):
         #  BoolComa is a boolean to know what kind of exportation is wanted
         #  BoolComa = True for COMA Exportation And False for DOT's one
+        #  COMA exportation uses the semicolon as value separator and the comma as decimal separator
+        if BoolComa:
+            delimiter, decimalSeparator = ';', ','
+        else:
+            delimiter, decimalSeparator = ',', '.'
 
         directory = directoryExport.directory
         messageBox = ctk.ctkMessageBox()
@@ -414,20 +2574,14 @@ class MeshStatsLogic (ScriptedLoadableModuleLogic):
                         if choice == messageBox.NoToAll:
                             break
                         if choice == messageBox.Yes:
-                            self.exportFieldAsCSV(filename, fieldName, modelDict)
-                            if BoolComa:
-                                self.convertCSVWithComma(filename)
+                            self.exportFieldAsCSV(filename, fieldName, modelDict, delimiter, decimalSeparator, ROIName)
                         if choice == messageBox.YesToAll:
                             for fieldName, shapeDict in sorted(ROIDictValue.iteritems()):
                                 filename = directoryFolder + "/" + fieldName + ".csv"
-                                self.exportFieldAsCSV(filename, fieldName, shapeDict)
-                                if BoolComa:
-                                    self.convertCSVWithComma(filename)
+                                self.exportFieldAsCSV(filename, fieldName, shapeDict, delimiter, decimalSeparator, ROIName)
                             break
                     else:
-                        self.exportFieldAsCSV(filename, fieldName, modelDict)
-                        if BoolComa:
-                            self.convertCSVWithComma(filename)
+                        self.exportFieldAsCSV(filename, fieldName, modelDict, delimiter, decimalSeparator, ROIName)
         else:
             for ROIName, ROIDictValue in sorted(ROIDict.iteritems()):
                 filename = directory + "/" + ROIName + ".csv"
@@ -439,37 +2593,14 @@ class MeshStatsLogic (ScriptedLoadableModuleLogic):
                     if choice == messageBox.NoToAll:
                         break
                     if choice == messageBox.Yes:
-                        self.exportAllAsCSV(filename, ROIName, ROIDictValue)
-                        if BoolComa:
-                            self.convertCSVWithComma(filename)
+                        self.exportAllAsCSV(filename, ROIName, ROIDictValue, delimiter, decimalSeparator)
                     if choice == messageBox.YesToAll:
                         for ROIName, ROIDictValue in sorted(ROIDict.iteritems()):
                             filename = directory + "/" + ROIName + ".csv"
-                            self.exportAllAsCSV(filename, ROIName, ROIDictValue)
-                            if exportCheckBox.isChecked():
-                                self.convertCSVWithComma(filename)
+                            self.exportAllAsCSV(filename, ROIName, ROIDictValue, delimiter, decimalSeparator)
                         break
                 else:
-                    self.exportAllAsCSV(filename, ROIName, ROIDictValue)
-                    if BoolComa:
-                        self.convertCSVWithComma(filename)
-
-    def replaceCharac(self, filename, oldCharac, newCharac):
-        #  Function to replace a charactere (oldCharac) in a file (filename) by a new one (newCharac)
-        file = open(filename,'r')
-        lines = file.readlines()
-        with open(filename, 'r') as file:
-            lines = [line.replace(oldCharac, newCharac) for line in file.readlines()]
-        file.close()
-        file = open(filename, 'w')
-        file.writelines(lines)
-        file.close()
-
-    def convertCSVWithComma(self, filename):
-        #  Convert the comma (used as value separator) by the semicolon
-        #  Convert the dot (used as decimal separator) by the comma
-        self.replaceCharac(filename, ',', ';')
-        self.replaceCharac(filename, '.', ',')
+                    self.exportAllAsCSV(filename, ROIName, ROIDictValue, delimiter, decimalSeparator)
 
 class MeshStatsTest(ScriptedLoadableModuleTest):
     def setUp(self):
@@ -489,6 +2620,7 @@ class MeshStatsTest(ScriptedLoadableModuleTest):
         return array
 
     def testStorageValue(self, logic):
+        from random import randint
         print " Test storage of Values: "
         bool = True
         arrayValue = vtk.vtkDoubleArray()
@@ -518,6 +2650,22 @@ class MeshStatsTest(ScriptedLoadableModuleTest):
         if bool:
             print "         Passed"
 
+    def testDefineArrayWithoutROI(self, logic):
+        print " Test array without ROI and with a wrong size of ROI: "
+        arrayValue = vtk.vtkDoubleArray()
+        arrayMask = vtk.vtkDoubleArray()
+        for i in range(0, 100):
+            arrayValue.InsertNextValue(i)
+            arrayMask.InsertNextValue(1.0)
+        arrayMask.InsertNextValue(1.0)
+        array = logic.defineArray(arrayValue, 'None')
+        if array.size != 100 or array[0] != 0 or array[99] != 99:
+            print "         Failed"
+        elif logic.defineArray(arrayValue, arrayMask) is not None:
+            print "         Failed"
+        else:
+            print "         Passed"
+
     def testMinMaxMeanFunctions(self, logic):
         print "Test min, max, mean, and std: "
         array = self.defineArrays(logic, 1, 101)
@@ -561,11 +2709,562 @@ class MeshStatsTest(ScriptedLoadableModuleTest):
         else:
             print "         Passed! "
 
+    def testComputeStatistics(self, logic):
+        print " Test single pass statistics with configurable percentiles: "
+        array = self.defineArrays(logic, 1, 1000)
+        numpy.random.shuffle(array)
+        fieldState = logic.StatisticStore([1, 5, 15, 25, 50, 75, 85, 95, 99])
+        logic.computeStatistics(array, fieldState)
+        bool = (fieldState.min, fieldState.max) == logic.computeMinMax(array) and \
+               fieldState.mean == logic.computeMean(array) and \
+               fieldState.std == logic.computeStandardDeviation(array)
+        for percent, value in fieldState.percentiles.iteritems():
+            if value != logic.computePercentile(array, percent / 100.0):
+                bool = False
+        if bool and fieldState.percentile99 == 990 and logic.centileLabel(1) == '1st centile':
+            print "         Passed"
+        else:
+            print "         Failed"
+
+    def testStreamingStatistics(self, logic):
+        print " Test streaming statistics and quantile sketch: "
+        array = numpy.random.RandomState(0).randn(200000)
+        firstHalf = StreamingStatistics(256)
+        secondHalf = StreamingStatistics(256)
+        for start in range(0, 100000, 1000):
+            firstHalf.update(array[start:start + 1000])
+            secondHalf.update(array[100000 + start:101000 + start])
+        firstHalf.merge(secondHalf)
+        sortedArray = numpy.sort(array)
+        ranks = numpy.searchsorted(sortedArray, firstHalf.sketch.computePercentiles([5, 50, 95]))
+        maximumRankError = array.size * (math.log(array.size / 256.0, 2) + 1) / 256
+        if numpy.any(numpy.abs(ranks - logic.percentileRanks(array.size, [5, 50, 95])) > maximumRankError) or \
+           abs(firstHalf.mean - numpy.mean(array)) > 1e-9 or abs(math.sqrt(firstHalf.M2 / firstHalf.count) - numpy.std(array)) > 1e-9:
+            print "         Failed"
+        else:
+            print "         Passed"
+
+    def testBatchedStatistics(self, logic):
+        print " Test statistics of batched shapes against shapes computed one by one: "
+        shapes = list()
+        for shapeIndex in range(3):
+            polyData = vtk.vtkPolyData()
+            polyData.SetPoints(vtk.vtkPoints())
+            polyData.GetPoints().SetNumberOfPoints(1000)
+            random = numpy.random.RandomState(shapeIndex)
+            for arrayName, values in (('Field', random.randn(1000) + shapeIndex), ('Other Field', random.rand(1000)),
+                                      ('HalfROI', numpy.arange(1000) % 2), ('RandomROI', random.rand(1000) < 0.3)):
+                array = numpy_support.numpy_to_vtk(numpy.asarray(values, dtype=numpy.float64), deep=1)
+                array.SetName(arrayName)
+                polyData.GetPointData().AddArray(array)
+            shapes.append(('shape%d' % shapeIndex, polyData))
+        logic.bootstrapResamples = 100
+        logic.histogramBins = 8
+        ROIDicts = list()
+        batched = list()
+        for batchCorrespondedShapes in (True, False):
+            logic.batchCorrespondedShapes = batchCorrespondedShapes
+            ROIDict = dict((ROIName, {'Field': dict(), 'Other Field': dict()})
+                           for ROIName in ('Entire Shape', 'HalfROI', 'RandomROI'))
+            logic.executePlan(logic.planRun(shapes, ROIDict), ROIDict)
+            ROIDicts.append(ROIDict)
+            batched.append(logic.batched)
+        logic.batchCorrespondedShapes = True
+        logic.bootstrapResamples = 0
+        logic.histogramBins = 0
+        #  Population maps without the entire shapes: computed by the last task of the pool
+        logic.computePopulationMaps = True
+        ROIDict = {'HalfROI': {'Field': dict()}}
+        logic.startStatistics(logic.planRun(shapes, ROIDict), ROIDict)
+        logic.threadPool.join()
+        finished, numberOfTasks, finishedROIs = logic.pollStatistics(ROIDict)
+        logic.computePopulationMaps = False
+        rows = [numpy_support.vtk_to_numpy(polyData.GetPointData().GetArray('Field')) for shapeName, polyData in shapes]
+        bool = batched == [True, False] and finished == numberOfTasks == 2 and finishedROIs == ['HalfROI'] and \
+            numpy.allclose(logic.populationMaps['Field']['Mean'], numpy.mean(rows, axis=0))
+        for ROIName, ROIFieldDict in ROIDicts[0].iteritems():
+            for fieldName, shapeDict in ROIFieldDict.iteritems():
+                for shapeName, fieldState in shapeDict.iteritems():
+                    otherState = ROIDicts[1][ROIName][fieldName][shapeName]
+                    if logic.statisticsRow(shapeName, fieldState) != logic.statisticsRow(shapeName, otherState) or \
+                       fieldState.confidence != otherState.confidence or \
+                       not numpy.array_equal(fieldState.histogramEdges, otherState.histogramEdges) or \
+                       not numpy.array_equal(fieldState.histogram, otherState.histogram):
+                        bool = False
+        if not bool:
+            print "         Failed"
+        else:
+            print "         Passed"
+
+    def testCohortStatistics(self, logic):
+        print " Test cohort statistics merged from the sketches of the shapes: "
+        shapes = list()
+        arrays = list()
+        for shapeIndex in range(3):
+            polyData = vtk.vtkPolyData()
+            polyData.SetPoints(vtk.vtkPoints())
+            polyData.GetPoints().SetNumberOfPoints(1000)
+            arrays.append(numpy.random.RandomState(shapeIndex).randn(1000) + shapeIndex)
+            array = numpy_support.numpy_to_vtk(arrays[-1], deep=1)
+            array.SetName('Field')
+            polyData.GetPointData().AddArray(array)
+            shapes.append(('shape%d' % shapeIndex, polyData))
+        logic.streaming = True
+        ROIDict = {'Entire Shape': {'Field': dict()}}
+        logic.entryVersions = dict()
+        logic.recordVersions(shapes, {'Entire Shape': ['Field']})
+        logic.executePlan(logic.planRun(shapes, ROIDict), ROIDict)
+        shapeDict = ROIDict['Entire Shape']['Field']
+        cohortState = shapeDict.get(logic.cohortName)
+        pooledArray = numpy.concatenate(arrays)
+        bool = cohortState is not None and len(shapeDict) == 4 and \
+            cohortState.mean == logic.computeMean(pooledArray) and cohortState.std == logic.computeStandardDeviation(pooledArray) and \
+            (cohortState.min, cohortState.max) == logic.computeMinMax(pooledArray) and \
+            all(getattr(shapeStats, 'streamingStatistics', None) is None for shapeStats in shapeDict.itervalues())
+        #  Live mode: the cohort row cannot be updated with the changed shape and is removed
+        shapes[0][1].GetPointData().GetArray('Field').Modified()
+        tasks, changedROIs = logic.planLiveStatistics(shapes, ROIDict)
+        logic.streaming = False
+        if not bool or len(tasks) != 1 or logic.cohortName in shapeDict or changedROIs != set(['Entire Shape']):
+            print "         Failed"
+        else:
+            print "         Passed"
+
+    def testExportWithComma(self, logic):
+        print " Test exportation as 0,000: "
+        fieldState = logic.StatisticStore(logic.percentiles)
+        logic.computeStatistics(self.defineArrays(logic, 1, 101) / 8.0, fieldState)
+        filename = os.path.join(slicer.app.temporaryPath, 'MeshStatsTest.csv')
+        logic.exportFieldAsCSV(filename, 'field.name', {'shape.vtk': fieldState}, ';', ',')
+        with open(filename, 'r') as file:
+            lines = file.read().splitlines()
+        os.remove(filename)
+        if lines[0] != 'field.name' or lines[2] != 'shape.vtk;0,125;12,5;6,313;3,608;0,625;1,875;3,125;6,25;9,375;10,625;11,875':
+            print "         Failed", lines
+        else:
+            print "         Passed"
+
+    def testAreaWeightedStatistics(self, logic):
+        print " Test area weighted statistics: "
+        sphereSource = vtk.vtkSphereSource()
+        sphereSource.SetThetaResolution(40)
+        sphereSource.SetPhiResolution(40)
+        sphereSource.Update()
+        massProperties = vtk.vtkMassProperties()
+        massProperties.SetInputConnection(sphereSource.GetOutputPort())
+        massProperties.Update()
+        vertexAreas = logic.getVertexAreas(sphereSource.GetOutput())
+        array = self.defineArrays(logic, 1, 1000)
+        numpy.random.shuffle(array)
+        fieldState = logic.StatisticStore(logic.percentiles)
+        weightedState = logic.StatisticStore(logic.percentiles)
+        logic.computeStatistics(array, fieldState)
+        logic.computeWeightedStatistics(array, numpy.ones(array.size), weightedState)
+        if abs(numpy.sum(vertexAreas) - massProperties.GetSurfaceArea()) > 1e-9 or \
+           logic.statisticsRow('', fieldState) != logic.statisticsRow('', weightedState):
+            print "         Failed"
+        else:
+            print "         Passed"
+
+    def testStageProfiler(self, logic):
+        print " Test stage profiler: "
+        arrayValue = vtk.vtkDoubleArray()
+        arrayValue.SetName('Distance')
+        ROIArray = vtk.vtkDoubleArray()
+        ROIArray.SetName('LeftROI')
+        for i in range(0, 100):
+            arrayValue.InsertNextValue(i)
+            ROIArray.InsertNextValue(i % 2)
+        fieldState = logic.StatisticStore(logic.percentiles)
+        logic.computeAll(arrayValue, fieldState, ROIArray)  # Profiling disabled: nothing is recorded
+        profiler = logic.enableProfiling()
+        logic.computeAll(arrayValue, fieldState, ROIArray)
+        logic.computeAll(arrayValue, fieldState, ROIArray)
+        records = profiler.query(field='Distance', ROI='LeftROI')
+        logic.enableProfiling(False)
+        if [(record['stage'], record['calls'], record['elements'], record['bytes']) for record in records] != \
+           [('defineArray', 2, 100, 800), ('computeAll', 2, 100, 800)]:
+            print "         Failed"
+        else:
+            print "         Passed"
+
+    def testLabelStatistics(self, logic):
+        print " Test statistics of label arrays: "
+        valueArray = numpy.random.permutation(1000).astype(numpy.float64)
+        labelArray = numpy.arange(1000) % 7
+        labelStates = logic.computeLabelStatistics(valueArray, logic.groupLabels(labelArray))
+        bool = labelStates.keys() == range(1, 7)  # Label 0 is the background
+        for label, labelState in labelStates.iteritems():
+            fieldState = logic.StatisticStore(logic.percentiles)
+            logic.computeStatistics(valueArray[labelArray == label], fieldState)
+            if logic.statisticsRow('', fieldState) != logic.statisticsRow('', labelState):
+                bool = False
+        if not bool:
+            print "         Failed"
+        else:
+            print "         Passed"
+
+    def testLabelArrays(self, logic):
+        print " Test ROIs of the labels found by the tasks: "
+        shapes = list()
+        for shapeIndex, labels in enumerate(([0, 2], [0, 5, 2**40])):
+            polyData = vtk.vtkPolyData()
+            polyData.SetPoints(vtk.vtkPoints())
+            polyData.GetPoints().SetNumberOfPoints(100)
+            fieldArray = numpy_support.numpy_to_vtk(numpy.arange(100.0), deep=1)
+            fieldArray.SetName('Field')
+            polyData.GetPointData().AddArray(fieldArray)
+            labelArray = numpy_support.numpy_to_vtk(numpy.resize(numpy.array(labels, dtype=numpy.uint64), 100), deep=1)
+            labelArray.SetName('SegLabels')
+            polyData.GetPointData().AddArray(labelArray)
+            shapes.append(('shape%d' % shapeIndex, polyData))
+        ROIDict = {'SegLabels': {'Field': dict()}}
+        plan = logic.planRun(shapes, ROIDict)
+        #  Labels are not read by planRun
+        bool = ROIDict == {} and logic.labelArrays == {'SegLabels': []}
+        logic.executePlan(plan, ROIDict)
+        ROINames = ['SegLabels 2', 'SegLabels 5', 'SegLabels %d' % 2**40]
+        bool = bool and logic.labelArrays['SegLabels'] == ROINames and sorted(ROIDict) == sorted(ROINames) and \
+            ROIDict['SegLabels 2']['Field']['shape0'].mean == 50.0 and \
+            ROIDict['SegLabels 5']['Field']['shape1'].mean == 49.0 and 'shape1' not in ROIDict['SegLabels 2']['Field']
+        if not bool:
+            print "         Failed", logic.labelArrays
+        else:
+            print "         Passed"
+
+    def testBootstrapIntervals(self, logic):
+        print " Test bootstrap confidence intervals: "
+        array = self.defineArrays(logic, 1, 1000)
+        fieldState = logic.StatisticStore(logic.percentiles)
+        sameFieldState = logic.StatisticStore(logic.percentiles)
+        slicedFieldState = logic.StatisticStore(logic.percentiles)
+        singleThreadFieldState = logic.StatisticStore(logic.percentiles)
+        canceledFieldState = logic.StatisticStore(logic.percentiles)
+        logic.bootstrapResamples = 200
+        logic.computeStatistics(array, fieldState)
+        logic.computeStatistics(array, sameFieldState)
+        #  Slices of 64 values: 16 slices per resample, spread over the threads with at most 2 slices drawn at once
+        #  (pool and semaphore are built again for the new settings), then drawn by the computing thread only
+        logic.bootstrapSliceSize = 64
+        logic.bootstrapMemoryBudget = 2 * 16 * 64
+        logic.computeStatistics(array, slicedFieldState)
+        rebuilt = logic.bootstrapSettings[1:] == (2 * 16 * 64, 64)
+        logic.bootstrapThreads = 1
+        logic.computeStatistics(array, singleThreadFieldState)
+        rebuilt = rebuilt and logic.bootstrapPool is None
+        logic.bootstrapThreads = None
+        logic.cancelStatistics()
+        logic.computeStatistics(array, canceledFieldState)
+        logic.reset()
+        closed = logic.bootstrapPool is None
+        logic.bootstrapSliceSize = 1 << 16
+        logic.bootstrapMemoryBudget = 8 * 1024 * 1024
+        logic.bootstrapResamples = 0
+        estimates = [fieldState.mean] + fieldState.percentiles.values()
+        if fieldState.intervals != sameFieldState.intervals or len(fieldState.intervals) != len(estimates) or \
+           any(not lower <= estimate <= upper for estimate, (lower, upper) in zip(estimates, fieldState.intervals.values())) or \
+           len(slicedFieldState.intervals) != len(estimates) or canceledFieldState.intervals or not closed or \
+           singleThreadFieldState.intervals != slicedFieldState.intervals or not rebuilt:
+            print "         Failed"
+        else:
+            print "         Passed"
+
+    def testHistograms(self, logic):
+        print " Test histograms: "
+        matrix = numpy.random.RandomState(0).standard_normal((3, 1000))
+        edges = numpy.linspace(-2, 2, 11)
+        histograms = logic.computeHistograms(matrix, edges, numpy.arange(3)[:, numpy.newaxis], 3)
+        bool = histograms.shape == (3, 10)
+        for row, histogram in zip(matrix, histograms):
+            if not numpy.array_equal(histogram, numpy.histogram(row, edges)[0]):
+                bool = False
+        logic.streamingChunkSize = 7
+        bool = bool and logic.computeRange(numpy.append(matrix[0], numpy.nan)) == (matrix[0].min(), matrix[0].max()) \
+            and logic.computeRange(numpy.array([numpy.nan])) is None
+        logic.streamingChunkSize = 65536
+        #  Edges over all the shapes, computed by the tasks and not when planning them
+        shapes = list()
+        for row in matrix:
+            polyData = vtk.vtkPolyData()
+            polyData.SetPoints(vtk.vtkPoints())
+            polyData.GetPoints().SetNumberOfPoints(len(row))
+            array = numpy_support.numpy_to_vtk(row, deep=1)
+            array.SetName('Field')
+            polyData.GetPointData().AddArray(array)
+            shapes.append(('shape%d' % len(shapes), polyData))
+        logic.histogramBins = 10
+        ROIDict = {'Entire Shape': {'Field': dict()}}
+        tasks = logic.planTasks(logic.planRun(shapes, ROIDict), ROIDict)
+        bool = bool and not logic.histogramEdges
+        for ROIName, task in tasks:
+            logic.mergeResults(ROIDict, ROIName, task())
+        logic.histogramBins = 0
+        logic.histogramPlan = None
+        if not bool or not numpy.allclose(logic.histogramEdges['Field'], numpy.linspace(matrix.min(), matrix.max(), 11)):
+            print "         Failed"
+        else:
+            print "         Passed"
+
+    def testReset(self, logic):
+        print " Test reset of the logic on scene close: "
+        polyData = vtk.vtkPolyData()
+        points = vtk.vtkPoints()
+        fieldArray = numpy_support.numpy_to_vtk(numpy.arange(1, 101, dtype=numpy.float64), deep=1)
+        fieldArray.SetName('Field')
+        for i in range(100):
+            points.InsertNextPoint(i, 0, 0)
+        polyData.SetPoints(points)
+        polyData.GetPointData().AddArray(fieldArray)
+        ROIDict = {'Entire Shape': {'Field': dict()}}
+        logic.histogramBins = 4
+        logic.startStatistics(logic.planRun([('shape', polyData)], ROIDict), ROIDict)
+        logic.threadPool.join()
+        logic.pollStatistics(ROIDict)
+        bool = ROIDict['Entire Shape']['Field']['shape'].mean == 50.5 and logic.histogramEdges
+        logic.reset()
+        logic.histogramBins = 0
+        if not bool or logic.histogramEdges or logic.pendingResults or logic.numberOfTasks or logic.arrayIndex:
+            print "         Failed"
+        else:
+            print "         Passed"
+
+    def testLiveStatistics(self, logic):
+        print " Test live recomputation of the changed shapes: "
+        shapes = list()
+        for shapeName in ('shape0', 'shape1'):
+            polyData = vtk.vtkPolyData()
+            polyData.SetPoints(vtk.vtkPoints())
+            polyData.GetPoints().SetNumberOfPoints(100)
+            for arrayName, values in (('Field', numpy.arange(100.0)), ('HalfROI', numpy.arange(100) < 50)):
+                array = numpy_support.numpy_to_vtk(values.astype(numpy.float64), deep=1)
+                array.SetName(arrayName)
+                polyData.GetPointData().AddArray(array)
+            shapes.append((shapeName, polyData))
+        ROIDict = {'Entire Shape': {'Field': dict()}, 'HalfROI': {'Field': dict()}}
+        logic.entryVersions = dict()
+        logic.recordVersions(shapes, dict((ROIName, ROIFieldDict.keys()) for ROIName, ROIFieldDict in ROIDict.iteritems()))
+        logic.executePlan(logic.planRun(shapes, ROIDict), ROIDict)
+        unchangedState = ROIDict['Entire Shape']['Field']['shape0']
+        fieldArray = shapes[1][1].GetPointData().GetArray('Field')
+        numpy_support.vtk_to_numpy(fieldArray)[:] += 100
+        fieldArray.Modified()
+        tasks, changedROIs = logic.planLiveStatistics(shapes, ROIDict)
+        for ROIName, task in tasks:
+            logic.mergeResults(ROIDict, ROIName, task())
+        bool = len(tasks) == 2 and not changedROIs and ROIDict['Entire Shape']['Field']['shape1'].mean == 149.5 and \
+            ROIDict['HalfROI']['Field']['shape1'].mean == 124.5 and \
+            ROIDict['Entire Shape']['Field']['shape0'] is unchangedState
+        tasks, changedROIs = logic.planLiveStatistics(shapes[1:], ROIDict)
+        if not bool or tasks or changedROIs != set(ROIDict) or 'shape0' in ROIDict['HalfROI']['Field']:
+            print "         Failed"
+        else:
+            print "         Passed"
+
+    def testArrayStoreInTasks(self, logic):
+        print " Test copies to the array store made by the tasks: "
+        polyData = vtk.vtkPolyData()
+        polyData.SetPoints(vtk.vtkPoints())
+        polyData.GetPoints().SetNumberOfPoints(100)
+        for arrayName, values in (('Field', numpy.arange(100.0)), ('HalfROI', numpy.arange(100) < 50)):
+            array = numpy_support.numpy_to_vtk(values.astype(numpy.float64), deep=1)
+            array.SetName(arrayName)
+            polyData.GetPointData().AddArray(array)
+        directory = os.path.join(slicer.app.temporaryPath, 'MeshStatsTestArrays')
+        logic.arrayStore = ArrayStore(directory)
+        logic.arrayStore.clear()
+        numbersOfFiles = list()
+        for version in (1, 2):
+            ROIDict = {'HalfROI': {'Field': dict()}}
+            plan = logic.planRun([('shape', polyData, version)], ROIDict)
+            numbersOfFiles.append(len(os.listdir(directory)))
+            logic.executePlan(plan, ROIDict)
+            numbersOfFiles.append(len(os.listdir(directory)))
+        plan = logic.planRun([('shape', None, 2)], {'HalfROI': {'Field': dict()}})
+        bool = ROIDict['HalfROI']['Field']['shape'].mean == 24.5 and isinstance(plan[0].fieldArrays['Field'], numpy.memmap)
+        logic.arrayStore.clear()
+        logic.arrayStore = None
+        #  Nothing is copied by planRun, the arrays of version 1 are replaced by the ones of version 2
+        if not bool or numbersOfFiles != [0, 3, 3, 3]:
+            print "         Failed", numbersOfFiles
+        else:
+            print "         Passed"
+
+    def testStatisticsCacheVersions(self, logic):
+        print " Test cache entries keyed on the versions of the shapes: "
+        polyData = vtk.vtkPolyData()
+        polyData.SetPoints(vtk.vtkPoints())
+        polyData.GetPoints().SetNumberOfPoints(100)
+        array = numpy_support.numpy_to_vtk(numpy.arange(100.0), deep=1)
+        array.SetName('Field')
+        polyData.GetPointData().AddArray(array)
+        logic.cache = StatisticsCache(os.path.join(slicer.app.temporaryPath, 'MeshStatsTestCache'))
+        logic.cache.clear()
+        logic.cache.numberOfSamples = 10  # Values 0, 10, 20...
+        means = list()
+        for version in (1, 1, 2):
+            ROIDict = {'Entire Shape': {'Field': dict()}}
+            logic.executePlan(logic.planRun([('shape', polyData, version)], ROIDict), ROIDict)
+            means.append(ROIDict['Entire Shape']['Field']['shape'].mean)
+            array.SetValue(1, 100.0)  # Not sampled: only a new version of the shape gives its statistics again
+        #  Versions only valid in one session (modification times): the whole content is hashed, once per session
+        logic.cache = StatisticsCache(os.path.join(slicer.app.temporaryPath, 'MeshStatsTestCache'), fullHash=True)
+        logic.cache.numberOfSamples = 10
+        for value in (100.0, 200.0):
+            array.SetValue(1, value)
+            logic.sessionFingerprints.clear()  # Next session
+            ROIDict = {'Entire Shape': {'Field': dict()}}
+            logic.executePlan(logic.planRun([('shape', polyData, 3)], ROIDict), ROIDict)
+            means.append(ROIDict['Entire Shape']['Field']['shape'].mean)
+        logic.cache.clear()
+        logic.cache = None
+        if means != [49.5, 49.5, 50.49, 50.49, 51.49]:
+            print "         Failed", means
+        else:
+            print "         Passed"
+
+    def testNeighborhoodFields(self, logic):
+        print " Test neighborhood smoothing and local statistics: "
+        sphereSource = vtk.vtkSphereSource()
+        sphereSource.SetThetaResolution(12)
+        sphereSource.SetPhiResolution(10)
+        sphereSource.Update()
+        polyData = sphereSource.GetOutput()
+        neighbors = [set([i]) for i in range(polyData.GetNumberOfPoints())]  # Closed 1-ring of each vertex
+        for cellID in range(polyData.GetNumberOfCells()):
+            pointIds = polyData.GetCell(cellID).GetPointIds()
+            cellPoints = [pointIds.GetId(i) for i in range(pointIds.GetNumberOfIds())]
+            for pointID in cellPoints:
+                neighbors[pointID].update(cellPoints)
+        values = numpy.random.RandomState(0).standard_normal(polyData.GetNumberOfPoints())
+        logic.smoothingRings = 3
+        logic.localRings = 1
+        neighborhoodFields = logic.computeNeighborhoodFields(polyData, values)
+        constantFields = logic.computeNeighborhoodFields(polyData, numpy.ones(values.size))
+        logic.smoothingRings = logic.localRings = 0
+        rows, columns, degrees = logic.getAdjacency(polyData)
+        bool = sorted(zip(rows, columns)) == sorted(zip(columns, rows)) and \
+            numpy.allclose(constantFields['Smoothed'], 1) and numpy.allclose(constantFields['Local SD'], 0)
+        for pointID, ring in enumerate(neighbors):
+            ringValues = values[list(ring)]
+            if degrees[pointID] != len(ring) - 1 or \
+               not numpy.isclose(neighborhoodFields['Local Mean'][pointID], numpy.mean(ringValues)) or \
+               not numpy.isclose(neighborhoodFields['Local SD'][pointID], numpy.std(ringValues)):
+                bool = False
+        if not bool:
+            print "         Failed"
+        else:
+            print "         Passed"
+
+    def testNeighborhoodFieldsInTasks(self, logic):
+        print " Test neighborhood fields computed by the tasks, not by planRun: "
+        sphereSource = vtk.vtkSphereSource()
+        sphereSource.Update()
+        polyData = vtk.vtkPolyData()
+        polyData.DeepCopy(sphereSource.GetOutput())
+        fieldArray = numpy_support.numpy_to_vtk(numpy.arange(polyData.GetNumberOfPoints(), dtype=numpy.float64), deep=1)
+        fieldArray.SetName('Field')
+        polyData.GetPointData().AddArray(fieldArray)
+        calls = list()
+        computeNeighborhoodFields = logic.computeNeighborhoodFields
+        logic.computeNeighborhoodFields = lambda *args: calls.append(args) or computeNeighborhoodFields(*args)
+        logic.smoothingRings = 2
+        logic.localRings = 1
+        ROIDict = {'Entire Shape': {'Field': dict()}}
+        plan = logic.planRun([('shape', polyData)], ROIDict)
+        bool = not calls and callable(plan[0].fieldArrays['Field Smoothed 2-ring'])
+        logic.executePlan(plan, ROIDict)
+        del logic.computeNeighborhoodFields
+        bool = bool and polyData in logic.adjacencies
+        logic.planRun(list(), dict())
+        bool = bool and polyData not in logic.adjacencies  # Released once the shape is not planned anymore
+        logic.smoothingRings = logic.localRings = 0
+        if not bool or len(calls) != 1 or len(ROIDict['Entire Shape']) != 4 or \
+           ROIDict['Entire Shape']['Field Local SD 1-ring']['shape'].mean <= 0:
+            print "         Failed"
+        else:
+            print "         Passed"
+
+    def testExportAsSQLite(self, logic):
+        print " Test exportation to SQLite: "
+        fieldState = logic.StatisticStore(logic.percentiles)
+        fieldState.histogramEdges = numpy.linspace(0, 100, 5)
+        logic.computeStatistics(self.defineArrays(logic, 1, 101), fieldState)
+        ROIDict = {'Entire Shape': {'field': {'shape0': fieldState, 'shape1': fieldState, 'shape2': fieldState}}}
+        filename = os.path.join(slicer.app.temporaryPath, 'MeshStatsTest.sqlite')
+        if os.path.exists(filename):
+            os.remove(filename)
+        logic.exportAsSQLite(filename, ROIDict)
+        #  Histogram of shape1 with other bins, shape2 without any vertex: none of their previous records remain
+        fieldState = logic.StatisticStore(logic.percentiles)
+        fieldState.histogramEdges = numpy.linspace(0, 10, 3)
+        logic.computeStatistics(self.defineArrays(logic, 1, 11), fieldState)
+        ROIDict['Entire Shape']['field'] = {'shape1': fieldState, 'shape2': logic.StatisticStore(logic.percentiles)}
+        runID = logic.exportAsSQLite(filename, ROIDict)
+        database = StatisticsDatabase(filename)
+        means = database.connection.execute("SELECT shape, value, run_id FROM statistics WHERE statistic = 'Mean' "
+                                            "ORDER BY shape").fetchall()
+        numberOfRecords = database.connection.execute("SELECT shape, COUNT(*) FROM statistics GROUP BY shape "
+                                                      "ORDER BY shape").fetchall()
+        database.close()
+        os.remove(filename)
+        if means != [('shape0', 50.5, 1), ('shape1', 5.5, runID)] or runID != 2 or \
+           numberOfRecords != [('shape0', 4 + len(logic.percentiles) + 4), ('shape1', 4 + len(logic.percentiles) + 2)]:
+            print "         Failed", means, numberOfRecords
+        else:
+            print "         Passed"
+
+    def testEmptyROI(self, logic):
+        print " Test statistics of a ROI without any vertex: "
+        polyData = vtk.vtkPolyData()
+        polyData.SetPoints(vtk.vtkPoints())
+        polyData.GetPoints().SetNumberOfPoints(100)
+        for arrayName, values in (('Field', numpy.arange(100.0)), ('EmptyROI', numpy.zeros(100))):
+            array = numpy_support.numpy_to_vtk(values, deep=1)
+            array.SetName(arrayName)
+            polyData.GetPointData().AddArray(array)
+        logic.bootstrapResamples = 100
+        ROIDict = {'EmptyROI': {'Field': dict()}, 'Entire Shape': {'Field': dict()}}
+        logic.executePlan(logic.planRun([('shape', polyData, None)], ROIDict), ROIDict)
+        logic.bootstrapResamples = 0
+        emptyRow = logic.statisticsRow('shape', ROIDict['EmptyROI']['Field']['shape'])
+        header = logic.statisticsHeader(logic.percentiles, logic.bootstrapConfidence)
+        row = logic.statisticsRow('shape', ROIDict['Entire Shape']['Field']['shape'])
+        #  Not computed statistics are empty in the CSV files and have no record in the SQLite databases
+        bool = len(emptyRow) == len(row) == len(header) and all(value != value for value in emptyRow[1:]) and \
+            logic.formatRow(emptyRow) == ['shape'] + [''] * (len(row) - 1) and \
+            logic.formatRow(emptyRow, ',') == logic.formatRow(emptyRow) and \
+            logic.rowRecords('EmptyROI', 'Field', header, emptyRow) == [] and \
+            len(logic.rowRecords('Entire Shape', 'Field', header, row)) == len(row) - 1
+        if not bool:
+            print "         Failed", emptyRow
+        else:
+            print "         Passed"
+
     def testAllMeshStatistics(self):
         print "TEST"
         logic = MeshStatsLogic()
         self.testMinMaxMeanFunctions(logic)
         self.testPercentileFunction(logic)
         self.testStorageValue(logic)
+        self.testDefineArrayWithoutROI(logic)
+        self.testComputeStatistics(logic)
+        self.testStreamingStatistics(logic)
+        self.testCohortStatistics(logic)
+        self.testBatchedStatistics(logic)
+        self.testExportWithComma(logic)
+        self.testAreaWeightedStatistics(logic)
+        self.testStageProfiler(logic)
+        self.testLabelStatistics(logic)
+        self.testLabelArrays(logic)
+        self.testBootstrapIntervals(logic)
+        self.testHistograms(logic)
+        self.testReset(logic)
+        self.testLiveStatistics(logic)
+        self.testExportAsSQLite(logic)
+        self.testArrayStoreInTasks(logic)
+        self.testStatisticsCacheVersions(logic)
+        self.testNeighborhoodFields(logic)
+        self.testNeighborhoodFieldsInTasks(logic)
+        self.testEmptyROI(logic)
         print " Done "
 